@@ -0,0 +1,559 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import ssl
+import time
+from collections import deque
+from json import loads as json_loads
+from json.decoder import JSONDecodeError
+from typing import AsyncIterator, BinaryIO, Dict, Iterable, List, Optional, Union
+
+import aiohttp
+
+from .caniot import DeviceId, Endpoint
+from .caniot_attributes import AttributeId, resolve_key
+from .attribute_cache import AttributeCache
+from .controller import AttributeKey, AttributeRequestError, AttributesBatch, DevicePageError, DFUStatus, RestAPI, \
+    ProgressCallback
+from .url import URL
+from .utils import MakeTransientChunks, map_file, read_validator, response_validator, same_validator, write_validator
+from . import tuning
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+async def MakeAsyncChunks(data: Union[bytes, memoryview], size: int) -> AsyncIterator[memoryview]:
+    # asyncio counterpart of utils.MakeTransientChunks, chunks are only valid
+    # until the next one is requested
+    for chunk in MakeTransientChunks(data, size):
+        yield chunk
+
+
+# asyncio counterpart of Controller, all requests share a single aiohttp session
+# whose connector holds at most `pool_size` connections to the controller.
+class AsyncController:
+    def __init__(self, host: str = "192.0.2.1", port: int = None, secure: bool = False,
+                 cert: str = None, key: str = None, verify: str = None,
+                 pool_size: int = 4) -> None:
+
+        self.host = host
+
+        if port is None:
+            self.port = 443 if secure else 80
+        else:
+            self.port = int(port)
+
+        self.secure = secure
+        self.cert = cert
+        self.key = key
+        self.verify = verify
+
+        self.pool_size = pool_size
+
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ssl_context.check_hostname = False
+        if verify:
+            self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+            self.ssl_context.load_verify_locations(verify)
+        else:
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        if cert:
+            self.ssl_context.load_cert_chain(cert, key)
+
+        self.session: Optional[aiohttp.ClientSession] = None
+
+        # HTTP Timeout
+        self.timeout = 5.0
+
+        self.url = URL(f"{self.host}:{self.port}", secure=self.secure)
+
+        self.default_headers = {
+            "Timeout-ms": str(int(self.timeout * 1000)),
+        }
+
+        self.caniot: AsyncCaniotAPI = AsyncCaniotAPI(self)
+
+    def is_http_session(self) -> bool:
+        return self.session is not None and not self.session.closed
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if not self.is_http_session():
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.pool_size,
+                ssl=self.ssl_context if self.secure else False,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.default_headers,
+                timeout=self._client_timeout(self.timeout),
+            )
+        return self.session
+
+    @staticmethod
+    def _client_timeout(timeout: float) -> aiohttp.ClientTimeout:
+        # same meaning as the requests timeout of Controller: bounds the
+        # connection and each read, not the whole transfer (uploads and
+        # downloads may take longer)
+        return aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+
+    async def _req(self,
+                   method,
+                   url,
+                   **kwargs) -> aiohttp.ClientResponse:
+        session = self._get_session()
+
+        t0 = time.perf_counter()
+        async with session.request(method, str(url), **kwargs) as resp:
+            # Body is read (and cached) before the connection returns to the pool
+            content = await resp.read()
+        t1 = time.perf_counter()
+
+        logger.info(f"[{t1 - t0:.3f} s] {method} {url} status={resp.status} len={len(content)}")
+
+        return resp
+
+    async def req(self,
+                  method,
+                  url,
+                  params=None,
+                  data=None,
+                  headers=None,
+                  json=None,
+                  timeout=None) -> Optional[Union[dict, str]]:
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = self._client_timeout(timeout)
+
+        resp = await self._req(method, url, params=params, data=data, headers=headers, json=json, **kwargs)
+
+        result = None
+
+        if resp.status == 200:
+            text = await resp.text()
+            try:
+                result = json_loads(text)
+            except JSONDecodeError as e:
+                result = text
+        elif resp.status == 204:
+            result = ""
+        else:
+            logger.error(f"Request failed: {resp.status} {resp.reason}")
+
+        return result
+
+    async def download(self, filepath: str, dest: str,
+                       chunk_size: int = 16384,
+                       resume: bool = True,
+                       retries: int = 3,
+                       progress: ProgressCallback = None) -> bool:
+        # see Controller.download, the body is streamed to `dest + ".part"`
+        # inside the request context as _req() releases the response.
+        part = dest + ".part"
+        meta = part + ".meta"
+        url = self.url.sub(f"api/files/{filepath}")
+        session = self._get_session()
+
+        validator = read_validator(meta) if resume and os.path.exists(part) else None
+        # a partial file without validator cannot be trusted
+        offset = os.path.getsize(part) if validator is not None else 0
+        total = None
+        t0 = time.perf_counter()
+        received = 0
+
+        for attempt in range(retries + 1):
+            headers = {}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                if_range = validator.get("etag") or validator.get("last_modified")
+                if if_range:
+                    headers["If-Range"] = if_range
+            try:
+                async with session.request("GET", str(url), headers=headers) as resp:
+                    current = response_validator(resp)
+                    if resp.status in (206, 416) and offset and \
+                            not same_validator(validator, current):
+                        logger.warning(f"{filepath} changed since the partial download, restarting")
+                        offset = 0
+                        continue
+
+                    if resp.status == 416 and offset:
+                        # nothing left to download if the part file is complete
+                        m = re.match(r"bytes \*/(\d+)", resp.headers.get("Content-Range", ""))
+                        if m and int(m.group(1)) == offset == validator.get("size"):
+                            total = offset
+                            break
+                        offset = 0
+                        continue
+                    elif resp.status == 206:
+                        m = re.match(r"bytes (\d+)-\d+/(\d+|\*)", resp.headers.get("Content-Range", ""))
+                        if m is None or int(m.group(1)) != offset:
+                            logger.warning(f"Unexpected range for {filepath}, restarting")
+                            offset = 0
+                            continue
+                        total = int(m.group(2)) if m.group(2) != "*" else None
+                        if total != validator.get("size"):
+                            logger.warning(f"{filepath} size changed since the partial download, restarting")
+                            offset = 0
+                            continue
+                        mode = "ab"
+                    elif resp.status == 200:
+                        # range ignored or validator mismatch, full content
+                        offset = 0
+                        total = resp.content_length
+                        mode = "wb"
+                    else:
+                        logger.error(f"Failed to download {filepath} to {dest}: "
+                                     f"{resp.status} {resp.reason}")
+                        return False
+
+                    if mode == "wb":
+                        validator = dict(current, size=total)
+                        if resume:
+                            write_validator(meta, validator)
+
+                    with open(part, mode) as f:
+                        async for chunk in resp.content.iter_chunked(chunk_size):
+                            f.write(chunk)
+                            offset += len(chunk)
+                            received += len(chunk)
+                            if progress is not None:
+                                progress(offset, total, received / (time.perf_counter() - t0))
+
+                if total is None or offset == total:
+                    break
+                logger.warning(f"Download of {filepath} incomplete ({offset}/{total} B)")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Download of {filepath} interrupted at {offset} B: {e}")
+
+            if not resume:
+                offset = 0
+        else:
+            logger.error(f"Failed to download {filepath} to {dest} after {retries + 1} attempts")
+            return False
+
+        os.replace(part, dest)
+        if os.path.exists(meta):
+            os.remove(meta)
+
+        dt = time.perf_counter() - t0
+        logger.info(f"Downloaded {filepath} [{offset} B] to {dest} "
+                    f"({received / dt / 1024:.1f} KiB/s)")
+        return True
+
+    async def upload(self, source: Union[str, BinaryIO],
+                     filepath: str,
+                     chunked_encoding: bool = True,
+                     chunks_size: Optional[int] = None) -> aiohttp.ClientResponse:
+        rec_path = re.compile(
+            r"^(\.?/)?(?P<filepath>([a-zA-Z0-9_]+/)*[a-zA-Z0-9_\-\.]+)$")
+
+        m = rec_path.match(filepath)
+        if m is None:
+            raise ValueError(f"Invalid filepath: {filepath}")
+        else:
+            filepath = m.group("filepath")
+
+        if chunks_size is None:
+            chunks_size = self.get_chunks_size()
+
+        with map_file(source) as view:
+            size = len(view)
+            if chunked_encoding and chunks_size:
+                data = MakeAsyncChunks(view, chunks_size)
+            else:
+                data = view if size else b""
+
+            t0 = time.perf_counter()
+            try:
+                resp = await self._req(
+                    "POST",
+                    self.url.sub(f"api/files/{filepath}"),
+                    data=data,
+                )
+            finally:
+                if chunked_encoding and chunks_size:
+                    await data.aclose()
+            dt = time.perf_counter() - t0
+
+        logger.info(f"Uploaded {filepath} [{size} B] in {dt:.3f} s "
+                    f"({size / dt / 1024 if dt else 0.0:.1f} KiB/s)")
+
+        return resp
+
+    def get_chunks_size(self) -> int:
+        # chunks size tuned with Controller.tune_chunks_size() for this controller
+        return tuning.cache.get(self.host, self.port) or tuning.DEFAULT_CHUNKS_SIZE
+
+    async def get_dfu_status(self) -> DFUStatus:
+        resp = await self._req("GET", self.url.sub("api/dfu"))
+
+        if resp.status == 200:
+            return DFUStatus(**json_loads(await resp.text()))
+
+    async def get_info(self) -> Dict:
+        return await self.req("GET", self.url.sub("api/info"))
+
+    async def get_ha_stats(self) -> Dict:
+        return await self.req("GET", self.url.sub("api/ha/stats"))
+
+    async def get_devices_page(self, page: int = 0) -> List:
+        return await self.req("GET", self.url.sub(f"api/devices?page={page}"))
+
+    async def get_metrics(self) -> Optional[str]:
+        # raw text (never decoded as JSON), see caniot.metrics to parse it
+        resp = await self._req("GET", self.url.sub("metrics"))
+        if resp.status != 200:
+            logger.error(f"Request failed: {resp.status} {resp.reason}")
+            return None
+        return await resp.text()
+
+    async def get_room(self, room_id: int) -> dict:
+        return await self.req("GET", self.url.sub(f"api/room/{room_id}"))
+
+    async def _get_devices_page(self, page: int, retries: int) -> List:
+        # see Controller._get_devices_page
+        for attempt in range(retries + 1):
+            error = None
+            try:
+                devices = await self.get_devices_page(page)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                devices, error = None, e
+            if isinstance(devices, list):
+                return devices
+            logger.warning(f"Devices page {page} failed (attempt {attempt + 1}/{retries + 1})"
+                           + (f": {error}" if error is not None else ""))
+        raise DevicePageError(page) from error
+
+    async def iter_devices(self, prefetch: int = 1, retries: int = 2) -> AsyncIterator[dict]:
+        # Keeps up to `prefetch` page requests in flight, pages are yielded in
+        # order and iteration stops at the first empty page.
+        prefetch = max(prefetch, 1)
+        pending = deque(asyncio.ensure_future(self._get_devices_page(page, retries))
+                        for page in range(prefetch))
+        next_page = prefetch
+        try:
+            while pending:
+                to_append = await pending.popleft()
+                if not to_append:
+                    break
+
+                pending.append(asyncio.ensure_future(self._get_devices_page(next_page, retries)))
+                next_page += 1
+
+                for device in to_append:
+                    yield device
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_devices(self, prefetch: int = 1, retries: int = 2) -> List:
+        return [device async for device in self.iter_devices(prefetch, retries)]
+
+    async def send_can(self, arbitration_id: int, vals: Iterable[int] = None):
+        if vals is None:
+            vals = []
+        arr = list(vals)
+        assert len(arr) <= 8
+        assert all(map(lambda x: 0 <= x <= 255 and isinstance(x, int), arr))
+        url = self.url.sub("api/if/can/{arbitration_id:X}").project(arbitration_id=arbitration_id)
+        return await self.req("POST", url, json=arr)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        self._get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+class AsyncCaniotAPI(RestAPI):
+    def __init__(self, ctrl: AsyncController, max_inflight_per_device: int = 2):
+        super().__init__(ctrl)
+
+        # A CAN node can only serve a few requests at once
+        self.max_inflight_per_device = max_inflight_per_device
+        self._device_slots: Dict[int, asyncio.Semaphore] = {}
+
+        # Optional attribute read cache (see enable_cache())
+        self.cache: Optional[AttributeCache] = None
+
+    def enable_cache(self, maxsize: int = 1024, system_ttl: float = 1.0) -> AttributeCache:
+        self.cache = AttributeCache(maxsize=maxsize, system_ttl=system_ttl)
+        return self.cache
+
+    class Device:
+        def __init__(self, api: AsyncCaniotAPI, did: DeviceId):
+            self.api = api
+            self.did = did
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc_value, traceback):
+            pass
+
+        async def read_attribute(self, attr: Union[int, AttributeId], bypass_cache: bool = False) -> dict:
+            return await self.api.read_attribute(self.did, attr, bypass_cache)
+
+        async def read_attributes(self, attrs: Iterable[AttributeKey], bypass_cache: bool = False) -> AttributesBatch:
+            return await self.api.read_attributes(self.did, attrs, bypass_cache)
+
+        async def write_attributes(self, values: Dict[AttributeKey, int]) -> AttributesBatch:
+            return await self.api.write_attributes(self.did, values)
+
+        async def request_telemetry(self, ep: int):
+            return await self.api.request_telemetry(self.did, ep)
+
+        async def write_attribute(self, attr: Union[int, AttributeId], value: int):
+            return await self.api.write_attribute(self.did, attr, value)
+
+        async def command(self, ep: int, data: Iterable[int]):
+            return await self.api.command(self.did, ep, data)
+
+        async def command_cls1(self, vals: Iterable[str]):
+            return await self.api.command_cls1(self.did, vals)
+
+        async def reboot(self):
+            return await self.api.reboot(self.did)
+
+        async def factory_reset(self):
+            return await self.api.factory_reset(self.did)
+
+    def open_device(self, did: DeviceId) -> AsyncCaniotAPI.Device:
+        return AsyncCaniotAPI.Device(self, did)
+
+    async def request_telemetry(self, did: Union[DeviceId, int], ep: int):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/{ep}/telemetry").project(**{
+            "did": int(did),
+            "ep": ep
+        })
+        return await self.ctrl.req("GET", url, headers=self.app_timeout_header)
+
+    async def command(self, did: Union[DeviceId, int], ep: int, vals: Iterable[int]):
+        if vals is None:
+            vals = []
+        arr = list(vals)
+        assert len(arr) <= 8
+        assert all(map(lambda x: 0 <= x <= 255 and isinstance(x, int), arr))
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/{ep}/command").project(**{
+            "did": int(did),
+            "ep": ep,
+        })
+        return await self.ctrl.req("POST", url, json=arr, headers=self.app_timeout_header)
+
+    async def command_cls1(self, did: Union[DeviceId, int], vals: Iterable[str]):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/blc1/command").project(**{
+            "did": int(did),
+            "ep": Endpoint.BoardLevelControl,
+        })
+        return await self.ctrl.req("POST", url, json=list(vals), headers=self.app_timeout_header)
+
+    async def read_attribute(self, did: Union[DeviceId, int], attr: Union[int, AttributeId],
+                             bypass_cache: bool = False) -> dict:
+        cache = self.cache
+        if cache is not None and not bypass_cache:
+            hit, res = cache.get(did, attr)
+            if hit:
+                return dict(res)
+
+        # a write completing before the response invalidates this read
+        generation = cache.generation(did, attr) if cache is not None else None
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/attribute/{attr:x}").project(**{
+            "did": int(did),
+            "attr": int(attr)
+        })
+        res = await self.ctrl.req("GET", url, headers=self.app_timeout_header)
+
+        if cache is not None and isinstance(res, dict):
+            cache.put(did, attr, dict(res), generation)
+
+        return res
+
+    async def write_attribute(self, did: Union[DeviceId, int], attr: Union[int, AttributeId], value: Union[int, bytes]):
+        # see CaniotAPI.write_attribute
+        if self.cache is not None:
+            self.cache.invalidate(did, attr)
+
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/attribute/{attr:x}").project(**{
+            "did": int(did),
+            "attr": int(attr)
+        })
+        try:
+            return await self.ctrl.req("PUT", url, json={"value": str(hex(value))},
+                                       headers=self.app_timeout_header)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(did, attr)
+
+    def _get_device_slots(self, did: Union[DeviceId, int]) -> asyncio.Semaphore:
+        slots = self._device_slots.get(int(did))
+        if slots is None:
+            slots = asyncio.Semaphore(self.max_inflight_per_device)
+            self._device_slots[int(did)] = slots
+        return slots
+
+    async def _attributes_batch(self, did: Union[DeviceId, int], items: Iterable[AttributeKey],
+                                operation) -> AttributesBatch:
+        batch = AttributesBatch()
+        slots = self._get_device_slots(did)
+
+        async def run(item: AttributeKey):
+            key = resolve_key(item)
+            async with slots:
+                res = await operation(key, item)
+            if not isinstance(res, dict):
+                raise AttributeRequestError(did, key)
+            return res.get("value")
+
+        items = list(items)
+        results = await asyncio.gather(*[run(item) for item in items], return_exceptions=True)
+        for item, res in zip(items, results):
+            if isinstance(res, Exception):
+                logger.error(f"Attribute {item} of device {int(did)} failed: {res}")
+                batch.errors[item] = res
+            else:
+                batch[item] = res
+
+        return batch
+
+    async def read_attributes(self, did: Union[DeviceId, int], attrs: Iterable[AttributeKey],
+                              bypass_cache: bool = False) -> AttributesBatch:
+        return await self._attributes_batch(
+            did, attrs, lambda key, item: self.read_attribute(did, key, bypass_cache))
+
+    async def write_attributes(self, did: Union[DeviceId, int], values: Dict[AttributeKey, int]) -> AttributesBatch:
+        return await self._attributes_batch(
+            did, values, lambda key, item: self.write_attribute(did, key, values[item]))
+
+    async def factory_reset(self, did: Union[DeviceId, int]):
+        if self.cache is not None:
+            self.cache.invalidate(did)
+
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/factory_reset").project(**{
+            "did": int(did),
+        })
+        return await self.ctrl.req("POST", url, headers=self.app_timeout_header)
+
+    async def reboot(self, did: Union[DeviceId, int]):
+        if self.cache is not None:
+            self.cache.invalidate(did)
+
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/reboot").project(**{
+            "did": int(did),
+        })
+        return await self.ctrl.req("POST", url, headers=self.app_timeout_header)
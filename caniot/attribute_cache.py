@@ -0,0 +1,140 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from __future__ import annotations
+
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple, Union
+
+from .caniot import DeviceId
+from .caniot_attributes import AttributeId, get_by_key
+
+# Attribute key sections
+SECTION_IDENTIFICATION = 0x0
+SECTION_SYSTEM = 0x1
+SECTION_CONFIG = 0x2
+
+
+class AttributeCache:
+    # Read cache for attribute values, keyed by (device id, attribute key):
+    # - identification attributes (readonly) are cached for the whole session,
+    # - config attributes are cached until written (see invalidate()),
+    # - system attributes (counters, time, ...) are cached for `system_ttl` seconds.
+    #
+    # A read captures generation() before sending its request and passes it to
+    # put(): a value read before an invalidation is not cached.
+    def __init__(self, maxsize: int = 1024, system_ttl: float = 1.0) -> None:
+        self.maxsize = maxsize
+        self.system_ttl = system_ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: OrderedDict[Tuple[int, int], Tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        # invalidation counters of (device, attribute base key), of devices
+        # and of the whole cache (clear())
+        self._generations: Dict[Tuple[int, int], int] = {}
+        self._device_generations: Dict[int, int] = {}
+        self._generation = 0
+
+    def ttl(self, key: Union[int, AttributeId]) -> Optional[float]:
+        # None if the attribute should not be cached
+        attr = get_by_key(int(key))
+        if attr is None:
+            return None
+
+        section = (int(key) >> 12) & 0xF
+        if section == SECTION_IDENTIFICATION and attr.readonly:
+            return math.inf
+        elif section == SECTION_SYSTEM:
+            return self.system_ttl
+        elif section == SECTION_CONFIG:
+            return math.inf
+        else:
+            return None
+
+    def get(self, did: Union[DeviceId, int], key: Union[int, AttributeId]) -> Tuple[bool, Any]:
+        entry_key = (int(did), int(key))
+
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None:
+                expires, value = entry
+                if time.monotonic() < expires:
+                    self._entries.move_to_end(entry_key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[entry_key]
+
+            self.misses += 1
+            return False, None
+
+    def generation(self, did: Union[DeviceId, int], key: Union[int, AttributeId]) -> Tuple[int, int, int]:
+        did = int(did)
+        return (self._generation,
+                self._device_generations.get(did, 0),
+                self._generations.get((did, int(key) & 0xFFF0), 0))
+
+    def put(self, did: Union[DeviceId, int], key: Union[int, AttributeId], value: Any,
+            generation: Tuple[int, int, int] = None) -> bool:
+        # `generation` is the one captured before the value was requested
+        ttl = self.ttl(key)
+        if ttl is None or ttl <= 0:
+            return False
+
+        entry_key = (int(did), int(key))
+
+        with self._lock:
+            if generation is not None and generation != self.generation(did, key):
+                # invalidated while the value was requested
+                return False
+
+            self._entries[entry_key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(entry_key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+        return True
+
+    def invalidate(self, did: Union[DeviceId, int], key: Union[int, AttributeId] = None):
+        # Invalidate all parts of the attribute `key`, or everything cached for `did`
+        did = int(did)
+
+        with self._lock:
+            if key is None:
+                self._device_generations[did] = self._device_generations.get(did, 0) + 1
+                stale = [k for k in self._entries if k[0] == did]
+            else:
+                base = int(key) & 0xFFF0
+                self._generations[(did, base)] = self._generations.get((did, base), 0) + 1
+                stale = [(did, base | part) for part in range(16)]
+
+            for entry_key in stale:
+                self._entries.pop(entry_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return f"AttributeCache(entries={len(self)}/{self.maxsize} hits={self.hits} " \
+               f"misses={self.misses} evictions={self.evictions})"
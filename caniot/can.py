@@ -0,0 +1,165 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Raw CAN buses: Linux SocketCAN interfaces and an in-process virtual bus.
+
+from __future__ import annotations
+
+import socket
+import struct
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, List, NamedTuple
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CanFrame(NamedTuple):
+    arbitration_id: int
+    data: bytes = b""
+    is_extended: bool = False
+
+
+FrameListener = Callable[[CanFrame], None]
+
+
+class CanBus(ABC):
+    def __init__(self) -> None:
+        self._listeners: List[FrameListener] = []
+        self._listeners_lock = threading.Lock()
+
+    @abstractmethod
+    def send(self, frame: CanFrame):
+        pass
+
+    def add_listener(self, listener: FrameListener):
+        with self._listeners_lock:
+            self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener: FrameListener):
+        with self._listeners_lock:
+            self._listeners = [l for l in self._listeners if l is not listener]
+
+    def _dispatch(self, frame: CanFrame):
+        # listeners list is replaced (never mutated) so no lock is needed here
+        for listener in self._listeners:
+            try:
+                listener(frame)
+            except Exception as e:
+                logger.exception(f"CAN listener failed on frame 0x{frame.arbitration_id:X}: {e}")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class VirtualCanBus:
+    # In-process CAN bus, frames sent on an interface are delivered
+    # (synchronously, in the sender thread) to all other interfaces.
+    def __init__(self) -> None:
+        self._interfaces: List[VirtualCanInterface] = []
+        self._lock = threading.Lock()
+
+        self.frames = 0
+
+    def connect(self) -> VirtualCanInterface:
+        interface = VirtualCanInterface(self)
+        with self._lock:
+            self._interfaces = self._interfaces + [interface]
+        return interface
+
+    def disconnect(self, interface: VirtualCanInterface):
+        with self._lock:
+            self._interfaces = [i for i in self._interfaces if i is not interface]
+
+    def _transmit(self, frame: CanFrame, sender: VirtualCanInterface):
+        self.frames += 1
+        for interface in self._interfaces:
+            if interface is not sender:
+                interface._dispatch(frame)
+
+
+class VirtualCanInterface(CanBus):
+    def __init__(self, bus: VirtualCanBus) -> None:
+        super().__init__()
+        self.bus = bus
+
+    def send(self, frame: CanFrame):
+        assert len(frame.data) <= 8
+        self.bus._transmit(frame, self)
+
+    def close(self):
+        self.bus.disconnect(self)
+
+
+# struct can_frame (linux/can.h)
+CAN_FRAME_FMT = "=IB3x8s"
+CAN_FRAME_SIZE = struct.calcsize(CAN_FRAME_FMT)
+
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1FFFFFFF
+CAN_SFF_MASK = 0x000007FF
+
+
+class SocketCanBus(CanBus):
+    # Linux SocketCAN raw interface (e.g. "can0", "vcan0"),
+    # received frames are dispatched from a reader thread.
+    def __init__(self, channel: str = "can0") -> None:
+        super().__init__()
+        self.channel = channel
+
+        self.sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        self.sock.bind((channel,))
+
+        self._stop = threading.Event()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True,
+                                        name=f"socketcan-{channel}")
+        self._reader.start()
+
+    def send(self, frame: CanFrame):
+        can_id = frame.arbitration_id
+        if frame.is_extended:
+            can_id = (can_id & CAN_EFF_MASK) | CAN_EFF_FLAG
+        else:
+            can_id &= CAN_SFF_MASK
+
+        data = bytes(frame.data)
+        assert len(data) <= 8
+        self.sock.send(struct.pack(CAN_FRAME_FMT, can_id, len(data), data.ljust(8, b"\x00")))
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            try:
+                raw = self.sock.recv(CAN_FRAME_SIZE)
+            except OSError:
+                break
+
+            can_id, length, data = struct.unpack(CAN_FRAME_FMT, raw)
+            if can_id & (CAN_RTR_FLAG | CAN_ERR_FLAG):
+                continue
+
+            if can_id & CAN_EFF_FLAG:
+                frame = CanFrame(can_id & CAN_EFF_MASK, data[:length], True)
+            else:
+                frame = CanFrame(can_id & CAN_SFF_MASK, data[:length], False)
+
+            self._dispatch(frame)
+
+    def close(self):
+        self._stop.set()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -6,34 +6,57 @@
 
 from __future__ import annotations
 
-from enum import Enum, IntEnum
-from dataclasses import dataclass
+from enum import Enum, IntEnum, IntFlag
+from dataclasses import FrozenInstanceError
+from functools import lru_cache
 
 from typing import Union, List, Dict, Tuple
 
-@dataclass
 class DeviceId:
+    # Immutable, hashes like its integer encoding so a DeviceId and the
+    # corresponding int are interchangeable as dict/set keys.
+    __slots__ = ("cls", "sid")
+
+    # Interned instances for all 64 device ids, see from_int()
+    _table: Tuple[DeviceId, ...] = None
+
     def __init__(self, cls: int, sid: int):
-        self.cls = cls & 0x7
-        self.sid = sid & 0x7
+        object.__setattr__(self, "cls", cls & 0x7)
+        object.__setattr__(self, "sid", sid & 0x7)
 
     @classmethod
     def from_int(cls, deviceid: int) -> DeviceId:
-        return DeviceId(
-            cls=int(deviceid) & 7,
-            sid=int(deviceid) >> 3
-        )
+        return DeviceId._table[int(deviceid) & 0x3F]
 
     def get_id(self) -> int:
         return (self.sid << 3) | self.cls
 
     id = property(get_id)
 
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+    def __reduce__(self):
+        return (DeviceId, (self.cls, self.sid))
+
     def __eq__(self, other: Union[int, DeviceId]):
-        return int(other) == int(self)
+        if self is other:
+            return True
+        if not isinstance(other, (int, DeviceId)):
+            return NotImplemented
+        return int(other) == (self.sid << 3) | self.cls
+
+    def __hash__(self):
+        return hash((self.sid << 3) | self.cls)
 
     def __int__(self):
-        return self.get_id()
+        return (self.sid << 3) | self.cls
+
+    def __index__(self):
+        return (self.sid << 3) | self.cls
 
     def is_broadcast(self) -> bool:
         return self.sid == 0x7 and self.cls == 0x7
@@ -46,7 +69,9 @@ class DeviceId:
 
     @classmethod
     def Broadcast(cls) -> DeviceId:
-        return DeviceId(cls=0b111, sid=0b111)
+        return DeviceId._table[0x3F]
+
+DeviceId._table = tuple(DeviceId(cls=value & 0x7, sid=value >> 3) for value in range(0x40))
 
 class IdType(IntEnum):
     Standard = 11
@@ -71,54 +96,147 @@ class Endpoint(IntEnum):
     def join(self, controller: Endpoint):
         return self | controller
 
-@dataclass
-class MsgId:
-    frame_type: FrameType
-    query_type: QueryType
-    device_id: DeviceId
-    endpoint: Endpoint = Endpoint.ApplicationMain
-
-    extended_id: int = 0
+# Command of a class 1 output (xps), 3 bits each in a board level command
+class XPS(IntEnum):
+    NONE = 0
+    SET_ON = 1
+    SET_OFF = 2
+    TOGGLE = 3
+    RESET = 4
+    PULSE_ON = 5
+    PULSE_OFF = 6
+    PULSE_CANCEL = 7
+
+# System command, last byte of a board level control command
+class SysCommand(IntFlag):
+    NONE = 0
+    HardwareReset = 1 << 0
+    SoftwareReset = 1 << 1
+    WatchdogReset = 1 << 2
+    ConfigReset = 1 << 5
+
+def blc_command(xps: List[Union[XPS, str, int]] = (), sys: SysCommand = SysCommand.NONE) -> bytes:
+    # Board level control command payload: outputs packed in the first 7 bytes
+    # (class 1 xps, names as accepted by the controller API e.g. "set_on"),
+    # system command in the last one. No output command is all zeroes, for
+    # every class.
+    bits = 0
+    for i, cmd in enumerate(xps):
+        if isinstance(cmd, str):
+            cmd = XPS[cmd.upper()]
+        bits |= (XPS(cmd) & 0b111) << (3 * i)
+    if bits >> 56:
+        raise ValueError(f"Output commands do not fit in 7 bytes: {len(xps)} outputs")
+    return bits.to_bytes(7, "little") + bytes([int(sys)])
+
+# Response frame type expected for each query frame type
+_RESPONSE_FRAME_TYPE = (
+    FrameType.Telemetry,  # Command
+    FrameType.Telemetry,  # Telemetry
+    FrameType.ReadAttribute,  # WriteAttribute
+    FrameType.ReadAttribute,  # ReadAttribute
+)
+
+def response_id(query_id: int) -> int:
+    # Arbitration id of the response to the query `query_id`
+    return (query_id & ~0b111) | QueryType.Response << 2 | _RESPONSE_FRAME_TYPE[query_id & 0b11]
 
-    id_type: IdType = IdType.Standard
+class MsgId:
+    # Immutable, use replace() to derive a new identifier
+    __slots__ = ("frame_type", "query_type", "device_id", "endpoint",
+                 "extended_id", "id_type", "_id", "_valid", "_repr")
+
+    # Decoded identifiers for all standard (11 bits) ids, built on first use
+    _std_table: Tuple[MsgId, ...] = None
+
+    def __init__(self,
+                 frame_type: FrameType,
+                 query_type: QueryType,
+                 device_id: DeviceId,
+                 endpoint: Endpoint = Endpoint.ApplicationMain,
+                 extended_id: int = 0,
+                 id_type: IdType = IdType.Standard):
+        _set = object.__setattr__
+        _set(self, "frame_type", frame_type)
+        _set(self, "query_type", query_type)
+        _set(self, "device_id", device_id)
+        _set(self, "endpoint", endpoint)
+        _set(self, "extended_id", extended_id)
+        _set(self, "id_type", id_type)
+
+        did = device_id.get_id()
+        std_id = frame_type | query_type << 2 | did << 3 | endpoint << 9
+        _set(self, "_id", std_id | extended_id << 11 if id_type is IdType.Extended else std_id)
+
+        is_error = frame_type == FrameType.Command and query_type == QueryType.Response
+        _set(self, "_valid", did != 0 and not is_error and
+             (query_type == QueryType.Query or did != 0x3F)) # cannot be a response from all nodes
+        _set(self, "_repr", None)
+
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field '{name}'")
+
+    def __delattr__(self, name):
+        raise FrozenInstanceError(f"cannot delete field '{name}'")
+
+    def __reduce__(self):
+        return (MsgId, (self.frame_type, self.query_type, self.device_id,
+                        self.endpoint, self.extended_id, self.id_type))
+
+    def replace(self, **changes) -> MsgId:
+        fields = {
+            "frame_type": self.frame_type,
+            "query_type": self.query_type,
+            "device_id": self.device_id,
+            "endpoint": self.endpoint,
+            "extended_id": self.extended_id,
+            "id_type": self.id_type,
+        }
+        fields.update(changes)
+        return MsgId(**fields)
 
     def __eq__(self, other: Union[int, MsgId]):
-        return int(self) == int(other)
+        if self is other:
+            return True
+        if not isinstance(other, (int, MsgId)):
+            return NotImplemented
+        return self._id == int(other)
+
+    def __hash__(self):
+        return hash(self._id)
 
     def __str__(self):
         return self.__repr__()
 
     def __repr__(self):
-        if self.is_valid():
-            return f"[{hex(self)}] " \
-                   f"{QueryType(self.query_type).name} " \
-                   f"{FrameType(self.frame_type).name} " \
-                   f"{Endpoint(self.endpoint).name} " \
-                   f"{self.device_id}"
-        elif self.is_error():
-            return f"[{hex(self)}] ERROR message from {self.device_id}"
-        else:
-            return f"INVALID CANIOT MESSAGE [0x{int(self):04X}]"
+        if self._repr is None:
+            if self.is_valid():
+                r = f"[{hex(self)}] " \
+                    f"{QueryType(self.query_type).name} " \
+                    f"{FrameType(self.frame_type).name} " \
+                    f"{Endpoint(self.endpoint).name} " \
+                    f"{self.device_id}"
+            elif self.is_error():
+                r = f"[{hex(self)}] ERROR message from {self.device_id}"
+            else:
+                r = f"INVALID CANIOT MESSAGE [0x{int(self):04X}]"
+            object.__setattr__(self, "_repr", r)
+        return self._repr
 
     def __int__(self) -> int:
-        return self.get()
+        return self._id
 
     def __index__(self):
-        return int(self)
+        return self._id
 
     def __and__(self, other: MsgId):
         return int(self) & int(other)
 
     def get(self) -> int:
-        std_id = self.frame_type | self.query_type << 2 | self.device_id.get_id() << 3 | self.endpoint << 9
-
-        if self.id_type is IdType.Extended:
-            return std_id | self.extended_id << 11
-        else:
-            return std_id
+        return self._id
 
     @staticmethod
-    def from_int(value: int, extended: bool = None) -> MsgId:
+    def _decode(value: int, extended: bool = None) -> MsgId:
         return MsgId(
             frame_type=FrameType(value & 0b11),
             query_type=QueryType((value >> 2) & 1),
@@ -128,6 +246,27 @@ class MsgId:
             id_type=IdType.Extended if value >> 11 and extended is not False else IdType.Standard
         )
 
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _decode_extended(value: int) -> MsgId:
+        return MsgId._decode(value)
+
+    @classmethod
+    def _build_std_table(cls) -> Tuple[MsgId, ...]:
+        cls._std_table = tuple(cls._decode(value) for value in range(0x800))
+        return cls._std_table
+
+    @staticmethod
+    def from_int(value: int, extended: bool = None) -> MsgId:
+        value = int(value)
+
+        # extended bits are ignored for standard ids
+        if value < 0x800 or extended is False:
+            table = MsgId._std_table or MsgId._build_std_table()
+            return table[value & 0x7FF]
+
+        return MsgId._decode_extended(value)
+
     def bin_repr(self) -> str:
         return bin(int(self))[2:].rjust(self.id_type, "0")
 
@@ -135,49 +274,44 @@ class MsgId:
         return self.frame_type == FrameType.Command and self.query_type == QueryType.Response
 
     def is_valid(self) -> bool:
-        return self.device_id != 0 and not self.is_error() and \
-               (self.query_type == QueryType.Query or not self.is_broadcast_device()) # cannot be a response from all nodes
+        return self._valid
 
     def is_query(self) -> bool:
-        return self.is_valid() and self.query_type is QueryType.Query
+        return self._valid and self.query_type is QueryType.Query
 
     def is_broadcast_device(self) -> bool:
-        return self.device_id == DeviceId.Broadcast()
+        return (self._id >> 3) & 0x3F == 0x3F
 
     def is_response(self) -> bool:
-        return self.is_valid() and self.query_type is QueryType.Response
+        return self._valid and self.query_type is QueryType.Response
 
     def prepare_response(self) -> MsgId:
         if self.is_query():
-            if self.frame_type == FrameType.Command:
-                resp_type = FrameType.Telemetry
-            elif self.frame_type == FrameType.WriteAttribute:
-                resp_type = FrameType.ReadAttribute
+            if self.id_type is IdType.Extended:
+                return self.replace(
+                    frame_type=_RESPONSE_FRAME_TYPE[self.frame_type],
+                    query_type=QueryType.Response,
+                )
             else:
-                resp_type = self.frame_type
-
-            return MsgId(
-                frame_type=resp_type,
-                query_type=QueryType.Response,
-                endpoint=self.endpoint,
-                device_id=self.device_id,
-                id_type=self.id_type,
-                extended_id=self.extended_id if self.id_type is IdType.Extended else 0
-            )
+                return MsgId.from_int(response_id(self._id), extended=False)
         else:
             raise Exception(f"{self} MsgID is not a query")
 
     def is_response_of(self, query: MsgId) -> bool:
         if self.is_valid():
-            expected_response = query.prepare_response()
+            if not query.is_query():
+                raise Exception(f"{query} MsgID is not a query")
+
+            expected_response = response_id(query._id)
 
             # handle the case when a message is a response for a broadcast message
             if query.is_broadcast_device():
 
                 # we expect a response to a broadcast query
-                expected_response.device_id = self.device_id
+                mask = ~(0x3F << 3)
+                return expected_response & mask == self._id & mask
 
-            return expected_response == self
+            return expected_response == self._id
         else:
             raise Exception(f"{query} is not a valid Query")
 
@@ -1,7 +1,7 @@
 import datetime
 import struct
 import time
-from typing import Union
+from typing import Dict, Iterable, List, Union
 
 from enum import IntEnum
 
@@ -108,14 +108,12 @@ class Attribute:
         return Attribute.default_interpret(val, key)
 
     def __contains__(self, key: Union[Key, int]):
-        if isinstance(key, int):
-            key = Key(key)
+        if isinstance(key, Key):
+            key = key.key
 
-        my = Key(self.key)
-
-        return my.section == key.section and \
-            my.attr == key.attr and \
-            key.part <= self.size // 4
+        # same section and attribute, valid part
+        return (self.key & 0xFFF0) == (key & 0xFFF0) and \
+            (key & 0xF) <= self.size // 4
 
 
 class AttrNodeID(Attribute):
@@ -271,18 +269,55 @@ attributes = [
 ]
 
 
-def get_by_key(key: int) -> Attribute:
-    key = Key(key)
+class AttributeIndex:
+    # Lookup tables over an attributes list, rebuilt whenever the list grows
+    # or shrinks (call rebuild() after replacing entries in place).
+    def __init__(self, attributes: List[Attribute]):
+        self.attributes = attributes
+
+        self._size = -1
+        self._by_key: Dict[int, List[Attribute]] = {}
+        self._by_name: Dict[str, Attribute] = {}
+
+    def rebuild(self):
+        by_key = {}
+        by_name = {}
+
+        # keep the first definition in list order, as a linear scan would
+        for attr in self.attributes:
+            by_key.setdefault(attr.key & 0xFFF0, []).append(attr)
+            by_name.setdefault(attr.name, attr)
+
+        self._by_key = by_key
+        self._by_name = by_name
+        self._size = len(self.attributes)
+
+    def _check(self):
+        if len(self.attributes) != self._size:
+            self.rebuild()
+
+    def get_by_key(self, key: int) -> Attribute:
+        self._check()
+
+        for attr in self._by_key.get(key & 0xFFF0, ()):
+            if (key & 0xF) <= attr.size // 4:
+                return attr
 
-    for attr in attributes:
-        if key in attr:
-            return attr
+    def get(self, name: str) -> Attribute:
+        self._check()
+
+        return self._by_name.get(name)
+
+
+index = AttributeIndex(attributes)
+
+
+def get_by_key(key: int) -> Attribute:
+    return index.get_by_key(int(key))
 
 
 def get(name: str) -> Attribute:
-    for attr in attributes:
-        if attr.name == name:
-            return attr
+    return index.get(name)
 
 
 def interpret(key: int, val: int) -> str:
@@ -292,3 +327,27 @@ def interpret(key: int, val: int) -> str:
         return attr.interpret(val, key)
     else:
         return Attribute.default_interpret(val, key)
+
+
+def interpret_many(keys: Iterable[int], values: Iterable[int]) -> List[str]:
+    lookup = index.get_by_key
+
+    results = []
+    for key, val in zip(keys, values):
+        key = int(key)
+        attr = lookup(key)
+        if attr:
+            results.append(attr.interpret(val, key))
+        else:
+            results.append(Attribute.default_interpret(val, key))
+    return results
+
+
+def resolve_key(attr: Union[int, str, AttributeId]) -> int:
+    if isinstance(attr, str):
+        found = get(attr)
+        if found is not None:
+            return found.key
+        # AttributeId member name (e.g. "CfgTelemetryPeriodMs"), raises KeyError
+        return AttributeId[attr]
+    return int(attr)
@@ -11,19 +11,31 @@ from json.decoder import JSONDecodeError
 from dataclasses import dataclass
 
 import requests
+from requests.adapters import HTTPAdapter
+import os
 import ssl
 import struct
+import threading
 import time
 import re
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from .caniot import DeviceId, Endpoint
-from .caniot_attributes import AttributeId
+from .caniot_attributes import AttributeId, resolve_key
+from .attribute_cache import AttributeCache
+from .transport import CaniotTransport
+from .fssync import SyncResult, sync_dir
+from . import tuning
+from .dfu import DFUPipeline, DFUReport
+from .metrics import MetricsParser, Sample, iter_metrics
 
 from abc import ABC, abstractmethod
 
-from typing import Dict, List, Union, Iterable, Optional
+from typing import BinaryIO, Callable, Dict, List, Union, Iterable, Iterator, Optional
 
-from .utils import MakeChunks
+from .utils import MakeTransientChunks, map_file, read_validator, response_validator, same_validator, write_validator
 
 from .url import URL
 
@@ -31,6 +43,9 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# progress(bytes done, total bytes or None, throughput in B/s)
+ProgressCallback = Optional[Callable[[int, Optional[int], float], None]]
+
 @dataclass    
 class DFUStatus:
     mcuboot_version: int
@@ -43,9 +58,44 @@ class DFUStatus:
     def __repr__(self) -> str:
         return f"DFU: Firmware Version {self.version_major}.{self.version_minor}.{self.version_revision}+{self.version_build} size={self.image_size} B (mcuboot version={self.mcuboot_version})"
 
+AttributeKey = Union[int, str, AttributeId]
+
+class AttributeRequestError(Exception):
+    def __init__(self, did: Union[DeviceId, int], key: int, reason: str = "request failed"):
+        super().__init__(f"Attribute 0x{key:04X} of device {int(did)}: {reason}")
+        self.did = did
+        self.key = key
+
+class DevicePageError(Exception):
+    def __init__(self, page: int, reason: str = "request failed"):
+        super().__init__(f"Devices page {page}: {reason}")
+        self.page = page
+
+# key -> value mapping of a batch of attribute operations,
+# keys which failed are reported in `errors` instead.
+class AttributesBatch(dict):
+    def __init__(self):
+        super().__init__()
+        self.errors: Dict[AttributeKey, Exception] = {}
+
+    def ok(self) -> bool:
+        return not self.errors
+
+class TLSAdapter(HTTPAdapter):
+    def __init__(self, ssl_context: ssl.SSLContext = None, **kwargs):
+        # must be set before HTTPAdapter.__init__() calls init_poolmanager()
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
 class Controller:
     def __init__(self, host: str = "192.0.2.1", port: int = None, secure: bool = False, 
-                 cert: str = None, key: str = None, verify: str = None) -> None:
+                 cert: str = None, key: str = None, verify: str = None,
+                 pool_size: int = 4) -> None:
 
         self.host = host
 
@@ -59,12 +109,21 @@ class Controller:
         self.key = key
         self.verify = verify
 
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.check_hostname = False
-        ssl_context.load_default_certs()
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+        self.ssl_context.check_hostname = False
+        self.ssl_context.load_default_certs()
+        if cert:
+            self.ssl_context.load_cert_chain(cert, key)
+
+        # Maximum number of connections kept alive to the controller,
+        # requests block until a connection is available.
+        self.pool_size = pool_size
 
-        self.session = None
+        # Connection pool shared by the per-thread sessions
+        self._adapter: Optional[TLSAdapter] = None
+        self._adapter_lock = threading.Lock()
+        self._local = threading.local()
 
         # HTTP Timeout
         self.timeout = 5.0
@@ -81,20 +140,56 @@ class Controller:
 
         self.caniot: CaniotAPI = CaniotAPI(self)
     
+    def _get_adapter(self) -> TLSAdapter:
+        with self._adapter_lock:
+            if self._adapter is None:
+                self._adapter = TLSAdapter(
+                    ssl_context=self.ssl_context,
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    pool_block=True,
+                )
+            return self._adapter
+
+    def _make_session(self) -> requests.Session:
+        session = requests.Session()
+
+        adapter = self._get_adapter()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        session.headers.update(self.default_headers)
+        session.verify = self.verify if self.verify else self.default_req["verify"]
+
+        return session
+
+    # requests.Session is not thread-safe, each thread gets its own session
+    # but all of them share the same (thread-safe) connection pool.
+    @property
+    def session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None or session.adapters.get("http://") is not self._adapter:
+            session = self._make_session()
+            self._local.session = session
+        return session
+
     def is_http_session(self) -> bool:
-        return self.session is not None
+        return self._adapter is not None
 
     def _req(self,
              method,
              url, 
              **kwargs) -> requests.Response:
-        request_method = self.session.request if self.session else requests.request
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
 
         t0 = time.perf_counter()
-        resp = request_method(method, url, **kwargs)
+        resp = self.session.request(method, str(url), **kwargs)
         t1 = time.perf_counter()
 
-        logger.info(f"[{t1 - t0:.3f} s] {method} {url} status={resp.status_code} len={len(resp.content)}")
+        # don't consume streamed bodies
+        length = resp.headers.get("Content-Length") if kwargs.get("stream") else len(resp.content)
+        logger.info(f"[{t1 - t0:.3f} s] {method} {url} status={resp.status_code} len={length}")
 
         return resp
 
@@ -132,24 +227,116 @@ class Controller:
 
         return result
 
-    def download(self, filepath: str, dest: str) -> bool:
-        resp = self._req("GET", self.url.sub(f"api/files/{filepath}"))
-
-        if resp.status_code == 200:
-            with open(dest, "wb") as f:
-                content = resp.content
-                size = len(content)
-                f.write(content)
-                logger.info(f"Downloaded {filepath} [{size} B] to {dest}")
-                return True
+    def download(self, filepath: str, dest: str,
+                 chunk_size: int = 16384,
+                 resume: bool = True,
+                 retries: int = 3,
+                 progress: ProgressCallback = None) -> bool:
+        # Streams the file to `dest + ".part"`, renamed to `dest` once complete.
+        # An interrupted transfer is resumed from the last byte written (Range
+        # request) if the server supports it, including from a previous call.
+        # The validator of the partial content (ETag or Last-Modified, and
+        # size) is kept in `dest + ".part.meta"` and sent as If-Range, so that
+        # a file changed in the meantime is downloaded again from the start.
+        part = dest + ".part"
+        meta = part + ".meta"
+        url = self.url.sub(f"api/files/{filepath}")
+
+        validator = read_validator(meta) if resume and os.path.exists(part) else None
+        # a partial file without validator cannot be trusted
+        offset = os.path.getsize(part) if validator is not None else 0
+        total = None
+        t0 = time.perf_counter()
+        received = 0
+
+        for attempt in range(retries + 1):
+            headers = {}
+            if offset:
+                headers["Range"] = f"bytes={offset}-"
+                if_range = validator.get("etag") or validator.get("last_modified")
+                if if_range:
+                    headers["If-Range"] = if_range
+            try:
+                resp = self._req("GET", url, stream=True, headers=headers)
+                with resp:
+                    current = response_validator(resp)
+                    if resp.status_code in (206, 416) and offset and \
+                            not same_validator(validator, current):
+                        logger.warning(f"{filepath} changed since the partial download, restarting")
+                        offset = 0
+                        continue
+
+                    if resp.status_code == 416 and offset:
+                        # nothing left to download if the part file is complete
+                        m = re.match(r"bytes \*/(\d+)", resp.headers.get("Content-Range", ""))
+                        if m and int(m.group(1)) == offset == validator.get("size"):
+                            total = offset
+                            break
+                        offset = 0
+                        continue
+                    elif resp.status_code == 206:
+                        m = re.match(r"bytes (\d+)-\d+/(\d+|\*)", resp.headers.get("Content-Range", ""))
+                        if m is None or int(m.group(1)) != offset:
+                            logger.warning(f"Unexpected range for {filepath}, restarting")
+                            offset = 0
+                            continue
+                        total = int(m.group(2)) if m.group(2) != "*" else None
+                        if total != validator.get("size"):
+                            logger.warning(f"{filepath} size changed since the partial download, restarting")
+                            offset = 0
+                            continue
+                        mode = "ab"
+                    elif resp.status_code == 200:
+                        # range ignored or validator mismatch, full content
+                        offset = 0
+                        length = resp.headers.get("Content-Length")
+                        total = int(length) if length is not None else None
+                        mode = "wb"
+                    else:
+                        logger.error(f"Failed to download {filepath} to {dest}: "
+                                     f"{resp.status_code} {resp.reason}")
+                        return False
+
+                    if mode == "wb":
+                        validator = dict(current, size=total)
+                        if resume:
+                            write_validator(meta, validator)
+
+                    with open(part, mode) as f:
+                        for chunk in resp.iter_content(chunk_size):
+                            f.write(chunk)
+                            offset += len(chunk)
+                            received += len(chunk)
+                            if progress is not None:
+                                progress(offset, total, received / (time.perf_counter() - t0))
+
+                if total is None or offset == total:
+                    break
+                logger.warning(f"Download of {filepath} incomplete ({offset}/{total} B)")
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout) as e:
+                logger.warning(f"Download of {filepath} interrupted at {offset} B: {e}")
+
+            if not resume:
+                offset = 0
         else:
-            logger.error(f"Failed to download {filepath} to {dest}")
+            logger.error(f"Failed to download {filepath} to {dest} after {retries + 1} attempts")
             return False
 
-    def upload(self, source: str,
+        os.replace(part, dest)
+        if os.path.exists(meta):
+            os.remove(meta)
+
+        dt = time.perf_counter() - t0
+        logger.info(f"Downloaded {filepath} [{offset} B] to {dest} "
+                    f"({received / dt / 1024:.1f} KiB/s)")
+        return True
+
+    def upload(self, source: Union[str, BinaryIO],
                filepath: str,
                chunked_encoding: bool = True,
-               chunks_size: int = 1024) -> requests.Response:
+               chunks_size: Optional[int] = None) -> requests.Response:
         rec_path = re.compile(
             r"^(\.?/)?(?P<filepath>([a-zA-Z0-9_]+/)*[a-zA-Z0-9_\-\.]+)$")
 
@@ -159,17 +346,52 @@ class Controller:
         else:
             filepath = m.group("filepath")
 
-        binary = open(source, "rb").read()
-        
-        if chunked_encoding:
-            if chunks_size:
-                binary = MakeChunks(binary, chunks_size)
+        if chunks_size is None:
+            chunks_size = self.get_chunks_size()
+
+        # The file is memory-mapped and sent as memoryview slices, either
+        # whole with a Content-Length or as chunks (chunked encoding).
+        with map_file(source) as view:
+            size = len(view)
+            if chunked_encoding and chunks_size:
+                data = MakeTransientChunks(view, chunks_size)
+            else:
+                data = view if size else b""
+
+            t0 = time.perf_counter()
+            try:
+                resp = self._req(
+                    "POST",
+                    self.url.sub(f"api/files/{filepath}"),
+                    data=data,
+                )
+            finally:
+                if chunked_encoding and chunks_size:
+                    data.close()
+            dt = time.perf_counter() - t0
+
+        logger.info(f"Uploaded {filepath} [{size} B] in {dt:.3f} s "
+                    f"({size / dt / 1024 if dt else 0.0:.1f} KiB/s)")
+
+        return resp
+
+    def get_chunks_size(self) -> int:
+        # upload chunks size tuned for this controller (see tune_chunks_size())
+        return tuning.cache.get(self.host, self.port) or tuning.DEFAULT_CHUNKS_SIZE
+
+    def tune_chunks_size(self, **kwargs) -> int:
+        return tuning.tune_chunks_size(self, **kwargs)
+
+    def dfu(self, image: Union[str, BinaryIO], reboot: bool = False, **kwargs) -> DFUReport:
+        # Firmware update, see dfu.DFUPipeline
+        return DFUPipeline(image, reboot=reboot, **kwargs).run(self)
 
-        return self._req(
-            "POST",
-            self.url.sub(f"api/files/{filepath}"),
-            data=binary,
-        )
+    def sync_dir(self, local: str, remote: str = "/", manifest: str = None,
+                 workers: int = None, verify: bool = False, **kwargs) -> SyncResult:
+        # Upload only the files of `local` which changed since the last sync,
+        # see fssync.sync_dir()
+        return sync_dir(self, local, remote, manifest,
+                        workers=workers or self.pool_size, verify=verify, **kwargs)
 
     def get_dfu_status(self) -> DFUStatus:
         resp = self._req("GET", self.url.sub("api/dfu"))
@@ -186,25 +408,69 @@ class Controller:
     def get_devices_page(self, page: int = 0) -> List:
         return self.req("GET", self.url.sub(f"api/devices?page={page}"))
 
-    def get_metrics(self) -> str:
-        return self.req("GET", self.url.sub("metrics")).text
+    def get_metrics(self) -> Optional[str]:
+        # raw text, see caniot.metrics to parse it
+        resp = self._req("GET", self.url.sub("metrics"))
+        if resp.status_code != 200:
+            logger.error(f"Request failed: {resp.status_code} {resp.reason}")
+            return None
+        return resp.text
+
+    def iter_metrics(self, parser: MetricsParser = None) -> Iterator[Sample]:
+        # streamed and parsed metrics, see caniot.metrics
+        return iter_metrics(self, parser)
 
     def get_room(self, room_id: int) -> dict:
         return self.req("GET", self.url.sub(f"api/room/{room_id}"))
 
-    def get_devices(self) -> List:
-        page = 0
-        devices = []
-
-        while True:
-            to_append = self.get_devices_page(page)
-            if len(to_append) > 0:
-                devices += to_append
+    def _get_devices_page(self, page: int, retries: int) -> List:
+        # A failed page is retried, then raises DevicePageError: only an empty
+        # page ends the table, a truncated table is never returned.
+        for attempt in range(retries + 1):
+            error = None
+            try:
+                devices = self.get_devices_page(page)
+            except requests.exceptions.RequestException as e:
+                devices, error = None, e
+            if isinstance(devices, list):
+                return devices
+            logger.warning(f"Devices page {page} failed (attempt {attempt + 1}/{retries + 1})"
+                           + (f": {error}" if error is not None else ""))
+        raise DevicePageError(page) from error
+
+    def iter_devices(self, prefetch: int = 1, retries: int = 2) -> Iterator[dict]:
+        # Keeps up to `prefetch` page requests in flight, pages are yielded in
+        # order and iteration stops at the first empty page.
+        if prefetch <= 1:
+            page = 0
+            while True:
+                to_append = self._get_devices_page(page, retries)
+                if not to_append:
+                    return
+                yield from to_append
                 page += 1
-            else:
-                break
-        
-        return devices
+
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending = deque(executor.submit(self._get_devices_page, page, retries)
+                            for page in range(prefetch))
+            next_page = prefetch
+            try:
+                while pending:
+                    to_append = pending.popleft().result()
+                    if not to_append:
+                        break
+
+                    pending.append(executor.submit(self._get_devices_page, next_page, retries))
+                    next_page += 1
+
+                    yield from to_append
+            finally:
+                # pages beyond the end (or no longer wanted) are not fetched
+                for future in pending:
+                    future.cancel()
+
+    def get_devices(self, prefetch: int = 1, retries: int = 2) -> List:
+        return list(self.iter_devices(prefetch, retries))
 
     def send_can(self, arbitration_id: int, vals: Iterable[int] = None) -> requests.Response:
         if vals is None:
@@ -215,23 +481,78 @@ class Controller:
         url = self.url.sub("api/if/can/{arbitration_id:X}").project(arbitration_id=arbitration_id)
         return self.req("POST", url, json=arr)
         
+    def close(self):
+        with self._adapter_lock:
+            if self._adapter is not None:
+                self._adapter.close()
+                self._adapter = None
+        self._local = threading.local()
+
     def __enter__(self):
-        if self.session:
-            raise RuntimeError("Session already exists")
+        self._get_adapter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        self.session = requests.Session() 
+class RestTransport(CaniotTransport):
+    # CANIOT operations through the controller REST API
+    def __init__(self, ctrl: Controller):
+        self.ctrl = ctrl
 
-        # TODO Setup session
-        # SSL
-        # Default headers
-        # Timeout
+    @staticmethod
+    def _timeout_header(timeout: float) -> dict:
+        return {
+            "Timeout-ms": str(int(timeout * 1000)),
+        }
 
-        return self
+    def request_telemetry(self, did: Union[DeviceId, int], ep: int, timeout: float):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/{ep}/telemetry").project(**{
+            "did": int(did),
+            "ep": ep
+        })
+        return self.ctrl.req("GET", url, headers=self._timeout_header(timeout))
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if self.session:
-            self.session.close()
-            self.session = None
+    def command(self, did: Union[DeviceId, int], ep: int, vals: List[int], timeout: float):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/{ep}/command").project(**{
+            "did": int(did),
+            "ep": ep,
+        })
+        return self.ctrl.req("POST", url, json=vals, headers=self._timeout_header(timeout))
+
+    def command_cls1(self, did: Union[DeviceId, int], vals: Iterable[str], timeout: float):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/blc1/command").project(**{
+            "did": int(did),
+            "ep": Endpoint.BoardLevelControl,
+        })
+        return self.ctrl.req("POST", url, json=list(vals), headers=self._timeout_header(timeout))
+
+    def read_attribute(self, did: Union[DeviceId, int], key: int, timeout: float):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/attribute/{attr:x}").project(**{
+            "did": int(did),
+            "attr": key
+        })
+        return self.ctrl.req("GET", url, headers=self._timeout_header(timeout))
+
+    def write_attribute(self, did: Union[DeviceId, int], key: int, value: int, timeout: float):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/attribute/{attr:x}").project(**{
+            "did": int(did),
+            "attr": key
+        })
+        return self.ctrl.req("PUT", url, json={"value": str(hex(value))},
+                             headers=self._timeout_header(timeout))
+
+    def factory_reset(self, did: Union[DeviceId, int], timeout: float):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/factory_reset").project(**{
+            "did": int(did),
+        })
+        return self.ctrl.req("POST", url, headers=self._timeout_header(timeout))
+
+    def reboot(self, did: Union[DeviceId, int], timeout: float):
+        url = self.ctrl.url.sub("api/devices/caniot/{did}/reboot").project(**{
+            "did": int(did),
+        })
+        return self.ctrl.req("POST", url, headers=self._timeout_header(timeout))
 
 class RestAPI(ABC):
     _app_timeout: float
@@ -256,9 +577,26 @@ class RestAPI(ABC):
     
 
 class CaniotAPI(RestAPI):
-    def __init__(self, ctrl):
+    def __init__(self, ctrl, max_inflight_per_device: int = 2,
+                 transport: CaniotTransport = None):
         super().__init__(ctrl)
 
+        # REST API of the controller unless another transport is given
+        # (e.g. transport.RawCanTransport to talk on the CAN bus directly)
+        self.transport: CaniotTransport = transport if transport is not None else RestTransport(ctrl)
+
+        # A CAN node can only serve a few requests at once
+        self.max_inflight_per_device = max_inflight_per_device
+        self._device_slots: Dict[int, threading.BoundedSemaphore] = {}
+        self._device_slots_lock = threading.Lock()
+
+        # Optional attribute read cache (see enable_cache())
+        self.cache: Optional[AttributeCache] = None
+
+    def enable_cache(self, maxsize: int = 1024, system_ttl: float = 1.0) -> AttributeCache:
+        self.cache = AttributeCache(maxsize=maxsize, system_ttl=system_ttl)
+        return self.cache
+
     class Device:
         def __init__(self, api: CaniotAPI, did: DeviceId):
             self.api = api
@@ -270,8 +608,14 @@ class CaniotAPI(RestAPI):
         def __exit__(self, exc_type, exc_value, traceback):
             pass
 
-        def read_attribute(self, attr: Union[int, AttributeId]) -> dict:
-            return self.api.read_attribute(self.did, attr)
+        def read_attribute(self, attr: Union[int, AttributeId], bypass_cache: bool = False) -> dict:
+            return self.api.read_attribute(self.did, attr, bypass_cache)
+
+        def read_attributes(self, attrs: Iterable[AttributeKey], bypass_cache: bool = False) -> AttributesBatch:
+            return self.api.read_attributes(self.did, attrs, bypass_cache)
+
+        def write_attributes(self, values: Dict[AttributeKey, int]) -> AttributesBatch:
+            return self.api.write_attributes(self.did, values)
 
         def request_telemetry(self, ep: int):
             return self.api.request_telemetry(self.did, ep)
@@ -295,11 +639,7 @@ class CaniotAPI(RestAPI):
         return CaniotAPI.Device(self, did)
 
     def request_telemetry(self, did: Union[DeviceId, int], ep: int):
-        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/{ep}/telemetry").project(**{
-            "did": int(did),
-            "ep": ep
-        })
-        return self.ctrl.req("GET", url, headers=self.app_timeout_header)
+        return self.transport.request_telemetry(did, ep, self.app_timeout)
 
     def command(self, did: Union[DeviceId, int], ep: int, vals: Iterable[int]):
         if vals is None:
@@ -307,45 +647,96 @@ class CaniotAPI(RestAPI):
         arr = list(vals)
         assert len(arr) <= 8
         assert all(map(lambda x: 0 <= x <= 255 and isinstance(x, int), arr))
-        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/{ep}/command").project(**{
-            "did": int(did),
-            "ep": ep,
-        })
-        return self.ctrl.req("POST", url, json=arr, headers=self.app_timeout_header)
+        return self.transport.command(did, ep, arr, self.app_timeout)
 
     def command_cls1(self, did: Union[DeviceId, int], vals: Iterable[str]):
-        url = self.ctrl.url.sub("api/devices/caniot/{did}/endpoint/blc1/command").project(**{
-            "did": int(did),
-            "ep": Endpoint.BoardLevelControl,
-        })
-        return self.ctrl.req("POST", url, json=list(vals), headers=self.app_timeout_header)
+        return self.transport.command_cls1(did, vals, self.app_timeout)
 
-    def read_attribute(self, did: Union[DeviceId, int], attr: Union[int, AttributeId]) -> requests.Response:
-        url = self.ctrl.url.sub("api/devices/caniot/{did}/attribute/{attr:x}").project(**{
-            "did": int(did),
-            "attr": int(attr)
-        })
-        return self.ctrl.req("GET", url, headers=self.app_timeout_header)
+    def read_attribute(self, did: Union[DeviceId, int], attr: Union[int, AttributeId],
+                       bypass_cache: bool = False) -> dict:
+        cache = self.cache
+        if cache is not None and not bypass_cache:
+            hit, res = cache.get(did, attr)
+            if hit:
+                return dict(res)
+
+        # a write completing before the response invalidates this read
+        generation = cache.generation(did, attr) if cache is not None else None
+        res = self.transport.read_attribute(did, int(attr), self.app_timeout)
+
+        if cache is not None and isinstance(res, dict):
+            cache.put(did, attr, dict(res), generation)
+
+        return res
 
     def write_attribute(self, did: Union[DeviceId, int], attr: Union[int, AttributeId], value: Union[int, bytes]):
-        url = self.ctrl.url.sub("api/devices/caniot/{did}/attribute/{attr:x}").project(**{
-            "did": int(did),
-            "attr": int(attr)
-        })
-        return self.ctrl.req("PUT", url, json={"value": str(hex(value))}, 
-                             headers=self.app_timeout_header)
+        # Invalidated before and after the write: reads in flight during the
+        # write don't cache the previous value (see AttributeCache.generation()).
+        if self.cache is not None:
+            self.cache.invalidate(did, attr)
+        try:
+            return self.transport.write_attribute(did, int(attr), value, self.app_timeout)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(did, attr)
+
+    def _get_device_slots(self, did: Union[DeviceId, int]) -> threading.BoundedSemaphore:
+        with self._device_slots_lock:
+            slots = self._device_slots.get(int(did))
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_inflight_per_device)
+                self._device_slots[int(did)] = slots
+            return slots
+
+    def _attributes_batch(self, did: Union[DeviceId, int], items: Iterable[AttributeKey],
+                          operation) -> AttributesBatch:
+        batch = AttributesBatch()
+        slots = self._get_device_slots(did)
+
+        def run(item: AttributeKey):
+            key = resolve_key(item)
+            with slots:
+                res = operation(key, item)
+            if not isinstance(res, dict):
+                raise AttributeRequestError(did, key)
+            return res.get("value")
+
+        items = list(items)
+        if not items:
+            return batch
+
+        workers = min(len(items), self.max_inflight_per_device)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(item, executor.submit(run, item)) for item in items]
+            for item, future in futures:
+                try:
+                    batch[item] = future.result()
+                except Exception as e:
+                    logger.error(f"Attribute {item} of device {int(did)} failed: {e}")
+                    batch.errors[item] = e
+
+        return batch
+
+    def read_attributes(self, did: Union[DeviceId, int], attrs: Iterable[AttributeKey],
+                        bypass_cache: bool = False) -> AttributesBatch:
+        return self._attributes_batch(
+            did, attrs, lambda key, item: self.read_attribute(did, key, bypass_cache))
+
+    def write_attributes(self, did: Union[DeviceId, int], values: Dict[AttributeKey, int]) -> AttributesBatch:
+        return self._attributes_batch(
+            did, values, lambda key, item: self.write_attribute(did, key, values[item]))
 
     def factory_reset(self, did: Union[DeviceId, int]):
-        url = self.ctrl.url.sub("api/devices/caniot/{did}/factory_reset").project(**{
-            "did": int(did),
-        })
-        return self.ctrl.req("POST", url, headers=self.app_timeout_header)
+        if self.cache is not None:
+            self.cache.invalidate(did)
+
+        return self.transport.factory_reset(did, self.app_timeout)
 
     def reboot(self, did: Union[DeviceId, int]):
-        url = self.ctrl.url.sub("api/devices/caniot/{did}/reboot").project(**{
-            "did": int(did),
-        })
-        return self.ctrl.req("POST", url, headers=self.app_timeout_header)
+        if self.cache is not None:
+            self.cache.invalidate(did)
+
+        return self.transport.reboot(did, self.app_timeout)
 
 class TestAPI(RestAPI):
     def __init__(self, ctrl):
@@ -0,0 +1,291 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Matching of incoming CANIOT frames against outstanding queries.
+#
+# Each query is recorded under the arbitration id of its expected response
+# (and of the error frame the device would send instead), so an incoming
+# frame is matched with a single dict lookup. Queries sent to the broadcast
+# device id are recorded in a wildcard bucket with the device bits masked.
+
+from __future__ import annotations
+
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Tuple, Union
+
+from .caniot import FrameType, MsgId, QueryType, response_id
+
+# Device id bits of an arbitration id
+DEVICE_MASK = 0x3F << 3
+
+# Error frames are "Command" frames of type "Response"
+ERROR_BITS = QueryType.Response << 2 | FrameType.Command
+
+
+class CaniotError(Exception):
+    def __init__(self, arbitration_id: int, code: int):
+        super().__init__(f"CANIOT error {code} (0x{code & 0xFFFFFFFF:08X}) from {MsgId.from_int(arbitration_id)}")
+        self.arbitration_id = arbitration_id
+        self.code = code
+
+
+class Response(NamedTuple):
+    arbitration_id: int
+    data: bytes
+    timestamp: float
+
+    @property
+    def msgid(self) -> MsgId:
+        return MsgId.from_int(self.arbitration_id)
+
+
+def error_id(query_id: int) -> int:
+    # Arbitration id of the error frame a device sends in response to `query_id`
+    return (query_id & ~0b111) | ERROR_BITS
+
+
+def attribute_key(data: bytes) -> Optional[int]:
+    if len(data) >= 2:
+        return data[0] | data[1] << 8
+    return None
+
+
+def error_code(data: bytes) -> int:
+    if len(data) >= 4:
+        code, = struct.unpack_from("<i", data)
+        return code
+    return 0
+
+
+class PendingQuery:
+    __slots__ = ("query_id", "response_id", "error_id", "discriminator", "broadcast",
+                 "deadline", "future", "callback", "responses", "done")
+
+    def __init__(self, query_id: int, discriminator: Optional[int], deadline: float,
+                 callback: Optional[Callable[[PendingQuery, Response], None]]):
+        self.query_id = query_id
+        self.response_id = response_id(query_id)
+        self.error_id = error_id(query_id)
+        self.discriminator = discriminator
+        self.broadcast = (query_id & DEVICE_MASK) == DEVICE_MASK
+        self.deadline = deadline
+        self.future: Future = Future()
+        self.callback = callback
+        self.responses: List[Union[Response, CaniotError]] = []
+        self.done = False
+
+    def __repr__(self) -> str:
+        return f"PendingQuery({MsgId.from_int(self.query_id)} responses={len(self.responses)})"
+
+
+class TimerWheel:
+    # Hashed timer wheel, `slots` buckets of `tick` seconds each.
+    def __init__(self, tick: float = 0.01, slots: int = 512, now: float = 0.0):
+        self.tick = tick
+        self.slots = slots
+        self._wheel: List[List[Tuple[float, object]]] = [[] for _ in range(slots)]
+        self._current = int(now / tick)
+
+    def schedule(self, deadline: float, item: object):
+        # items are never placed in an already processed tick
+        tick = max(int(deadline / self.tick), self._current)
+        self._wheel[tick % self.slots].append((deadline, item))
+
+    def advance(self, now: float) -> List[object]:
+        expired = []
+
+        target = int(now / self.tick)
+        if target < self._current:
+            return expired
+
+        # at most one full turn
+        ticks = range(self._current, min(target, self._current + self.slots - 1) + 1)
+        for tick in ticks:
+            slot = self._wheel[tick % self.slots]
+            if slot:
+                remaining = []
+                for deadline, item in slot:
+                    if deadline <= now:
+                        expired.append(item)
+                    else:
+                        remaining.append((deadline, item))
+                slot[:] = remaining
+
+        self._current = target
+        return expired
+
+
+class QueryCorrelator:
+    def __init__(self, timeout: float = 1.0, tick: float = 0.01, slots: int = 512,
+                 clock: Callable[[], float] = time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._wheel = TimerWheel(tick, slots, clock())
+
+        # (expected response id, attribute key) -> pending queries (FIFO)
+        self._pending: Dict[Tuple[int, Optional[int]], Deque[PendingQuery]] = {}
+        # expected error id -> pending queries (FIFO)
+        self._errors: Dict[int, Deque[PendingQuery]] = {}
+        # broadcast queries, response/error ids with the device bits cleared
+        self._broadcast: Dict[Tuple[int, Optional[int]], List[PendingQuery]] = {}
+        self._broadcast_errors: Dict[int, List[PendingQuery]] = {}
+
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def register(self, query: Union[int, MsgId], data: bytes = b"",
+                 timeout: float = None,
+                 callback: Callable[[PendingQuery, Response], None] = None,
+                 now: float = None) -> PendingQuery:
+        # Record an outstanding query, the returned entry future completes with
+        # the Response (broadcast: the list of responses once expired).
+        query_id = int(query)
+        if now is None:
+            now = self.clock()
+        if timeout is None:
+            timeout = self.timeout
+
+        frame_type = query_id & 0b11
+        if frame_type in (FrameType.ReadAttribute, FrameType.WriteAttribute):
+            discriminator = attribute_key(data)
+        else:
+            discriminator = None
+
+        entry = PendingQuery(query_id, discriminator, now + timeout, callback)
+
+        with self._lock:
+            if entry.broadcast:
+                key = (entry.response_id & ~DEVICE_MASK, discriminator)
+                self._broadcast.setdefault(key, []).append(entry)
+                self._broadcast_errors.setdefault(entry.error_id & ~DEVICE_MASK, []).append(entry)
+            else:
+                self._pending.setdefault((entry.response_id, discriminator), deque()).append(entry)
+                self._errors.setdefault(entry.error_id, deque()).append(entry)
+            self._wheel.schedule(entry.deadline, entry)
+            self._count += 1
+
+        return entry
+
+    def _unlink(self, entry: PendingQuery):
+        if entry.broadcast:
+            key = (entry.response_id & ~DEVICE_MASK, entry.discriminator)
+            buckets = ((self._broadcast, key), (self._broadcast_errors, entry.error_id & ~DEVICE_MASK))
+        else:
+            buckets = ((self._pending, (entry.response_id, entry.discriminator)),
+                       (self._errors, entry.error_id))
+
+        for table, key in buckets:
+            bucket = table.get(key)
+            if bucket is not None:
+                try:
+                    bucket.remove(entry)
+                except ValueError:
+                    pass
+                if not bucket:
+                    del table[key]
+
+        entry.done = True
+        self._count -= 1
+
+    @staticmethod
+    def _first(table: Dict, key) -> Optional[PendingQuery]:
+        bucket = table.get(key)
+        if not bucket:
+            return None
+        return bucket[0]
+
+    def match(self, arbitration_id: int, data: bytes = b"", now: float = None) -> bool:
+        # Dispatch a received frame, returns True if it matched a pending query
+        if now is None:
+            now = self.clock()
+
+        response = Response(arbitration_id, bytes(data), now)
+        completed: List[Tuple[PendingQuery, Union[Response, CaniotError]]] = []
+        notified: List[Tuple[PendingQuery, Union[Response, CaniotError]]] = []
+
+        with self._lock:
+            if arbitration_id & 0b111 == ERROR_BITS:
+                result = CaniotError(arbitration_id, error_code(data))
+
+                entry = self._first(self._errors, arbitration_id)
+                if entry is not None:
+                    self._unlink(entry)
+                    completed.append((entry, result))
+
+                for entry in self._broadcast_errors.get(arbitration_id & ~DEVICE_MASK, ()):
+                    entry.responses.append(result)
+                    notified.append((entry, result))
+            else:
+                if arbitration_id & 0b11 == FrameType.ReadAttribute:
+                    discriminator = attribute_key(data)
+                else:
+                    discriminator = None
+
+                entry = self._first(self._pending, (arbitration_id, discriminator))
+                if entry is not None:
+                    self._unlink(entry)
+                    completed.append((entry, response))
+
+                key = (arbitration_id & ~DEVICE_MASK, discriminator)
+                for entry in self._broadcast.get(key, ()):
+                    entry.responses.append(response)
+                    notified.append((entry, response))
+
+        # complete futures and run callbacks outside of the lock
+        for entry, result in completed:
+            entry.responses.append(result)
+            if entry.future.cancelled():
+                continue
+            elif isinstance(result, Exception):
+                entry.future.set_exception(result)
+            else:
+                entry.future.set_result(result)
+            if entry.callback:
+                entry.callback(entry, result)
+
+        for entry, result in notified:
+            if entry.callback:
+                entry.callback(entry, result)
+
+        return bool(completed or notified)
+
+    def expire(self, now: float = None) -> List[PendingQuery]:
+        # Complete timed out queries, broadcast queries complete with their responses
+        if now is None:
+            now = self.clock()
+
+        with self._lock:
+            expired = [entry for entry in self._wheel.advance(now) if not entry.done]
+            for entry in expired:
+                self._unlink(entry)
+
+        for entry in expired:
+            if entry.future.cancelled():
+                continue
+            elif entry.broadcast:
+                entry.future.set_result(list(entry.responses))
+            else:
+                entry.future.set_exception(
+                    TimeoutError(f"No response to {MsgId.from_int(entry.query_id)}"))
+
+        return expired
+
+    def cancel(self, entry: PendingQuery) -> bool:
+        with self._lock:
+            if entry.done:
+                return False
+            self._unlink(entry)
+
+        entry.future.cancel()
+        return True
@@ -0,0 +1,326 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Rates of the monotonic counters of the controller (HA stats) and of the
+# CANIOT nodes (SysReceived*/SysSent* attributes).
+#
+# Counters are sampled periodically, all sources concurrently and the
+# attributes of a node as one batch (CaniotAPI.read_attributes). Node reboots
+# are detected through SysUptime/SysStartTime, the counters restarting from
+# zero, other decreases are handled as 32-bit wraparounds for node counters
+# and as resets for controller counters.
+
+from __future__ import annotations
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Deque, Dict, Hashable, List, Optional, Tuple, Union
+
+from .caniot import DeviceId
+from .caniot_attributes import AttributeId
+
+if TYPE_CHECKING:
+    from .controller import CaniotAPI, Controller
+    from .timeseries import TimeSeriesStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+NODE_COUNTERS = (
+    AttributeId.SysReceivedTotal,
+    AttributeId.SysReceivedReadAttribute,
+    AttributeId.SysReceivedWriteAttribute,
+    AttributeId.SysReceivedCommand,
+    AttributeId.SysReceivedRequestTelemetry,
+    AttributeId.SysSentTotal,
+    AttributeId.SysSentTelemetry,
+)
+
+COUNTER32_MODULO = 1 << 32
+
+
+@dataclass
+class Rate:
+    # total since the monitor started (resets/wraparounds compensated)
+    total: float
+    # per second, between the last two samples
+    rate: float
+    # per second, over the monitor window
+    window_rate: float
+    # increase over the monitor window
+    window_delta: float
+
+
+class Counter:
+    __slots__ = ("raw", "total", "samples", "resets")
+
+    def __init__(self):
+        self.raw: Optional[float] = None
+        self.total = 0.0
+        self.samples: Deque[Tuple[float, float]] = deque()
+        self.resets = 0
+
+    def update(self, timestamp: float, value: float, reset: bool, modulo: Optional[int], window: float):
+        if self.raw is not None:
+            if reset:
+                # restarted from zero
+                delta = value
+                self.resets += 1
+            elif value >= self.raw:
+                delta = value - self.raw
+            elif modulo is not None and self.raw > modulo // 2:
+                # wrapped around, only possible from the upper half
+                delta = value + modulo - self.raw
+            else:
+                # missed reset
+                delta = value
+                self.resets += 1
+            self.total += delta
+        self.raw = value
+
+        self.samples.append((timestamp, self.total))
+        # keep one sample older than the window to measure the whole window
+        while len(self.samples) > 2 and self.samples[1][0] <= timestamp - window:
+            self.samples.popleft()
+
+    def rate(self) -> Rate:
+        samples = self.samples
+        if len(samples) < 2:
+            return Rate(self.total, 0.0, 0.0, 0.0)
+
+        (t0, v0), (t1, v1) = samples[-2], samples[-1]
+        (tw, vw) = samples[0]
+        return Rate(
+            self.total,
+            (v1 - v0) / (t1 - t0) if t1 > t0 else 0.0,
+            (v1 - vw) / (t1 - tw) if t1 > tw else 0.0,
+            v1 - vw,
+        )
+
+
+class CounterSource(ABC):
+    # A set of counters sampled together (a controller or a node)
+    def __init__(self, name: Hashable, modulo: Optional[int] = None):
+        self.name = name
+        self.modulo = modulo
+        self.counters: Dict[str, Counter] = {}
+        self.last_sample: Optional[float] = None
+        self.errors = 0
+
+    @abstractmethod
+    def fetch(self) -> Tuple[Dict[str, float], bool]:
+        # (counter values, reset detected)
+        pass
+
+    def sample(self, window: float, timestamp: float = None) -> bool:
+        try:
+            values, reset = self.fetch()
+        except Exception as e:
+            values, reset = None, False
+            logger.debug(f"Sampling {self.name} failed: {e}")
+
+        if not values:
+            self.errors += 1
+            return False
+
+        if timestamp is None:
+            timestamp = time.time()
+        for name, value in values.items():
+            counter = self.counters.get(name)
+            if counter is None:
+                counter = self.counters[name] = Counter()
+            counter.update(timestamp, value, reset, self.modulo, window)
+        self.last_sample = timestamp
+        return True
+
+    def rates(self) -> Dict[str, Rate]:
+        return {name: counter.rate() for name, counter in self.counters.items()}
+
+
+class ControllerCounters(CounterSource):
+    # numeric fields of get_ha_stats(), nested ones as "a.b"
+    def __init__(self, ctrl: Controller, name: Hashable = None):
+        super().__init__(name if name is not None else f"{ctrl.host}:{ctrl.port}")
+        self.ctrl = ctrl
+
+    def fetch(self) -> Tuple[Dict[str, float], bool]:
+        stats = self.ctrl.get_ha_stats()
+        if not isinstance(stats, dict):
+            return {}, False
+
+        values = {}
+
+        def flatten(prefix: str, obj: dict):
+            for name, value in obj.items():
+                if isinstance(value, dict):
+                    flatten(f"{prefix}{name}.", value)
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    values[f"{prefix}{name}"] = value
+
+        flatten("", stats)
+        return values, False
+
+
+class NodeCounters(CounterSource):
+    def __init__(self, api: CaniotAPI, did: Union[DeviceId, int], name: Hashable = None,
+                 counters=NODE_COUNTERS):
+        super().__init__(name if name is not None else int(did), modulo=COUNTER32_MODULO)
+        self.api = api
+        self.did = did
+        self.attributes = tuple(counters)
+
+        self.start_time: Optional[int] = None
+        self.uptime: Optional[int] = None
+        self._sampled_at = 0.0
+
+        # uptime lag (s) tolerated before deciding that the node rebooted
+        self.reboot_tolerance = 5.0
+
+    def fetch(self) -> Tuple[Dict[str, float], bool]:
+        keys = self.attributes + (AttributeId.SysStartTime, AttributeId.SysUptime)
+        batch = self.api.read_attributes(self.did, keys, bypass_cache=True)
+        if not batch.ok():
+            # a partial sample would be mistaken for a reset later
+            return {}, False
+
+        now = time.monotonic()
+        start_time, uptime = batch[AttributeId.SysStartTime], batch[AttributeId.SysUptime]
+
+        values = {AttributeId(key).name: batch[key] for key in self.attributes}
+
+        # The node rebooted if its uptime decreased or did not advance as much
+        # as our clock since the last sample (rebooted and ran longer than the
+        # previous uptime), or if its start time changed while counters
+        # decreased. A start time change alone is a clock update.
+        reset = False
+        if self.uptime is not None:
+            expected = self.uptime + (now - self._sampled_at)
+            reset = uptime < self.uptime or uptime < expected - self.reboot_tolerance
+            if reset:
+                logger.info(f"Node {self.name} rebooted (uptime {self.uptime} -> {uptime} s)")
+            elif start_time != self.start_time:
+                reset = any(name in self.counters and self.counters[name].raw is not None
+                            and value < self.counters[name].raw for name, value in values.items())
+                if reset:
+                    logger.info(f"Node {self.name} rebooted (start time changed, counters decreased)")
+                else:
+                    logger.debug(f"Node {self.name} start time changed (clock update)")
+        self.start_time, self.uptime, self._sampled_at = start_time, uptime, now
+
+        return values, reset
+
+
+def _store_device(name: Hashable) -> Union[str, int]:
+    # TimeSeriesStore devices are str or int (snapshots are JSON keyed),
+    # e.g. ("ctrl1", 8) -> "ctrl1/8"
+    if isinstance(name, (str, int)):
+        return name
+    if isinstance(name, tuple):
+        return "/".join(str(part) for part in name)
+    return str(name)
+
+
+class CounterMonitor:
+    def __init__(self, period: float = 10.0, window: float = 60.0, workers: int = 8,
+                 store: TimeSeriesStore = None):
+        self.period = period
+        self.window = window
+        self.workers = workers
+
+        # if given, rates are appended to the store as (source, None, "<counter>.rate"),
+        # tuple source names (add_nodes() prefix) joined as "prefix/did"
+        self.store = store
+
+        self.sources: Dict[Hashable, CounterSource] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def add(self, source: CounterSource) -> CounterSource:
+        self.sources[source.name] = source
+        return source
+
+    def add_controller(self, ctrl: Controller, name: Hashable = None) -> ControllerCounters:
+        return self.add(ControllerCounters(ctrl, name))
+
+    def add_node(self, api: CaniotAPI, did: Union[DeviceId, int], name: Hashable = None) -> NodeCounters:
+        return self.add(NodeCounters(api, did, name))
+
+    def add_nodes(self, api: CaniotAPI, dids, prefix: Hashable = None) -> List[NodeCounters]:
+        return [self.add_node(api, did, (prefix, int(did)) if prefix is not None else None)
+                for did in dids]
+
+    def sample(self) -> int:
+        # Sample all the sources concurrently, returns the number of successes
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix="caniot-counters")
+
+        timestamp = time.time()
+        sources = list(self.sources.values())
+        results = list(self._executor.map(lambda s: s.sample(self.window, timestamp), sources))
+
+        if self.store is not None:
+            for source, ok in zip(sources, results):
+                if ok:
+                    device = _store_device(source.name)
+                    for name, rate in source.rates().items():
+                        self.store.append((device, None, f"{name}.rate"), rate.rate, timestamp)
+
+        return sum(results)
+
+    def rates(self, source: Hashable) -> Dict[str, Rate]:
+        return self.sources[source].rates()
+
+    def top(self, counter: str = "SysReceivedTotal", n: int = 10,
+            windowed: bool = True) -> List[Tuple[Hashable, float]]:
+        # sources with the highest rate of `counter` (e.g. nodes flooding the bus)
+        rates = []
+        for name, source in self.sources.items():
+            c = source.counters.get(counter)
+            if c is not None:
+                rate = c.rate()
+                rates.append((name, rate.window_rate if windowed else rate.rate))
+        rates.sort(key=lambda item: item[1], reverse=True)
+        return rates[:n]
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                # keep monitoring
+                logger.exception(f"Counters sampling failed: {e}")
+            next_tick += self.period
+            self._stop.wait(max(next_tick - time.monotonic(), 0.0))
+
+    def start(self) -> threading.Thread:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="caniot-counter-monitor")
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
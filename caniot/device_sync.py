@@ -0,0 +1,178 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Incremental synchronization of the controller device table.
+#
+# The previous snapshot is indexed by device address, each refresh reports
+# only the devices added, removed or changed, and for changed devices which
+# endpoints changed (new events included). Unchanged devices are skipped with
+# a single dict comparison, so consumers only process what changed.
+
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .controller import Controller
+
+import logging
+logger = logging.getLogger(__name__)
+
+# (addr_type, addr_medium, addr_repr)
+DeviceKey = Tuple[str, str, str]
+
+ENDPOINT_ADDED = "added"
+ENDPOINT_REMOVED = "removed"
+ENDPOINT_CHANGED = "changed"
+
+
+def device_key(dev: dict) -> DeviceKey:
+    return dev.get("addr_type"), dev.get("addr_medium"), dev.get("addr_repr")
+
+
+def event_timestamp(endpoint: Optional[dict]) -> int:
+    if not endpoint:
+        return 0
+    return (endpoint.get("last_event") or {}).get("timestamp", 0) or 0
+
+
+@dataclass
+class EndpointChange:
+    index: int
+    kind: str
+    previous: Optional[dict]
+    current: Optional[dict]
+
+    @property
+    def new_event(self) -> bool:
+        # the last event timestamp advanced
+        return event_timestamp(self.current) > event_timestamp(self.previous)
+
+    @property
+    def last_event(self) -> int:
+        return event_timestamp(self.current)
+
+
+@dataclass
+class DeviceChange:
+    key: DeviceKey
+    previous: dict
+    current: dict
+    # top level fields (other than endpoints) whose value changed
+    fields: List[str] = field(default_factory=list)
+    endpoints: List[EndpointChange] = field(default_factory=list)
+
+
+@dataclass
+class DeviceChanges:
+    added: List[dict] = field(default_factory=list)
+    removed: List[dict] = field(default_factory=list)
+    changed: List[DeviceChange] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self) -> str:
+        return f"DeviceChanges(added={len(self.added)} removed={len(self.removed)} " \
+               f"changed={len(self.changed)})"
+
+
+def diff_endpoints(previous: List[dict], current: List[dict]) -> List[EndpointChange]:
+    changes = []
+    for i in range(max(len(previous), len(current))):
+        prev = previous[i] if i < len(previous) else None
+        cur = current[i] if i < len(current) else None
+        if prev == cur:
+            continue
+        if prev is None:
+            kind = ENDPOINT_ADDED
+        elif cur is None:
+            kind = ENDPOINT_REMOVED
+        else:
+            kind = ENDPOINT_CHANGED
+        changes.append(EndpointChange(i, kind, prev, cur))
+    return changes
+
+
+def diff_device(key: DeviceKey, previous: dict, current: dict) -> DeviceChange:
+    fields = [name for name in previous.keys() | current.keys()
+              if name != "endpoints" and previous.get(name) != current.get(name)]
+    endpoints = diff_endpoints(previous.get("endpoints") or [], current.get("endpoints") or [])
+    return DeviceChange(key, previous, current, sorted(fields), endpoints)
+
+
+class DeviceTableSync:
+    def __init__(self, ctrl: Controller = None,
+                 fetch: Callable[[], Iterable[dict]] = None,
+                 prefetch: int = 2):
+        # devices are fetched with `fetch()` if given, ctrl.iter_devices() otherwise
+        if fetch is None:
+            if ctrl is None:
+                raise ValueError("A controller or a fetch function is required")
+            fetch = lambda: ctrl.iter_devices(prefetch)
+        self.fetch = fetch
+
+        self.devices: Dict[DeviceKey, dict] = {}
+        self.failures = 0
+        self._callbacks: List[Callable[[DeviceChanges], object]] = []
+
+    def subscribe(self, callback: Callable[[DeviceChanges], object]):
+        # called after each refresh with changes
+        self._callbacks.append(callback)
+
+    def update(self, devices: Iterable[dict]) -> DeviceChanges:
+        # Apply a new snapshot of the device table
+        changes = DeviceChanges()
+        current: Dict[DeviceKey, dict] = {}
+
+        for dev in devices:
+            key = device_key(dev)
+            if key in current:
+                logger.warning(f"Duplicate device {key}")
+                continue
+            current[key] = dev
+
+            previous = self.devices.get(key)
+            if previous is None:
+                changes.added.append(dev)
+            elif previous != dev:
+                changes.changed.append(diff_device(key, previous, dev))
+
+        if len(current) - len(changes.added) != len(self.devices):
+            changes.removed = [dev for key, dev in self.devices.items() if key not in current]
+
+        self.devices = current
+
+        if changes:
+            for callback in self._callbacks:
+                try:
+                    callback(changes)
+                except Exception as e:
+                    logger.exception(f"Device sync callback failed: {e}")
+
+        return changes
+
+    def refresh(self) -> Optional[DeviceChanges]:
+        # The table is fetched completely before being applied: if the fetch
+        # fails (e.g. DevicePageError), the previous snapshot is kept and None
+        # is returned, instead of reporting the missing devices as removed.
+        try:
+            devices = self.fetch()
+            if devices is None:
+                raise ValueError("no device table")
+            devices = list(devices)
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Device table refresh failed, previous snapshot kept: {e}")
+            return None
+        return self.update(devices)
+
+    def get(self, key: DeviceKey) -> Optional[dict]:
+        return self.devices.get(key)
+
+    def __len__(self) -> int:
+        return len(self.devices)
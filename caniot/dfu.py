@@ -0,0 +1,230 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Firmware update (DFU) pipeline for the controller.
+#
+# Phases: read the DFU status, stream the image (sha256 computed as the
+# chunks are sent), poll the status with exponential backoff until it
+# reports the new image, then optionally reboot and wait for the controller
+# to come back. The same pipeline runs on several controllers concurrently
+# with run_fleet().
+
+from __future__ import annotations
+
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+import requests
+
+from .utils import MakeTransientChunks, map_file
+
+if TYPE_CHECKING:
+    from .controller import Controller, DFUStatus
+
+import logging
+logger = logging.getLogger(__name__)
+
+# uptime lag (s) tolerated before deciding that the controller rebooted
+UPTIME_TOLERANCE = 2.0
+
+
+class DFUError(Exception):
+    pass
+
+
+@dataclass
+class DFUReport:
+    host: str
+    size: int = 0
+    sha256: Optional[str] = None
+    before: Optional[DFUStatus] = None
+    after: Optional[DFUStatus] = None
+    # phase -> duration (s)
+    phases: Dict[str, float] = field(default_factory=dict)
+    error: Optional[str] = None
+
+    def ok(self) -> bool:
+        return self.error is None
+
+    @property
+    def upload_throughput(self) -> float:
+        duration = self.phases.get("upload")
+        return self.size / duration if duration else 0.0
+
+    @property
+    def duration(self) -> float:
+        return sum(self.phases.values())
+
+    def __repr__(self) -> str:
+        phases = " ".join(f"{name}={duration:.3f}s" for name, duration in self.phases.items())
+        status = "OK" if self.ok() else f"FAILED ({self.error})"
+        return f"DFU {self.host}: {status} {self.size} B sha256={self.sha256} " \
+               f"({self.upload_throughput / 1024:.1f} KiB/s) {phases}"
+
+
+def image_confirmed(before: Optional[DFUStatus], status: DFUStatus, size: int) -> bool:
+    # default confirmation: the controller reports an image of the uploaded
+    # size and its status changed
+    return status.image_size == size and status != before
+
+
+class DFUPipeline:
+    def __init__(self, image: Union[str, BinaryIO],
+                 upload_route: str = "api/dfu",
+                 reboot: bool = False,
+                 reboot_route: str = "api/reboot",
+                 chunks_size: Optional[int] = None,
+                 poll_interval: float = 0.5,
+                 poll_max_interval: float = 5.0,
+                 confirm_timeout: float = 60.0,
+                 reboot_timeout: float = 60.0,
+                 confirmed: Callable[[Optional[DFUStatus], DFUStatus, int], bool] = image_confirmed):
+        self.image = image
+        self.upload_route = upload_route
+        self.reboot = reboot
+        self.reboot_route = reboot_route
+        self.chunks_size = chunks_size
+
+        self.poll_interval = poll_interval
+        self.poll_max_interval = poll_max_interval
+        self.confirm_timeout = confirm_timeout
+        self.reboot_timeout = reboot_timeout
+        self.confirmed = confirmed
+
+    def _hashing(self, chunks: Iterable[memoryview], digest) -> Iterator[memoryview]:
+        for chunk in chunks:
+            digest.update(chunk)
+            yield chunk
+
+    def _poll(self, fetch: Callable[[], object], done: Callable[[object], bool],
+              timeout: float) -> Optional[object]:
+        # Poll fetch() with exponential backoff until done(value), the
+        # controller may not answer in the meantime (reboot).
+        deadline = time.monotonic() + timeout
+        interval = self.poll_interval
+        while True:
+            try:
+                value = fetch()
+                if value is not None and done(value):
+                    return value
+            except requests.exceptions.RequestException as e:
+                logger.debug(f"Controller unavailable: {e}")
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.poll_max_interval)
+
+    def _wait_reboot(self, ctrl: Controller, uptime: Optional[float], since: float) -> bool:
+        # The reboot is confirmed once the controller answers again after
+        # being unreachable, or reports an uptime which restarted: a reply
+        # sent before it actually resets does not count.
+        down = False
+
+        def info() -> Optional[dict]:
+            nonlocal down
+            try:
+                resp = ctrl._req("GET", ctrl.url.sub("api/info"))
+                if resp.status_code == 200:
+                    return resp.json()
+            except (requests.exceptions.RequestException, ValueError):
+                pass
+            down = True
+            return None
+
+        def rebooted(info: dict) -> bool:
+            if down:
+                return True
+            current = info.get("uptime")
+            if uptime is None or current is None:
+                return False
+            return current < uptime or current + UPTIME_TOLERANCE < uptime + (time.monotonic() - since)
+
+        return self._poll(info, rebooted, self.reboot_timeout) is not None
+
+    def _uptime(self, ctrl: Controller) -> Optional[float]:
+        try:
+            info = ctrl.get_info()
+        except requests.exceptions.RequestException:
+            return None
+        return info.get("uptime") if isinstance(info, dict) else None
+
+    def run(self, ctrl: Controller) -> DFUReport:
+        report = DFUReport(f"{ctrl.host}:{ctrl.port}")
+
+        def phase(name: str, t0: float):
+            report.phases[name] = time.perf_counter() - t0
+
+        try:
+            t0 = time.perf_counter()
+            report.before = ctrl.get_dfu_status()
+            phase("status", t0)
+            logger.info(f"{ctrl.host}: {report.before}")
+
+            t0 = time.perf_counter()
+            chunks_size = self.chunks_size or ctrl.get_chunks_size()
+            digest = hashlib.sha256()
+            with map_file(self.image) as view:
+                report.size = len(view)
+                chunks = self._hashing(MakeTransientChunks(view, chunks_size), digest)
+                try:
+                    resp = ctrl._req("POST", ctrl.url.sub(self.upload_route), data=chunks,
+                                     headers={"Content-Type": "application/octet-stream"})
+                finally:
+                    chunks.close()
+            phase("upload", t0)
+            report.sha256 = digest.hexdigest()
+
+            if resp.status_code != 200:
+                raise DFUError(f"upload failed: {resp.status_code} {resp.reason}")
+            logger.info(f"{ctrl.host}: uploaded {report.size} B sha256={report.sha256} "
+                        f"({report.upload_throughput / 1024:.1f} KiB/s)")
+
+            t0 = time.perf_counter()
+            report.after = self._poll(ctrl.get_dfu_status,
+                                      lambda s: self.confirmed(report.before, s, report.size),
+                                      self.confirm_timeout)
+            phase("confirm", t0)
+            if report.after is None:
+                raise DFUError(f"image not confirmed after {self.confirm_timeout} s")
+
+            if self.reboot:
+                t0 = time.perf_counter()
+                uptime, since = self._uptime(ctrl), time.monotonic()
+                try:
+                    resp = ctrl._req("POST", ctrl.url.sub(self.reboot_route))
+                except requests.exceptions.RequestException:
+                    # the controller may reset before answering
+                    resp = None
+                if resp is not None and resp.status_code not in (200, 204):
+                    phase("reboot", t0)
+                    raise DFUError(f"reboot failed: {resp.status_code} {resp.reason}")
+                if not self._wait_reboot(ctrl, uptime, since):
+                    phase("reboot", t0)
+                    raise DFUError(f"controller did not reboot within {self.reboot_timeout} s")
+                status = self._poll(ctrl.get_dfu_status, lambda s: True, self.reboot_timeout)
+                phase("reboot", t0)
+                if status is None:
+                    raise DFUError(f"controller not back after {self.reboot_timeout} s")
+                report.after = status
+        except (DFUError, requests.exceptions.RequestException) as e:
+            report.error = str(e)
+            logger.error(f"DFU of {ctrl.host} failed: {e}")
+        except Exception as e:
+            # one controller must not abort run_fleet()
+            report.error = f"{type(e).__name__}: {e}"
+            logger.exception(f"DFU of {ctrl.host} failed: {e}")
+
+        return report
+
+    def run_fleet(self, controllers: Iterable[Controller], max_concurrent: int = 2) -> List[DFUReport]:
+        # Reports are in the order of `controllers`
+        with ThreadPoolExecutor(max_workers=max(max_concurrent, 1)) as executor:
+            return list(executor.map(self.run, controllers))
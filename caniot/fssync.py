@@ -0,0 +1,218 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Delta synchronization of a local directory to the controller filesystem.
+#
+# A local manifest records the size, mtime and sha256 of every file last
+# pushed to a controller, only new or modified files are uploaded on the
+# next run. Files whose size and mtime did not change are not hashed again.
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .utils import map_file
+
+if TYPE_CHECKING:
+    from .controller import Controller
+
+import logging
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with map_file(path) as view:
+        digest.update(view)
+    return digest.hexdigest()
+
+
+@dataclass
+class FileEntry:
+    size: int
+    mtime_ns: int
+    sha256: str
+
+
+class Manifest:
+    # Files pushed to each controller, persisted as JSON:
+    #   {"version": 1, "controllers": {"host:port": {"remote/path": FileEntry}}}
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.controllers: Dict[str, Dict[str, FileEntry]] = {}
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, "r") as f:
+            content = json.load(f)
+
+        if content.get("version") != MANIFEST_VERSION:
+            logger.warning(f"Ignoring manifest {self.path} (version {content.get('version')})")
+            return
+
+        self.controllers = {
+            ctrl: {path: FileEntry(**entry) for path, entry in files.items()}
+            for ctrl, files in content.get("controllers", {}).items()
+        }
+
+    def save(self):
+        if self.path is None:
+            return
+
+        content = {
+            "version": MANIFEST_VERSION,
+            "controllers": {
+                ctrl: {path: asdict(entry) for path, entry in sorted(files.items())}
+                for ctrl, files in self.controllers.items()
+            },
+        }
+
+        # atomic write
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".manifest-", dir=directory)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(content, f, indent=1)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def files(self, ctrl: Controller) -> Dict[str, FileEntry]:
+        return self.controllers.setdefault(f"{ctrl.host}:{ctrl.port}", {})
+
+
+@dataclass
+class SyncResult:
+    uploaded: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    # files in the manifest which no longer exist locally (not deleted remotely)
+    removed: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+    bytes_uploaded: int = 0
+    duration: float = 0.0
+
+    def ok(self) -> bool:
+        return not self.failed
+
+    def __repr__(self) -> str:
+        return f"SyncResult(uploaded={len(self.uploaded)} [{self.bytes_uploaded} B] " \
+               f"unchanged={len(self.unchanged)} removed={len(self.removed)} " \
+               f"failed={len(self.failed)} in {self.duration:.3f} s)"
+
+
+def walk(local: str, remote: str, exclude: Iterable[str] = (".git",)) -> Iterator[Tuple[str, str]]:
+    # (local path, remote path) of every file below `local`
+    exclude = set(exclude)
+    for root, subdirs, files in os.walk(local):
+        subdirs[:] = sorted(d for d in subdirs if d not in exclude)
+
+        rel = os.path.relpath(root, local)
+        parts = [] if rel == os.curdir else rel.split(os.sep)
+        for file in sorted(files):
+            if file in exclude:
+                continue
+            yield os.path.join(root, file), posixpath.join(remote, *parts, file)
+
+
+def _entry(path: str, previous: Optional[FileEntry]) -> FileEntry:
+    st = os.stat(path)
+    if previous is not None and previous.size == st.st_size and previous.mtime_ns == st.st_mtime_ns:
+        return previous
+    return FileEntry(st.st_size, st.st_mtime_ns, file_digest(path))
+
+
+def _push(ctrl: Controller, src: str, dest: str, entry: FileEntry, verify: bool,
+          chunks_size: Optional[int]) -> Optional[str]:
+    # returns the error if the upload failed
+    resp = ctrl.upload(src, dest, chunks_size=chunks_size)
+    if resp.status_code != 200:
+        return f"upload failed: {resp.status_code} {resp.reason}"
+
+    if verify:
+        fd, tmp = tempfile.mkstemp(prefix="caniot-verify-")
+        os.close(fd)
+        try:
+            if not ctrl.download(dest.lstrip("/"), tmp, resume=False):
+                return "verify failed: download error"
+            if file_digest(tmp) != entry.sha256:
+                return "verify failed: content differs"
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    return None
+
+
+def sync_dir(ctrl: Controller, local: str, remote: str = "/",
+             manifest: Optional[str] = None,
+             workers: int = 4,
+             verify: bool = False,
+             force: bool = False,
+             exclude: Iterable[str] = (".git",),
+             chunks_size: Optional[int] = None) -> SyncResult:
+    # Upload the files of `local` which changed since the last sync to `remote`
+    # over up to `workers` concurrent connections (also capped by the
+    # controller pool size). If `verify` is set, uploaded files are
+    # downloaded back and compared. Without `manifest` everything is uploaded.
+    t0 = time.perf_counter()
+    result = SyncResult()
+
+    state = Manifest(manifest)
+    pushed = state.files(ctrl)
+
+    todo: List[Tuple[str, str, FileEntry]] = []
+    seen = set()
+    for src, dest in walk(local, remote, exclude):
+        seen.add(dest)
+        previous = pushed.get(dest)
+        entry = _entry(src, previous)
+        if not force and previous is not None and previous.sha256 == entry.sha256:
+            # touched but identical
+            pushed[dest] = entry
+            result.unchanged.append(dest)
+        else:
+            todo.append((src, dest, entry))
+
+    for dest in sorted(set(pushed) - seen):
+        del pushed[dest]
+        result.removed.append(dest)
+
+    def push(item: Tuple[str, str, FileEntry]) -> Optional[str]:
+        src, dest, entry = item
+        try:
+            return _push(ctrl, src, dest, entry, verify, chunks_size)
+        except Exception as e:
+            return str(e)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for (src, dest, entry), error in zip(todo, executor.map(push, todo)):
+            if error is None:
+                pushed[dest] = entry
+                result.uploaded.append(dest)
+                result.bytes_uploaded += entry.size
+                logger.info(f"Synced {src} to {dest} [{entry.size} B]")
+            else:
+                result.failed[dest] = error
+                logger.error(f"Failed to sync {src} to {dest}: {error}")
+
+    state.save()
+
+    result.duration = time.perf_counter() - t0
+    return result
@@ -0,0 +1,330 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Concurrent load generator for the controller HTTP server.
+#
+# N clients (one thread and one keep-alive connection each) issue a weighted
+# mix of requests, either back-to-back (closed loop) or at a target total
+# rate (open loop, latencies measured from the scheduled send time so that
+# a stalled server is not hidden by the clients waiting on it).
+
+from __future__ import annotations
+
+import math
+import random
+import threading
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, TextIO
+
+import requests
+
+from .caniot import DeviceId, Endpoint
+from .caniot_attributes import AttributeId
+from .controller import Controller
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistogram:
+    # HDR-style log-linear histogram of latencies recorded in microseconds,
+    # with `significant_digits` of precision over the whole range.
+    def __init__(self, significant_digits: int = 2):
+        largest = 2 * 10 ** significant_digits
+        self.sub_bucket_magnitude = max(int(math.ceil(math.log2(largest))) - 1, 0)
+        self.sub_bucket_count = 1 << (self.sub_bucket_magnitude + 1)
+
+        # lowest equivalent value -> count
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _lowest_equivalent(self, value: int) -> int:
+        bucket = max(value.bit_length() - (self.sub_bucket_magnitude + 1), 0)
+        return (value >> bucket) << bucket
+
+    def _highest_equivalent(self, value: int) -> int:
+        bucket = max(value.bit_length() - (self.sub_bucket_magnitude + 1), 0)
+        return self._lowest_equivalent(value) + (1 << bucket) - 1
+
+    def record(self, seconds: float, count: int = 1):
+        value = max(int(seconds * 1e6), 0)
+        key = self._lowest_equivalent(value)
+        self.counts[key] = self.counts.get(key, 0) + count
+        self.total += count
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: LatencyHistogram):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.total += other.total
+        if other.min is not None:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> float:
+        # latency in seconds at `percentile` (0 - 100)
+        if not self.total:
+            return 0.0
+        target = max(int(math.ceil(percentile / 100.0 * self.total)), 1)
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= target:
+                return min(self._highest_equivalent(key), self.max) / 1e6
+        return self.max / 1e6
+
+    def mean(self) -> float:
+        if not self.total:
+            return 0.0
+        return sum(k * c for k, c in self.counts.items()) / self.total / 1e6
+
+    def stddev(self) -> float:
+        if not self.total:
+            return 0.0
+        mean = self.mean() * 1e6
+        variance = sum(c * (k - mean) ** 2 for k, c in self.counts.items()) / self.total
+        return math.sqrt(variance) / 1e6
+
+    def export(self, out: TextIO, ticks_per_half_distance: int = 5, scale: float = 1000.0):
+        # Percentile distribution in the HdrHistogram text format
+        # (values in ms by default), readable by the HdrHistogram plotter.
+        out.write(f"{'Value':>12} {'Percentile':>14} {'TotalCount':>10} {'1/(1-Percentile)':>14}\n\n")
+
+        seen = 0
+        percentile_to_report = 0.0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            value = min(self._highest_equivalent(key), self.max) / 1e6 * scale
+
+            if seen == self.total:
+                out.write(f"{value:12.3f} {1.0:14.12f} {seen:10d} {math.inf:14.2f}\n")
+                break
+
+            while 100.0 * seen / self.total >= percentile_to_report:
+                inverse = 1.0 / (1.0 - percentile_to_report / 100.0)
+                out.write(f"{value:12.3f} {percentile_to_report / 100.0:14.12f} {seen:10d} {inverse:14.2f}\n")
+                half_distance = 2 ** (int(math.log2(100.0 / (100.0 - percentile_to_report))) + 1)
+                percentile_to_report += 100.0 / (half_distance * ticks_per_half_distance)
+
+        out.write(f"#[Mean    = {self.mean() * scale:12.3f}, StdDeviation   = {self.stddev() * scale:12.3f}]\n")
+        out.write(f"#[Max     = {self.max / 1e6 * scale:12.3f}, Total count    = {self.total:12d}]\n")
+        out.write(f"#[Buckets = {len(self.counts):12d}, SubBuckets     = {self.sub_bucket_count:12d}]\n")
+
+
+Route = Callable[[Controller], object]
+
+
+def default_routes(dids: List[int] = None) -> Dict[str, Route]:
+    dids = dids or [int(DeviceId(0, 1))]
+
+    return {
+        "info": lambda ctrl: ctrl.get_info(),
+        "devices": lambda ctrl: ctrl.get_devices_page(0),
+        "attribute": lambda ctrl: ctrl.caniot.read_attribute(random.choice(dids), AttributeId.NodeID),
+        "telemetry": lambda ctrl: ctrl.caniot.request_telemetry(random.choice(dids), Endpoint.BoardLevelControl),
+    }
+
+
+@dataclass
+class LoadReport:
+    clients: int
+    duration: float
+    requests: int = 0
+    errors: int = 0
+    connection_refused: int = 0
+    timeouts: int = 0
+    histogram: LatencyHistogram = field(default_factory=LatencyHistogram)
+    routes: Dict[str, LatencyHistogram] = field(default_factory=dict)
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.duration if self.duration else 0.0
+
+    def percentile(self, percentile: float) -> float:
+        return self.histogram.percentile(percentile)
+
+    def merge(self, other: LoadReport):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.connection_refused += other.connection_refused
+        self.timeouts += other.timeouts
+        self.histogram.merge(other.histogram)
+        for route, histogram in other.routes.items():
+            self.routes.setdefault(route, LatencyHistogram()).merge(histogram)
+
+    def __repr__(self) -> str:
+        ms = lambda s: f"{s * 1000:.1f} ms"
+        lines = [
+            f"{self.requests} requests in {self.duration:.2f} s with {self.clients} clients "
+            f"({self.throughput:.1f} req/s)",
+            f"latency p50={ms(self.percentile(50))} p90={ms(self.percentile(90))} "
+            f"p99={ms(self.percentile(99))} max={ms(self.histogram.max / 1e6)}",
+            f"errors={self.errors} connection refused={self.connection_refused} timeouts={self.timeouts}",
+        ]
+        for route, histogram in sorted(self.routes.items()):
+            lines.append(f"  {route:<10} n={histogram.total:<6} p50={ms(histogram.percentile(50))} "
+                         f"p99={ms(histogram.percentile(99))}")
+        return "\n".join(lines)
+
+
+class LoadGenerator:
+    def __init__(self, host: str, port: int = None,
+                 clients: int = 4,
+                 duration: float = 10.0,
+                 warmup: float = 1.0,
+                 rate: float = None,
+                 requests_per_client: int = None,
+                 mix: Dict[str, float] = None,
+                 routes: Dict[str, Route] = None,
+                 controller_factory: Callable[[], Controller] = None,
+                 refused_backoff: float = 0.01,
+                 quiet: bool = True):
+        self.host = host
+        self.port = port
+        self.clients = clients
+        self.duration = duration
+        self.warmup = warmup
+
+        # Open loop total request rate (req/s), closed loop if None
+        self.rate = rate
+
+        # Stop each client after this many measured requests (instead of
+        # duration), sent after the warmup
+        self.requests_per_client = requests_per_client
+
+        self.routes = routes if routes is not None else default_routes()
+        self.mix = mix if mix is not None else {"info": 1.0}
+        for route in self.mix:
+            if route not in self.routes:
+                raise ValueError(f"Unknown route: {route}")
+
+        # pause of a client after a refused connection (closed loop)
+        self.refused_backoff = refused_backoff
+
+        # silence the per request INFO lines of caniot.controller during the
+        # run, they would throttle the clients
+        self.quiet = quiet
+
+        # each client has its own controller, i.e. its own connection
+        self.controller_factory = controller_factory or \
+            (lambda: Controller(self.host, self.port, pool_size=1))
+
+    def _client(self, ctrl: Controller, barrier: threading.Barrier, start: List[float], report: LoadReport):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        rng = random.Random()
+
+        interval = self.clients / self.rate if self.rate else None
+
+        barrier.wait()
+        t_start = start[0]
+        t_measure = t_start + self.warmup
+        t_end = t_measure + self.duration
+
+        # spread the open loop clients over one interval
+        next_send = t_start + (rng.uniform(0, interval) if interval else 0.0)
+        measured = 0
+
+        while True:
+            if interval:
+                now = time.perf_counter()
+                if next_send > now:
+                    time.sleep(next_send - now)
+                t0 = next_send
+                next_send += interval
+            else:
+                t0 = time.perf_counter()
+
+            if self.requests_per_client is None:
+                if t0 >= t_end:
+                    break
+            elif measured >= self.requests_per_client:
+                break
+
+            route = rng.choices(names, weights)[0]
+
+            error = refused = timeout = False
+            try:
+                if self.routes[route](ctrl) is None:
+                    error = True
+            except requests.exceptions.Timeout:
+                timeout = True
+            except requests.exceptions.ConnectionError:
+                refused = True
+            except requests.exceptions.RequestException as e:
+                error = True
+                logger.debug(f"{route} failed: {e}")
+            except Exception as e:
+                # a failing route must not end the client
+                error = True
+                logger.debug(f"{route} failed: {e!r}", exc_info=True)
+            t1 = time.perf_counter()
+
+            if refused and not interval and self.refused_backoff:
+                time.sleep(self.refused_backoff)
+
+            if t0 < t_measure:
+                continue
+
+            measured += 1
+            report.requests += 1
+            report.errors += error
+            report.connection_refused += refused
+            report.timeouts += timeout
+            if not (error or refused or timeout):
+                report.histogram.record(t1 - t0)
+                report.routes.setdefault(route, LatencyHistogram()).record(t1 - t0)
+
+    def run(self) -> LoadReport:
+        ctrl_logger = logging.getLogger("caniot.controller")
+        level = ctrl_logger.level
+        if self.quiet:
+            ctrl_logger.setLevel(max(level, logging.WARNING))
+        try:
+            return self._run()
+        finally:
+            ctrl_logger.setLevel(level)
+
+    def _run(self) -> LoadReport:
+        barrier = threading.Barrier(self.clients + 1)
+        start = [0.0]
+        reports = [LoadReport(1, 0.0) for _ in range(self.clients)]
+
+        # controllers are set up before the clients start, a failing one
+        # raises here instead of leaving the others waiting on the barrier
+        with ExitStack() as stack:
+            controllers = [stack.enter_context(self.controller_factory())
+                           for _ in range(self.clients)]
+
+            threads = [
+                threading.Thread(target=self._client, args=(controllers[i], barrier, start, reports[i]),
+                                 daemon=True)
+                for i in range(self.clients)
+            ]
+            for thread in threads:
+                thread.start()
+
+            start[0] = time.perf_counter()
+            barrier.wait()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start[0]
+
+        if self.requests_per_client is None:
+            duration = self.duration
+        else:
+            # measured from the end of the warmup
+            duration = max(elapsed - self.warmup, 0.0)
+
+        report = LoadReport(self.clients, duration)
+        for client_report in reports:
+            report.merge(client_report)
+        return report
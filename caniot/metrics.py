@@ -0,0 +1,441 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Parser and scraper for the controller metrics (Prometheus text format).
+#
+# The parser works line by line on the streamed response, so a scrape never
+# holds the whole body. Label sets are interned: the raw "{...}" text is
+# parsed once into a tuple of (name, value) pairs, which later scrapes reuse
+# as is, so series keys are the same objects from one scrape to the next.
+#
+# The scraper polls several controllers concurrently, computes the deltas of
+# the counters between scrapes (resets handled), optionally appends them to a
+# TimeSeriesStore and can re-export the last scrape of all the controllers,
+# labelled by controller.
+
+from __future__ import annotations
+
+import io
+import math
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import (TYPE_CHECKING, Dict, Hashable, Iterable, Iterator, List, NamedTuple,
+                    Optional, TextIO, Tuple, Union)
+
+import requests
+
+if TYPE_CHECKING:
+    from .controller import Controller
+    from .timeseries import TimeSeriesStore
+
+import logging
+logger = logging.getLogger(__name__)
+
+# (("handler", "api/devices"), ...)
+Labels = Tuple[Tuple[str, str], ...]
+# (metric name, labels)
+SeriesId = Tuple[str, Labels]
+
+NO_LABELS: Labels = ()
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+SUMMARY = "summary"
+UNTYPED = "untyped"
+
+# suffixes of the samples of histograms and summaries, all cumulative
+CUMULATIVE_SUFFIXES = ("_bucket", "_count", "_sum")
+
+_LABEL_RE = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*"((?:[^"\\]|\\.)*)"\s*,?')
+_ESCAPES = {"\\\\": "\\", '\\"': '"', "\\n": "\n"}
+_ESCAPE_RE = re.compile(r'\\[\\"n]')
+
+
+class MetricsParseError(Exception):
+    pass
+
+
+class Sample(NamedTuple):
+    name: str
+    labels: Labels
+    value: float
+    # ms since epoch, if given by the exporter
+    timestamp: Optional[int] = None
+
+
+def _unescape(value: str) -> str:
+    if "\\" not in value:
+        return value
+    return _ESCAPE_RE.sub(lambda m: _ESCAPES[m.group(0)], value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+
+
+class MetricsParser:
+    def __init__(self, labels_cache: Dict[str, Labels] = None, max_labels: int = 65536):
+        # raw label text -> interned labels, may be shared between parsers
+        self.labels_cache = labels_cache if labels_cache is not None else {}
+        self.max_labels = max_labels
+
+        # metric family -> type / help, from the last scrape (see begin())
+        self.types: Dict[str, str] = {}
+        self.help: Dict[str, str] = {}
+
+        # tables filled by parse_line(), the current ones outside of a scrape
+        self._types, self._help = self.types, self.help
+
+    def begin(self):
+        # Start a scrape: its families are collected in new tables, which
+        # replace the current ones at commit(), once the body was entirely
+        # read. The current tables are never modified meanwhile (they may be
+        # read from other threads).
+        self._types, self._help = {}, {}
+
+    def commit(self):
+        self.types, self.help = self._types, self._help
+
+    def reset(self):
+        # forget the families of the previous scrape
+        self.begin()
+        self.commit()
+
+    def labels(self, raw: str) -> Labels:
+        labels = self.labels_cache.get(raw)
+        if labels is None:
+            labels = self._parse_labels(raw)
+            if len(self.labels_cache) >= self.max_labels:
+                # label values are unbounded (e.g. a changing id), don't grow forever
+                self.labels_cache.clear()
+            self.labels_cache[raw] = labels
+        return labels
+
+    @staticmethod
+    def _parse_labels(raw: str) -> Labels:
+        labels = []
+        pos = 0
+        while pos < len(raw):
+            m = _LABEL_RE.match(raw, pos)
+            if m is None:
+                if raw[pos:].strip():
+                    raise MetricsParseError(f"Invalid labels {{{raw}}}")
+                break
+            labels.append((m.group(1), _unescape(m.group(2))))
+            pos = m.end()
+        return tuple(labels)
+
+    def family(self, name: str) -> str:
+        # metric family of a sample name (e.g. "x" for "x_bucket" of histogram "x")
+        if name in self.types:
+            return name
+        for suffix in CUMULATIVE_SUFFIXES:
+            if name.endswith(suffix) and name[:-len(suffix)] in self.types:
+                return name[:-len(suffix)]
+        return name
+
+    def type(self, name: str) -> str:
+        return self.types.get(self.family(name), UNTYPED)
+
+    def cumulative(self, name: str) -> bool:
+        # the sample only increases (deltas are meaningful)
+        family = self.family(name)
+        kind = self.types.get(family, UNTYPED)
+        if kind == COUNTER:
+            return True
+        if kind in (HISTOGRAM, SUMMARY):
+            return family != name
+        return kind == UNTYPED and name.endswith("_total")
+
+    def parse_line(self, line: Union[str, bytes]) -> Optional[Sample]:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            return None
+
+        if line[0] == "#":
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] in ("TYPE", "HELP"):
+                if parts[1] == "TYPE":
+                    self._types[parts[2]] = parts[3].strip() if len(parts) > 3 else UNTYPED
+                else:
+                    self._help[parts[2]] = parts[3] if len(parts) > 3 else ""
+            return None
+
+        brace = line.find("{")
+        if brace >= 0:
+            # values and timestamps never contain "}", label values may
+            end = line.rfind("}")
+            if end < brace:
+                raise MetricsParseError(f"Invalid sample: {line}")
+            name = line[:brace].strip()
+            labels = self.labels(line[brace + 1:end])
+            rest = line[end + 1:].split()
+        else:
+            parts = line.split()
+            name, labels, rest = parts[0], NO_LABELS, parts[1:]
+
+        if not rest or len(rest) > 2:
+            raise MetricsParseError(f"Invalid sample: {line}")
+        try:
+            value = float(rest[0])
+            timestamp = int(rest[1]) if len(rest) > 1 else None
+        except ValueError:
+            raise MetricsParseError(f"Invalid sample: {line}")
+
+        return Sample(name, labels, value, timestamp)
+
+    def parse(self, lines: Iterable[Union[str, bytes]]) -> Iterator[Sample]:
+        # Invalid lines are logged and skipped
+        for line in lines:
+            try:
+                sample = self.parse_line(line)
+            except (MetricsParseError, UnicodeDecodeError) as e:
+                logger.warning(f"{e}")
+                continue
+            if sample is not None:
+                yield sample
+
+
+def parse_metrics(text: str, parser: MetricsParser = None) -> List[Sample]:
+    parser = parser if parser is not None else MetricsParser()
+    parser.begin()
+    samples = list(parser.parse(text.splitlines()))
+    parser.commit()
+    return samples
+
+
+def iter_metrics(ctrl: Controller, parser: MetricsParser = None,
+                 chunk_size: int = 4096) -> Iterator[Sample]:
+    # Stream and parse GET /metrics, raises requests exceptions. The parser
+    # families are updated once the whole body is read.
+    parser = parser if parser is not None else MetricsParser()
+    resp = ctrl._req("GET", ctrl.url.sub("metrics"), stream=True)
+    with resp:
+        resp.raise_for_status()
+        parser.begin()
+        yield from parser.parse(resp.iter_lines(chunk_size=chunk_size))
+        parser.commit()
+
+
+class _Series:
+    __slots__ = ("value", "delta", "field", "seen")
+
+    def __init__(self, value: float, field: str):
+        self.value = value
+        # increase during the last scrape interval, None for gauges and for
+        # the series of the first scrape (no previous value)
+        self.delta: Optional[float] = None
+        # key of the series in the store
+        self.field = field
+        self.seen = 0
+
+
+@dataclass
+class ScrapeTarget:
+    ctrl: Controller
+    name: Hashable
+    parser: MetricsParser
+
+    series: Dict[SeriesId, _Series] = field(default_factory=dict)
+    scrapes: int = 0
+    errors: int = 0
+    resets: int = 0
+    # duration of the last scrape (s) and its number of samples
+    duration: float = 0.0
+    samples: int = 0
+    last_scrape: Optional[float] = None
+
+    def deltas(self) -> Dict[SeriesId, float]:
+        # increase of the cumulative series during the last scrape interval
+        return {sid: s.delta for sid, s in self.series.items()
+                if s.delta is not None and self.parser.cumulative(sid[0])}
+
+    def values(self) -> Dict[SeriesId, float]:
+        return {sid: s.value for sid, s in self.series.items()}
+
+
+class MetricsScraper:
+    def __init__(self, period: float = 10.0, workers: int = 8, store: TimeSeriesStore = None,
+                 chunk_size: int = 4096):
+        self.period = period
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+        # if given, counter deltas and gauge values are appended to the store
+        # as (target, None, 'name{labels}')
+        self.store = store
+
+        # label sets interned across all the targets
+        self.labels_cache: Dict[str, Labels] = {}
+        self.targets: Dict[Hashable, ScrapeTarget] = {}
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def add(self, ctrl: Controller, name: Hashable = None) -> ScrapeTarget:
+        name = name if name is not None else f"{ctrl.host}:{ctrl.port}"
+        target = ScrapeTarget(ctrl, name, MetricsParser(self.labels_cache))
+        self.targets[name] = target
+        return target
+
+    def remove(self, name: Hashable) -> bool:
+        return self.targets.pop(name, None) is not None
+
+    def _scrape(self, target: ScrapeTarget, timestamp: float) -> bool:
+        t0 = time.perf_counter()
+        scrape = target.scrapes + 1
+        series = target.series
+        parser = target.parser
+
+        # Nothing is updated until the whole body is read: a scrape failing
+        # midway must not advance part of the series (their increase would
+        # be lost), nor the parser families.
+        try:
+            samples = list(iter_metrics(target.ctrl, parser, self.chunk_size))
+        except (requests.exceptions.RequestException, UnicodeDecodeError) as e:
+            target.errors += 1
+            logger.debug(f"Scraping {target.name} failed: {e}")
+            return False
+
+        for sample in samples:
+            sid = (sample.name, sample.labels)
+            s = series.get(sid)
+            cumulative = parser.cumulative(sample.name)
+            if s is None:
+                s = series[sid] = _Series(sample.value, sample.name + format_labels(sample.labels))
+                if cumulative and target.scrapes:
+                    # appeared since the first scrape, counted from 0
+                    s.delta = sample.value
+            elif cumulative:
+                if sample.value >= s.value:
+                    s.delta = sample.value - s.value
+                else:
+                    # the exporter restarted
+                    s.delta = sample.value
+                    target.resets += 1
+                s.value = sample.value
+            else:
+                s.value = sample.value
+                s.delta = None
+            s.seen = scrape
+        count = len(samples)
+
+        # forget the series which disappeared
+        if len(series) != count:
+            for sid in [sid for sid, s in series.items() if s.seen != scrape]:
+                del series[sid]
+
+        target.scrapes = scrape
+        target.samples = count
+        target.duration = time.perf_counter() - t0
+        target.last_scrape = timestamp
+
+        if self.store is not None:
+            for (name, _), s in series.items():
+                if not parser.cumulative(name):
+                    self.store.append((target.name, None, s.field), s.value, timestamp)
+                elif s.delta is not None:
+                    self.store.append((target.name, None, s.field), s.delta, timestamp)
+
+        return True
+
+    def scrape(self) -> int:
+        # Scrape all the targets concurrently, returns the number of successes
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix="caniot-metrics")
+
+        timestamp = time.time()
+        targets = list(self.targets.values())
+        return sum(self._executor.map(lambda t: self._scrape(t, timestamp), targets))
+
+    def export(self, out: TextIO, label: str = "controller"):
+        # Last values of all the targets in the text format, each sample
+        # labelled with its target
+        families: Dict[str, List[Tuple[ScrapeTarget, SeriesId, _Series]]] = {}
+        for target in list(self.targets.values()):
+            for sid, s in list(target.series.items()):
+                families.setdefault(target.parser.family(sid[0]), []).append((target, sid, s))
+
+        for family, entries in families.items():
+            parser = entries[0][0].parser
+            if family in parser.help:
+                out.write(f"# HELP {family} {parser.help[family]}\n")
+            if family in parser.types:
+                out.write(f"# TYPE {family} {parser.types[family]}\n")
+            for target, (name, labels), s in entries:
+                labels = ((label, str(target.name)),) + labels
+                out.write(f"{name}{format_labels(labels)} {format_value(s.value)}\n")
+
+    def exposition(self, label: str = "controller") -> str:
+        out = io.StringIO()
+        self.export(out, label)
+        return out.getvalue()
+
+    def stats(self) -> Dict[str, int]:
+        targets = list(self.targets.values())
+        return {
+            "targets": len(targets),
+            "series": sum(len(t.series) for t in targets),
+            "labels": len(self.labels_cache),
+            "errors": sum(t.errors for t in targets),
+            "resets": sum(t.resets for t in targets),
+        }
+
+    def _run(self):
+        next_tick = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                self.scrape()
+            except Exception as e:
+                # keep scraping
+                logger.exception(f"Metrics scrape failed: {e}")
+            next_tick += self.period
+            self._stop.wait(max(next_tick - time.monotonic(), 0.0))
+
+    def start(self) -> threading.Thread:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True, name="caniot-metrics-scraper")
+            self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
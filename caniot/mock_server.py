@@ -0,0 +1,486 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Local stand-in for the controller HTTP server, covering the REST routes
+# used by Controller, CaniotAPI and TestClient. CANIOT devices are
+# SimulatedNode instances, served with their own latency and drop rate and
+# the Timeout-ms request header semantics of the controller.
+
+from __future__ import annotations
+
+import json
+import random
+import re
+import struct
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from .can import CanFrame
+from .caniot import DeviceId, Endpoint, FrameType, MsgId, QueryType
+from .correlator import ERROR_BITS, error_code
+from .simulator import SimulatedNode
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT_MS = 1000
+DEVICES_PAGE_SIZE = 4
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, controller: MockController):
+        self.controller = controller
+        self._active = 0
+        self._active_lock = threading.Lock()
+        super().__init__(address, handler)
+
+    def process_request(self, request, client_address):
+        # Emulates the small socket table of the controller: connections
+        # beyond `max_connections` are closed right away.
+        with self._active_lock:
+            self._active += 1
+            refused = self.controller.max_connections is not None and \
+                self._active > self.controller.max_connections
+        if refused:
+            self.controller.count("connections_refused")
+            self.shutdown_request(request)
+        else:
+            self.controller.count("connections")
+            super().process_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # clients dropping keep-alive connections are not errors
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            logger.debug(f"Connection from {client_address} closed by peer")
+        else:
+            super().handle_error(request, client_address)
+
+    def shutdown_request(self, request):
+        with self._active_lock:
+            self._active -= 1
+        super().shutdown_request(request)
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, avoid the Nagle/delayed ACK stall
+    disable_nagle_algorithm = True
+    server: MockHTTPServer
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                if size == 0:
+                    # trailers
+                    while self.rfile.readline() not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def reply(self, status: int, body=None, content_type: str = "application/json",
+              headers: Dict[str, str] = None):
+        if body is None:
+            payload = b""
+        elif isinstance(body, bytes):
+            payload = body
+        elif isinstance(body, str):
+            payload = body.encode()
+        else:
+            payload = json.dumps(body).encode()
+
+        self.send_response(status)
+        if payload:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if payload and self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def dispatch(self):
+        ctrl = self.server.controller
+        body = self.read_body()
+        ctrl.delay()
+
+        url = urlparse(self.path)
+        path = url.path.strip("/")
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        ctrl.count("requests")
+        if time.monotonic() < ctrl._down_until:
+            # rebooting
+            self.reply(503, {"error": "rebooting"})
+            return
+
+        for method, pattern, handler in ctrl.routes:
+            if method != self.command:
+                continue
+            m = pattern.fullmatch(path)
+            if m is not None:
+                ctrl.count_route(handler.__name__)
+                try:
+                    handler(self, body=body, query=query, **m.groupdict())
+                except Exception as e:
+                    logger.exception(f"{self.command} {self.path}: {e}")
+                    self.reply(500, {"error": str(e)})
+                return
+
+        self.reply(404, {"error": "not found"})
+
+    do_GET = do_POST = do_PUT = do_DELETE = dispatch
+
+
+class MockController:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0,
+                 max_connections: int = None,
+                 nodes: List[SimulatedNode] = None,
+                 dfu_delay: float = 0.0,
+                 reboot_delay: float = 0.5):
+        # HTTP latency added to every request (seconds)
+        self.latency = latency
+        self.jitter = jitter
+        self.max_connections = max_connections
+
+        self.nodes: Dict[int, SimulatedNode] = {int(n.did): n for n in (nodes or [])}
+        self.files: Dict[str, bytes] = {}
+        self.can_frames: List[CanFrame] = []
+        self.start_time = time.time()
+
+        # (did, ep) -> timestamp of the last telemetry
+        self.last_events: Dict[Tuple[int, int], int] = {}
+
+        self.dfu_status = {
+            "mcuboot_version": 1,
+            "image_size": 0,
+            "version_major": 0,
+            "version_minor": 1,
+            "version_revision": 0,
+            "version_build": 0,
+        }
+        # an uploaded image shows in the DFU status after `dfu_delay` seconds
+        self.dfu_delay = dfu_delay
+        self.dfu_image: Optional[bytes] = None
+        self._dfu_pending: Optional[Tuple[float, dict]] = None
+
+        # after api/reboot, requests fail (503) for `reboot_delay` seconds
+        self.reboot_delay = reboot_delay
+        self._down_until = 0.0
+
+        self.stats: Dict[str, int] = {
+            "requests": 0,
+            "connections": 0,
+            "connections_refused": 0,
+            "can_tx": 0,
+            "can_rx": 0,
+            "caniot_timeouts": 0,
+        }
+        self.route_stats: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+
+        self.routes: List[Tuple[str, re.Pattern, Callable]] = []
+        self._register_routes()
+
+        self.httpd = MockHTTPServer((host, port), MockRequestHandler, self)
+        self.host, self.port = self.httpd.server_address[:2]
+        self._thread: Optional[threading.Thread] = None
+
+    def add_node(self, did, **kwargs) -> SimulatedNode:
+        node = SimulatedNode(did, **kwargs)
+        self.nodes[int(node.did)] = node
+        return node
+
+    def route(self, method: str, pattern: str, handler: Callable):
+        self.routes.append((method, re.compile(pattern), handler))
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.stats[name] += n
+
+    def count_route(self, route: str):
+        with self._lock:
+            self.route_stats[route] = self.route_stats.get(route, 0) + 1
+
+    def delay(self):
+        delay = self.latency + (self._rng.uniform(0, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _register_routes(self):
+        caniot = r"api/devices/caniot/(?P<did>\d+)"
+
+        self.route("GET", r"api/info", self.get_info)
+        self.route("GET", r"api/devices", self.get_devices)
+        self.route("GET", r"api/ha/stats", self.get_ha_stats)
+        self.route("GET", r"api/room/(?P<room_id>\d+)", self.get_room)
+        self.route("GET", r"metrics", self.get_metrics)
+        self.route("GET", r"api/dfu", self.get_dfu)
+        self.route("POST", r"api/dfu", self.post_dfu)
+        self.route("POST", r"api/reboot", self.post_reboot)
+        self.route("GET", r"api/files/(?P<filepath>.+)", self.get_file)
+        self.route("POST", r"api/files/(?P<filepath>.+)", self.post_file)
+        self.route("POST", r"api/if/can/(?P<arbitration_id>[0-9a-fA-F]+)", self.post_can)
+
+        self.route("GET", caniot + r"/endpoint/(?P<ep>\d+)/telemetry", self.caniot_telemetry)
+        self.route("POST", caniot + r"/endpoint/(?P<ep>\d+)/command", self.caniot_command)
+        self.route("POST", caniot + r"/endpoint/blc1/command", self.caniot_command_cls1)
+        self.route("GET", caniot + r"/attribute/(?P<key>[0-9a-fA-F]+)", self.caniot_read_attribute)
+        self.route("PUT", caniot + r"/attribute/(?P<key>[0-9a-fA-F]+)", self.caniot_write_attribute)
+        self.route("POST", caniot + r"/factory_reset", self.caniot_reset)
+        self.route("POST", caniot + r"/reboot", self.caniot_reset)
+
+        self.route("POST", r"api/test/messaging", self.test_checksum)
+        self.route("POST", r"api/test/streaming", self.test_checksum)
+        self.route("GET", r"api/test/route_args/(?P<a>\d+)/(?P<b>\d+)/(?P<c>\d+)", self.test_route_args)
+        self.route("GET", r"api/test/headers", self.test_headers)
+
+    # Controller routes
+
+    def get_info(self, h: MockRequestHandler, **kwargs):
+        h.reply(200, {
+            "uptime": int(time.time() - self.start_time),
+            "devices": len(self.nodes),
+            "mock": True,
+        })
+
+    def _device_entry(self, node: SimulatedNode) -> dict:
+        did = int(node.did)
+        return {
+            "addr_type": "caniot",
+            "addr_medium": "can",
+            "addr_repr": f"0x{did:02X}",
+            "endpoints": [
+                {"last_event": {"timestamp": self.last_events.get((did, int(ep)), 0)}}
+                for ep in Endpoint
+            ],
+        }
+
+    def get_devices(self, h: MockRequestHandler, query: dict, **kwargs):
+        page = int(query.get("page", 0))
+        nodes = sorted(self.nodes.values(), key=lambda n: int(n.did))
+        page_nodes = nodes[page * DEVICES_PAGE_SIZE:(page + 1) * DEVICES_PAGE_SIZE]
+        h.reply(200, [self._device_entry(node) for node in page_nodes])
+
+    def get_ha_stats(self, h: MockRequestHandler, **kwargs):
+        with self._lock:
+            stats = dict(self.stats)
+        h.reply(200, stats)
+
+    def get_room(self, h: MockRequestHandler, room_id: str, **kwargs):
+        h.reply(200, {"room_id": int(room_id), "devices": []})
+
+    def get_metrics(self, h: MockRequestHandler, **kwargs):
+        lines = [
+            "# HELP caniot_requests_total Total number of HTTP requests",
+            "# TYPE caniot_requests_total counter",
+        ]
+        with self._lock:
+            route_stats = dict(self.route_stats)
+        for route, count in sorted(route_stats.items()):
+            lines.append(f'caniot_requests_total{{handler="{route}"}} {count}')
+        lines += [
+            "# HELP caniot_connections_refused_total Connections refused",
+            "# TYPE caniot_connections_refused_total counter",
+            f"caniot_connections_refused_total {self.stats['connections_refused']}",
+            "# HELP caniot_uptime_seconds Uptime",
+            "# TYPE caniot_uptime_seconds gauge",
+            f"caniot_uptime_seconds {time.time() - self.start_time:.3f}",
+        ]
+        h.reply(200, "\n".join(lines) + "\n", content_type="text/plain; version=0.0.4")
+
+    def get_dfu(self, h: MockRequestHandler, **kwargs):
+        with self._lock:
+            if self._dfu_pending is not None and time.monotonic() >= self._dfu_pending[0]:
+                self.dfu_status = self._dfu_pending[1]
+                self._dfu_pending = None
+            status = dict(self.dfu_status)
+        h.reply(200, status)
+
+    def post_dfu(self, h: MockRequestHandler, body: bytes, **kwargs):
+        status = dict(self.dfu_status, image_size=len(body),
+                      version_build=self.dfu_status["version_build"] + 1)
+        with self._lock:
+            self.dfu_image = body
+            self._dfu_pending = (time.monotonic() + self.dfu_delay, status)
+        h.reply(200, {"size": len(body)})
+
+    def post_reboot(self, h: MockRequestHandler, **kwargs):
+        # down for `reboot_delay` seconds once this reply is sent
+        self._down_until = time.monotonic() + self.reboot_delay
+        self.start_time = time.time() + self.reboot_delay
+        h.reply(200, {})
+
+    def get_file(self, h: MockRequestHandler, filepath: str, **kwargs):
+        content = self.files.get(filepath.strip("/"))
+        if content is None:
+            h.reply(404, {"error": "not found"})
+            return
+
+        etag = f'"{len(content):x}-{zlib.crc32(content):08x}"'
+        validators = {"Accept-Ranges": "bytes", "ETag": etag}
+
+        # single "bytes=start-[end]" ranges only, ignored (full content) if
+        # the If-Range validator does not match
+        m = re.fullmatch(r"bytes=(\d+)-(\d*)", h.headers.get("Range", "").strip())
+        if_range = h.headers.get("If-Range")
+        if m is None or (if_range is not None and if_range != etag):
+            h.reply(200, content, content_type="application/octet-stream", headers=validators)
+            return
+
+        start = int(m.group(1))
+        end = min(int(m.group(2)), len(content) - 1) if m.group(2) else len(content) - 1
+        if start >= len(content) or start > end:
+            h.reply(416, headers={"Content-Range": f"bytes */{len(content)}", **validators})
+        else:
+            h.reply(206, content[start:end + 1], content_type="application/octet-stream",
+                    headers={"Content-Range": f"bytes {start}-{end}/{len(content)}", **validators})
+
+    def post_file(self, h: MockRequestHandler, filepath: str, body: bytes, **kwargs):
+        self.files[filepath.strip("/")] = body
+        h.reply(200, {"path": filepath, "size": len(body)})
+
+    def post_can(self, h: MockRequestHandler, arbitration_id: str, body: bytes, **kwargs):
+        frame = CanFrame(int(arbitration_id, 16), bytes(json.loads(body or b"[]")))
+        self.can_frames.append(frame)
+        self.count("can_tx")
+        h.reply(200, {})
+
+    # CANIOT routes
+
+    def _timeout(self, h: MockRequestHandler) -> float:
+        return int(h.headers.get("Timeout-ms", DEFAULT_TIMEOUT_MS)) / 1000.0
+
+    def _caniot_query(self, h: MockRequestHandler, did: str, frame_type: FrameType,
+                      ep: int, data: bytes):
+        timeout = self._timeout(h)
+        node = self.nodes.get(int(did))
+
+        query = MsgId(frame_type, QueryType.Query, DeviceId.from_int(int(did)), Endpoint(ep))
+        self.count("can_tx")
+
+        if node is None or (node.drop_rate and self._rng.random() < node.drop_rate):
+            delay = None
+        else:
+            delay = max(0.0, node.latency + self._rng.uniform(-node.jitter, node.jitter))
+
+        if delay is None or delay > timeout:
+            time.sleep(timeout)
+            self.count("caniot_timeouts")
+            h.reply(504, {"error": "timeout", "timeout_ms": int(timeout * 1000)})
+            return None
+
+        time.sleep(delay)
+        with self._lock:
+            frames = node.handle(CanFrame(int(query), data))
+        self.count("can_rx", len(frames))
+
+        response = frames[0]
+        if response.arbitration_id & 0b111 == ERROR_BITS:
+            h.reply(400, {"error": error_code(response.data)})
+            return None
+
+        return response
+
+    def _reply_telemetry(self, h: MockRequestHandler, response: CanFrame):
+        msgid = MsgId.from_int(response.arbitration_id)
+        did, ep = int(msgid.device_id), int(msgid.endpoint)
+        self.last_events[(did, ep)] = int(time.time())
+        h.reply(200, {"did": did, "ep": ep, "payload": list(response.data)})
+
+    def _reply_attribute(self, h: MockRequestHandler, did: str, response: CanFrame):
+        key, value = struct.unpack_from("<HI", response.data)
+        h.reply(200, {"did": int(did), "key": key, "value": value})
+
+    def caniot_telemetry(self, h: MockRequestHandler, did: str, ep: str, **kwargs):
+        response = self._caniot_query(h, did, FrameType.Telemetry, int(ep), b"")
+        if response is not None:
+            self._reply_telemetry(h, response)
+
+    def caniot_command(self, h: MockRequestHandler, did: str, ep: str, body: bytes, **kwargs):
+        data = bytes(json.loads(body or b"[]"))
+        response = self._caniot_query(h, did, FrameType.Command, int(ep), data)
+        if response is not None:
+            self._reply_telemetry(h, response)
+
+    def caniot_command_cls1(self, h: MockRequestHandler, did: str, body: bytes, **kwargs):
+        # XPS commands are not encoded, the board state is left untouched
+        response = self._caniot_query(h, did, FrameType.Telemetry, Endpoint.BoardLevelControl, b"")
+        if response is not None:
+            self._reply_telemetry(h, response)
+
+    def caniot_read_attribute(self, h: MockRequestHandler, did: str, key: str, **kwargs):
+        data = struct.pack("<H", int(key, 16))
+        response = self._caniot_query(h, did, FrameType.ReadAttribute, Endpoint.ApplicationMain, data)
+        if response is not None:
+            self._reply_attribute(h, did, response)
+
+    def caniot_write_attribute(self, h: MockRequestHandler, did: str, key: str, body: bytes, **kwargs):
+        value = json.loads(body)["value"]
+        value = int(value, 0) if isinstance(value, str) else int(value)
+        data = struct.pack("<HI", int(key, 16), value & 0xFFFFFFFF)
+        response = self._caniot_query(h, did, FrameType.WriteAttribute, Endpoint.ApplicationMain, data)
+        if response is not None:
+            self._reply_attribute(h, did, response)
+
+    def caniot_reset(self, h: MockRequestHandler, did: str, **kwargs):
+        node = self.nodes.get(int(did))
+        if node is None:
+            h.reply(404, {"error": "unknown device"})
+        else:
+            with self._lock:
+                node.reset()
+            h.reply(204)
+
+    # Test routes
+
+    def test_checksum(self, h: MockRequestHandler, body: bytes, **kwargs):
+        h.reply(200, {"payload_len": len(body), "payload_checksum": sum(body)})
+
+    def test_route_args(self, h: MockRequestHandler, a: str, b: str, c: str, query: dict, **kwargs):
+        h.reply(200, {"a": int(a), "b": int(b), "c": int(c), "query": query})
+
+    def test_headers(self, h: MockRequestHandler, **kwargs):
+        h.reply(200, dict(h.headers.items()))
+
+    # Server
+
+    def start(self) -> MockController:
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True,
+                                        name="caniot-mock-controller")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
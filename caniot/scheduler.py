@@ -0,0 +1,285 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Periodic telemetry polling of a fleet of CANIOT devices.
+#
+# Targets (device, endpoint, period) are spread over their period (golden
+# ratio phases, so that adding targets keeps the spread even) with some
+# jitter, the number of requests in flight is capped per API (i.e. per
+# controller) and devices which time out are polled less often (exponential
+# backoff) until they answer again. Results are delivered to subscribed
+# callbacks and to async iterators.
+#
+# The scheduler runs on an asyncio loop, it accepts both CaniotAPI (calls run
+# in the loop executor) and AsyncCaniotAPI.
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
+
+from .caniot import DeviceId, Endpoint
+
+import logging
+logger = logging.getLogger(__name__)
+
+GOLDEN_RATIO_CONJUGATE = 0.6180339887498949
+
+
+@dataclass
+class TelemetryResult:
+    did: int
+    ep: int
+    # telemetry as returned by the API, None on failure
+    value: Optional[dict]
+    timestamp: float
+    latency: float
+    error: Optional[str] = None
+
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class TelemetryTarget:
+    api: object
+    did: int
+    ep: int
+    period: float
+
+    # scheduling state
+    due: float = 0.0
+    failures: int = 0
+    removed: bool = False
+
+    polls: int = 0
+    errors: int = 0
+
+    @property
+    def key(self) -> Tuple[int, int, int]:
+        return id(self.api), self.did, self.ep
+
+
+ResultCallback = Callable[[TelemetryResult], object]
+
+
+class TelemetryScheduler:
+    def __init__(self, api=None,
+                 max_inflight: int = 4,
+                 jitter: float = 0.05,
+                 backoff_max: float = 300.0,
+                 queue_size: int = 1024,
+                 seed: int = None):
+        # default API of the targets
+        self.api = api
+
+        # per API (controller) cap of concurrent requests
+        self.max_inflight = max_inflight
+
+        # random delay added to each period, as a fraction of the period
+        self.jitter = jitter
+
+        # maximum polling interval of a failing device (s)
+        self.backoff_max = backoff_max
+
+        self.queue_size = queue_size
+        self.rng = random.Random(seed)
+
+        self.targets: Dict[Tuple[int, int, int], TelemetryTarget] = {}
+        self._heap: List[Tuple[float, int, TelemetryTarget]] = []
+        self._seq = itertools.count()
+        self._phase = 0.0
+
+        self._slots: Dict[int, asyncio.Semaphore] = {}
+        self._callbacks: List[ResultCallback] = []
+        self._queues: List[asyncio.Queue] = []
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._requests: set = set()
+
+    # targets
+
+    def _push(self, target: TelemetryTarget):
+        heapq.heappush(self._heap, (target.due, next(self._seq), target))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def add(self, did: Union[DeviceId, int], ep: Union[Endpoint, int], period: float,
+            api=None) -> TelemetryTarget:
+        api = api if api is not None else self.api
+        if api is None:
+            raise ValueError("No API given for the target")
+
+        target = TelemetryTarget(api, int(did), int(ep), period)
+        previous = self.targets.pop(target.key, None)
+        if previous is not None:
+            previous.removed = True
+
+        # low discrepancy phase within the period
+        self._phase = (self._phase + GOLDEN_RATIO_CONJUGATE) % 1.0
+        target.due = time.monotonic() + self._phase * period
+
+        self.targets[target.key] = target
+        self._push(target)
+        return target
+
+    def remove(self, did: Union[DeviceId, int], ep: Union[Endpoint, int], api=None) -> bool:
+        api = api if api is not None else self.api
+        target = self.targets.pop((id(api), int(did), int(ep)), None)
+        if target is None:
+            return False
+        target.removed = True
+        return True
+
+    # results
+
+    def subscribe(self, callback: ResultCallback) -> ResultCallback:
+        # callback(result), may be a coroutine function
+        self._callbacks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback: ResultCallback):
+        self._callbacks.remove(callback)
+
+    async def results(self) -> AsyncIterator[TelemetryResult]:
+        # results are dropped (oldest first) if the consumer does not keep up
+        queue: asyncio.Queue = asyncio.Queue(self.queue_size)
+        self._queues.append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._queues.remove(queue)
+
+    def __aiter__(self) -> AsyncIterator[TelemetryResult]:
+        return self.results()
+
+    async def _deliver(self, result: TelemetryResult):
+        for queue in self._queues:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(result)
+
+        for callback in list(self._callbacks):
+            try:
+                ret = callback(result)
+                if asyncio.iscoroutine(ret):
+                    await ret
+            except Exception as e:
+                logger.exception(f"Telemetry callback failed: {e}")
+
+    # polling
+
+    def _slot(self, api) -> asyncio.Semaphore:
+        slot = self._slots.get(id(api))
+        if slot is None:
+            slot = self._slots[id(api)] = asyncio.Semaphore(self.max_inflight)
+        return slot
+
+    async def _call(self, target: TelemetryTarget):
+        func = target.api.request_telemetry
+        if asyncio.iscoroutinefunction(func):
+            return await func(target.did, target.ep)
+        return await self._loop.run_in_executor(None, func, target.did, target.ep)
+
+    def _reschedule(self, target: TelemetryTarget, success: bool):
+        if target.removed:
+            return
+
+        now = time.monotonic()
+        if success:
+            target.failures = 0
+            # keeps the phase, unless the request was late by more than a period
+            target.due = max(target.due + target.period, now)
+        else:
+            target.failures += 1
+            target.due = now + min(target.period * 2 ** target.failures, self.backoff_max)
+
+        if self.jitter:
+            target.due += self.rng.uniform(0, self.jitter * target.period)
+
+        self._push(target)
+
+    async def _poll(self, target: TelemetryTarget):
+        async with self._slot(target.api):
+            t0 = time.monotonic()
+            error = None
+            try:
+                value = await self._call(target)
+                if value is None:
+                    error = "no response"
+            except Exception as e:
+                value = None
+                error = str(e) or type(e).__name__
+            t1 = time.monotonic()
+
+        target.polls += 1
+        if error is not None:
+            target.errors += 1
+            logger.debug(f"Telemetry of {target.did} ep {target.ep} failed: {error} "
+                         f"(failures={target.failures + 1})")
+
+        self._reschedule(target, error is None)
+        await self._deliver(TelemetryResult(target.did, target.ep, value, time.time(), t1 - t0, error))
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+
+        while True:
+            self._wakeup.clear()
+
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                _, _, target = heapq.heappop(self._heap)
+                if target.removed:
+                    continue
+                task = self._loop.create_task(self._poll(target))
+                self._requests.add(task)
+                task.add_done_callback(self._requests.discard)
+
+            timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self) -> asyncio.Task:
+        # must be called from the loop
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            for task in list(self._requests):
+                task.cancel()
+            await asyncio.gather(self._task, *self._requests, return_exceptions=True)
+            self._task = None
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    def stats(self) -> Dict[str, int]:
+        targets = list(self.targets.values())
+        return {
+            "targets": len(targets),
+            "polls": sum(t.polls for t in targets),
+            "errors": sum(t.errors for t in targets),
+            "backing_off": sum(1 for t in targets if t.failures),
+        }
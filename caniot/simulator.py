@@ -0,0 +1,314 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Simulated CANIOT nodes answering on a (virtual) CAN bus.
+#
+# Nodes answer telemetry requests, commands and attribute reads/writes from
+# the caniot_attributes table, and emit periodic telemetry according to
+# their CfgTelemetryPeriodMs/CfgTelemetryDelay attributes. All nodes of a
+# Simulator run on a single asyncio loop, with configurable latency, jitter
+# and drop rate per node. There are only 62 valid device ids per bus, larger
+# fleets use one VirtualCanBus (and Simulator) per controller.
+
+from __future__ import annotations
+
+import asyncio
+import random
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Union
+
+from .can import CanBus, CanFrame, VirtualCanBus
+from .caniot import DeviceId, Endpoint, FrameType, MsgId, QueryType, SysCommand
+from .caniot_attributes import AttributeId, attributes, get_by_key
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Simulator error codes (sent in error frames, not the firmware values)
+ERROR_UNKNOWN_ATTRIBUTE = -1
+ERROR_READONLY_ATTRIBUTE = -2
+
+CANIOT_VERSION = 1
+APPLICATION_VERSION = 0
+
+
+class SimulatedNode:
+    def __init__(self, did: Union[DeviceId, int], name: str = None,
+                 latency: float = 0.002, jitter: float = 0.001, drop_rate: float = 0.0,
+                 telemetry_period_ms: int = 60000, telemetry_delay_ms: int = 0,
+                 clock=time.time):
+        self.did = DeviceId.from_int(int(did))
+        self.name = name if name is not None else f"sim-{int(self.did)}"
+
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+
+        self.clock = clock
+        self.start_time = int(clock())
+
+        # endpoint -> telemetry payload
+        self.state: Dict[int, bytes] = {ep: bytes(8) for ep in Endpoint}
+
+        self.values: Dict[int, int] = {}
+        self._defaults = (telemetry_period_ms, telemetry_delay_ms)
+        self._init_attributes(*self._defaults)
+
+    def _supports(self, key: int) -> bool:
+        attr = get_by_key(key)
+        if attr is None:
+            return False
+
+        # class specific configuration
+        try:
+            name = AttributeId(attr.key).name
+        except ValueError:
+            return True
+        if name.startswith("CfgClass"):
+            return name.startswith(f"CfgClass{self.did.cls}")
+        return True
+
+    def _init_attributes(self, telemetry_period_ms: int, telemetry_delay_ms: int):
+        for attr in attributes:
+            for part in range(max(attr.parts, 1)):
+                self.values[attr.key + part] = 0
+
+        name = self.name.encode("utf8")[:32].ljust(32, b"\x00")
+        for part in range(8):
+            self.values[AttributeId.Name + part], = struct.unpack_from("<I", name, part * 4)
+
+        self.values[AttributeId.NodeID] = int(self.did)
+        self.values[AttributeId.Version] = CANIOT_VERSION << 8 | APPLICATION_VERSION
+        self.values[AttributeId.MagicNumber] = random.getrandbits(32)
+        self.values[AttributeId.CfgTelemetryPeriodMs] = telemetry_period_ms
+        self.values[AttributeId.CfgTelemetryDelay] = telemetry_delay_ms
+
+    def reset(self, config: bool = False):
+        # clears the counters as a reboot would, and the attributes to their
+        # defaults on a factory reset (`config`)
+        if config:
+            self._init_attributes(*self._defaults)
+        self.start_time = int(self.clock())
+        for key in self.values:
+            if AttributeId.SysReceivedTotal <= key <= AttributeId.SysSentTelemetry:
+                self.values[key] = 0
+
+    def _increment(self, key: AttributeId):
+        self.values[key] = (self.values[key] + 1) & 0xFFFFFFFF
+
+    def read_value(self, key: int) -> int:
+        now = int(self.clock())
+        base = key & 0xFFF0
+        if base == AttributeId.SysTime:
+            return now
+        elif base in (AttributeId.SysUptime, AttributeId.SysUptimeSynced):
+            return now - self.start_time
+        elif base == AttributeId.SysStartTime:
+            return self.start_time
+        return self.values.get(key, 0)
+
+    @property
+    def telemetry_period(self) -> float:
+        return self.values[AttributeId.CfgTelemetryPeriodMs] / 1000.0
+
+    @property
+    def telemetry_delay(self) -> float:
+        return self.values[AttributeId.CfgTelemetryDelay] / 1000.0
+
+    @property
+    def telemetry_endpoint(self) -> Endpoint:
+        return Endpoint((self.values[AttributeId.CfgTelemetryFlags] >> 2) & 0x3)
+
+    def telemetry_frame(self, ep: Endpoint) -> CanFrame:
+        msgid = MsgId(FrameType.Telemetry, QueryType.Response, self.did, ep)
+
+        self._increment(AttributeId.SysSentTotal)
+        self._increment(AttributeId.SysSentTelemetry)
+        self.values[AttributeId.SysLastTelemetry] = int(self.clock())
+
+        return CanFrame(int(msgid), self.state[ep])
+
+    def _error_frame(self, query: MsgId, code: int, key: int = None) -> CanFrame:
+        msgid = MsgId(FrameType.Command, QueryType.Response, self.did, query.endpoint)
+        data = struct.pack("<i", code)
+        if key is not None:
+            data += struct.pack("<H", key)
+
+        self._increment(AttributeId.SysSentTotal)
+        return CanFrame(int(msgid), data)
+
+    def _attribute_frame(self, query: MsgId, key: int) -> CanFrame:
+        msgid = MsgId(FrameType.ReadAttribute, QueryType.Response, self.did, query.endpoint)
+
+        self._increment(AttributeId.SysSentTotal)
+        return CanFrame(int(msgid), struct.pack("<HI", key, self.read_value(key)))
+
+    def handle(self, frame: CanFrame) -> List[CanFrame]:
+        # Process a query addressed to this node, returns the frames to send back
+        query = MsgId.from_int(frame.arbitration_id)
+        if not query.is_query():
+            return []
+
+        self._increment(AttributeId.SysReceivedTotal)
+
+        if query.frame_type == FrameType.Telemetry:
+            self._increment(AttributeId.SysReceivedRequestTelemetry)
+            return [self.telemetry_frame(query.endpoint)]
+
+        elif query.frame_type == FrameType.Command:
+            self._increment(AttributeId.SysReceivedCommand)
+            data = bytes(frame.data).ljust(8, b"\x00")[:8]
+            if query.endpoint == Endpoint.BoardLevelControl:
+                sys = SysCommand(data[7] & (SysCommand.HardwareReset | SysCommand.SoftwareReset |
+                                            SysCommand.WatchdogReset | SysCommand.ConfigReset))
+                if sys:
+                    # resets without answering
+                    self.reset(config=bool(sys & SysCommand.ConfigReset))
+                    return []
+            self.state[query.endpoint] = data
+            return [self.telemetry_frame(query.endpoint)]
+
+        elif query.frame_type == FrameType.ReadAttribute:
+            self._increment(AttributeId.SysReceivedReadAttribute)
+            key, = struct.unpack_from("<H", bytes(frame.data).ljust(2, b"\x00"))
+            if not self._supports(key):
+                return [self._error_frame(query, ERROR_UNKNOWN_ATTRIBUTE, key)]
+            return [self._attribute_frame(query, key)]
+
+        elif query.frame_type == FrameType.WriteAttribute:
+            self._increment(AttributeId.SysReceivedWriteAttribute)
+            key, value = struct.unpack_from("<HI", bytes(frame.data).ljust(6, b"\x00"))
+            if not self._supports(key):
+                return [self._error_frame(query, ERROR_UNKNOWN_ATTRIBUTE, key)]
+            if get_by_key(key).readonly:
+                return [self._error_frame(query, ERROR_READONLY_ATTRIBUTE, key)]
+            self.values[key] = value
+            return [self._attribute_frame(query, key)]
+
+        return []
+
+    def __repr__(self) -> str:
+        return f"SimulatedNode({self.did} name={self.name})"
+
+
+class Simulator:
+    def __init__(self, bus: Union[VirtualCanBus, CanBus], seed: int = None):
+        self.interface: CanBus = bus.connect() if isinstance(bus, VirtualCanBus) else bus
+        self.nodes: Dict[int, SimulatedNode] = {}
+
+        self.rng = random.Random(seed)
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._timers: Dict[int, asyncio.TimerHandle] = {}
+        self._thread: Optional[threading.Thread] = None
+
+        self.received = 0
+        self.dropped = 0
+        self.sent = 0
+
+    def add_node(self, did: Union[DeviceId, int], **kwargs) -> SimulatedNode:
+        node = SimulatedNode(did, **kwargs)
+        self.nodes[int(node.did)] = node
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._schedule_telemetry, node, True)
+        return node
+
+    def add_nodes(self, dids, **kwargs) -> List[SimulatedNode]:
+        return [self.add_node(did, **kwargs) for did in dids]
+
+    def _send(self, frames: List[CanFrame]):
+        for frame in frames:
+            self.sent += 1
+            self.interface.send(frame)
+
+    def _delay(self, node: SimulatedNode) -> float:
+        return max(0.0, node.latency + self.rng.uniform(-node.jitter, node.jitter))
+
+    def _on_frame(self, frame: CanFrame):
+        # may be called from any thread
+        self.loop.call_soon_threadsafe(self._dispatch, frame)
+
+    def _dispatch(self, frame: CanFrame):
+        self.received += 1
+
+        did = (frame.arbitration_id >> 3) & 0x3F
+        if did == 0x3F:
+            targets = list(self.nodes.values())
+        else:
+            node = self.nodes.get(did)
+            targets = [node] if node is not None else []
+
+        for node in targets:
+            if node.drop_rate and self.rng.random() < node.drop_rate:
+                self.dropped += 1
+                continue
+            self.loop.call_later(self._delay(node), self._respond, node, frame)
+
+    def _respond(self, node: SimulatedNode, frame: CanFrame):
+        self._send(node.handle(frame))
+
+        # telemetry period changed
+        if frame.arbitration_id & 0b111 == FrameType.WriteAttribute and \
+                frame.data[:2] in (struct.pack("<H", AttributeId.CfgTelemetryPeriodMs),
+                                   struct.pack("<H", AttributeId.CfgTelemetryDelay)):
+            self._schedule_telemetry(node)
+
+    def _schedule_telemetry(self, node: SimulatedNode, first: bool = False):
+        timer = self._timers.pop(int(node.did), None)
+        if timer is not None:
+            timer.cancel()
+
+        period = node.telemetry_period
+        if period <= 0:
+            return
+
+        delay = node.telemetry_delay + self.rng.uniform(0, period) if first else period
+        self._timers[int(node.did)] = self.loop.call_later(delay, self._periodic_telemetry, node)
+
+    def _periodic_telemetry(self, node: SimulatedNode):
+        if node.drop_rate and self.rng.random() < node.drop_rate:
+            self.dropped += 1
+        else:
+            self._send([node.telemetry_frame(node.telemetry_endpoint)])
+        self._schedule_telemetry(node)
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        # must be called from the loop thread if no loop is given
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        for node in self.nodes.values():
+            self._schedule_telemetry(node, first=True)
+        self.interface.add_listener(self._on_frame)
+
+    def stop(self):
+        self.interface.remove_listener(self._on_frame)
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+
+    def start_background(self) -> threading.Thread:
+        # Run the simulator on its own loop in a daemon thread (for synchronous clients)
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            self.start(loop)
+            started.set()
+            loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True, name="caniot-simulator")
+        self._thread.start()
+        started.wait()
+        return self._thread
+
+    def stop_background(self):
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self.stop)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
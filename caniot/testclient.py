@@ -4,77 +4,231 @@
 # SPDX-License-Identifier: Apache-2.0
 #
 
+from __future__ import annotations
+
+import io
 import re
+import time
 import requests
 from requests_toolbelt import MultipartEncoder
 from pprint import pprint
 import random
-from typing import Callable, Iterator, List, Dict, Optional, Union
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Dict, Optional, Tuple, Union
 
 from caniot.controller import Controller
+from caniot.loadtest import LoadGenerator, LoadReport
 
 ChunksGeneratorType = Iterator[bytes]
 
+SEQ_PATTERN = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+
 
 def data_gen_zeros(size: int) -> bytes:
     return bytes(size)
 
 def data_gen_seq(size: int) -> bytes:
-    array = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
-    ret = ""
-    for _ in range(size):
-        ret += array[_ % len(array)]
-    return ret.encode()
+    repeat = size // len(SEQ_PATTERN) + 1
+    return (SEQ_PATTERN * repeat)[:size]
 
 def calc_checksum(data: bytes) -> int:
     return sum(data)
 
+
+class PatternPayload:
+    # `size` bytes of a repeated pattern, generated chunk by chunk: only one
+    # block of about `chunk_size` bytes is kept in memory, chunks are
+    # memoryview slices of it. Can be iterated multiple times.
+    def __init__(self, size: int, pattern: bytes = SEQ_PATTERN, chunk_size: int = 4096):
+        assert pattern and chunk_size > 0
+        self.size = size
+        self.pattern = pattern
+        self.chunk_size = chunk_size
+
+        repeat = (chunk_size + len(pattern) - 1) // len(pattern) + 1
+        self._block = memoryview(pattern * repeat)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[memoryview]:
+        plen = len(self.pattern)
+        sent = 0
+        while sent < self.size:
+            n = min(self.chunk_size, self.size - sent)
+            offset = sent % plen
+            yield self._block[offset:offset + n]
+            sent += n
+
+    def checksum(self) -> int:
+        # expected checksum, without generating the payload
+        full, rest = divmod(self.size, len(self.pattern))
+        return full * sum(self.pattern) + sum(self.pattern[:rest])
+
+    def reader(self) -> PayloadReader:
+        return PayloadReader(self)
+
+
+class ZeroPayload(PatternPayload):
+    def __init__(self, size: int, chunk_size: int = 4096):
+        super().__init__(size, b"\x00", chunk_size)
+
+
+class PayloadReader(io.RawIOBase):
+    # File-like view of a payload (e.g. for MultipartEncoder fields)
+    def __init__(self, payload: PatternPayload):
+        self.payload = payload
+        self._chunks = iter(payload)
+        self._pending = memoryview(b"")
+        self._pos = 0
+
+    def __len__(self) -> int:
+        return len(self.payload)
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        if not self._pending:
+            self._pending = next(self._chunks, memoryview(b""))
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self._pos += n
+        return n
+
+
+class ChecksumStream:
+    # Wraps a chunks iterable, the checksum and the send throughput are
+    # computed as the chunks are consumed by the HTTP client.
+    def __init__(self, chunks: Iterable[bytes], chunked: bool = False):
+        self.chunks = chunks
+        self.chunked = chunked
+
+        self.checksum = 0
+        self.length = 0
+        self.t_start: Optional[float] = None
+        self.t_end: Optional[float] = None
+
+        # requests sends a Content-Length instead of chunked encoding
+        # when the body length is known (attribute read by super_len())
+        if not chunked and hasattr(chunks, "__len__"):
+            self.len = len(chunks)
+
+    def __iter__(self) -> Iterator[bytes]:
+        self.t_start = time.perf_counter()
+        for chunk in self.chunks:
+            self.checksum += sum(chunk)
+            self.length += len(chunk)
+            yield chunk
+        self.t_end = time.perf_counter()
+
+    @property
+    def send_duration(self) -> float:
+        if self.t_start is None or self.t_end is None:
+            return 0.0
+        return self.t_end - self.t_start
+
+
+@dataclass
+class TransferStats:
+    route: str
+    length: int
+    checksum: int
+    send_duration: float
+    total_duration: float
+    status_code: int = 0
+    host_checksum: Optional[int] = None
+
+    @property
+    def send_throughput(self) -> float:
+        return self.length / self.send_duration if self.send_duration else 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.length / self.total_duration if self.total_duration else 0.0
+
+    def checksum_ok(self) -> bool:
+        return self.host_checksum == self.checksum
+
+    def __repr__(self) -> str:
+        return f"{self.route}: {self.length} B status={self.status_code} " \
+               f"send {self.send_duration:.3f} s ({self.send_throughput / 1024:.1f} KiB/s) " \
+               f"total {self.total_duration:.3f} s ({self.throughput / 1024:.1f} KiB/s)"
+
+
 class TestClient(Controller):
-    def test_big_data(self, size=32768, to_stream_res: bool = False) -> requests.Response:
-        data = data_gen_seq(size)
-        req = {
-            **self.default_req,
-            "method": "POST",
-            "url": self.url + ("api/test/messaging" if not to_stream_res else "api/test/streaming"),
-            "timeout": self.timeout,
-            "headers": self.default_headers,
-            "data": data
-        }
-        resp = requests.request(**req)
+    def post_payload(self, route: str, chunks: Iterable[bytes],
+                     chunked: bool = False,
+                     content_type: str = "application/octet-stream") -> Tuple[requests.Response, TransferStats]:
+        stream = ChecksumStream(chunks, chunked)
+
+        t0 = time.perf_counter()
+        resp = self._req(
+            "POST",
+            self.url + route,
+            data=stream,
+            headers={"Content-Type": content_type},
+        )
+        t1 = time.perf_counter()
+
+        stats = TransferStats(route, stream.length, stream.checksum,
+                              stream.send_duration, t1 - t0, resp.status_code)
+        if resp.status_code == 200:
+            try:
+                stats.host_checksum = resp.json().get("payload_checksum")
+            except ValueError:
+                pass
+        return resp, stats
+
+    def test_big_data(self, size=32768, to_stream_res: bool = False,
+                      chunk_size: int = 4096, chunked: bool = False) -> requests.Response:
+        payload = PatternPayload(size, chunk_size=chunk_size)
+        route = "api/test/messaging" if not to_stream_res else "api/test/streaming"
+
+        resp, stats = self.post_payload(route, payload, chunked)
+        print(stats)
         if resp and resp.status_code == 200:
-            checksum = calc_checksum(data)
-            host_checksum = resp.json()["payload_checksum"]
-            if checksum == host_checksum:
+            if stats.checksum_ok():
                 print("Checksum OK")
             else:
-                print(f"Checksum ERROR (expected: {checksum}, got: {host_checksum})")
+                print(f"Checksum ERROR (expected: {stats.checksum}, got: {stats.host_checksum})")
         return resp
 
-    def test_simultaneous(self, simultaneous: int = 5, count: int = 5):
-        sessions = [requests.Session() for _ in range(simultaneous)]
-        conn_refused = 0
-
-        for reqid in range(count):
-            for clientid, s in enumerate(sessions):
-                req = {
-                    **self.default_req,
-                    "method": "GET",
-                    "url": self.url + "api/info",
-                    "json": {"clientid": clientid, "reqid": reqid},
-                    "timeout": self.timeout,
-                    "headers": self.default_headers
-                }
-                try:
-                    resp = s.request(**req)
-                except requests.exceptions.ConnectionError:
-                    conn_refused += 1
-                    sessions.remove(s)
-
-                print(resp.status_code, resp.text[:50] + " ...")
+    def test_throughput(self, sizes: Iterable[int] = (1 << 16, 1 << 20, 4 << 20),
+                        chunk_size: int = 4096) -> List[TransferStats]:
+        # Send/receive throughput of the messaging and streaming test routes
+        results = []
+        for route, chunked in (("api/test/messaging", False), ("api/test/streaming", True)):
+            for size in sizes:
+                _, stats = self.post_payload(route, PatternPayload(size, chunk_size=chunk_size), chunked)
+                print(stats, "checksum OK" if stats.checksum_ok() else "checksum ERROR")
+                results.append(stats)
+        return results
 
-            random.shuffle(sessions)
-
-        print("Connection refused:", conn_refused)
+    def test_simultaneous(self, simultaneous: int = 5, count: int = 5,
+                          duration: float = None, warmup: float = 0.0,
+                          rate: float = None, mix: Dict[str, float] = None) -> LoadReport:
+        # `simultaneous` concurrent clients, each on its own connection,
+        # sending `count` requests each (or for `duration` seconds).
+        generator = LoadGenerator(
+            self.host, self.port,
+            clients=simultaneous,
+            duration=duration or 0.0,
+            warmup=warmup,
+            rate=rate,
+            requests_per_client=None if duration else count,
+            mix=mix,
+            controller_factory=lambda: Controller(self.host, self.port, self.secure,
+                                                  self.cert, self.key, self.verify,
+                                                  pool_size=1),
+        )
+        report = generator.run()
+        print(report)
+        return report
 
     def test_session(self, count: int = 20):
         with requests.sessions.Session() as s:
@@ -93,17 +247,9 @@ class TestClient(Controller):
                 print(resp.status_code, resp.text[:50])
 
     def test_stream(self, chunks_generator: ChunksGeneratorType) -> requests.Response:
-        req = {
-            **self.default_req,
-            "method": "POST",
-            "url": self.url + "api/test/streaming",
-            "data": chunks_generator,
-            "headers": {
-                "Content-Type": "application/octet-stream"
-            },
-        }
-
-        return requests.request(**req)
+        resp, stats = self.post_payload("api/test/streaming", chunks_generator, chunked=True)
+        print(stats)
+        return resp
 
     def test_any(self):
         raise Exception("Not implemented")
@@ -123,7 +269,7 @@ class TestClient(Controller):
         multipart = MultipartEncoder(
             fields={
                 "KEY1": "VALUE___AA",
-                "myfile.txt": ("myfile.bin", data_gen_zeros(size)),
+                "myfile.txt": ("myfile.bin", ZeroPayload(size).reader()),
             },
             boundary="----WebKitFormBoundary7MA4YWxkTrZu0gW",
         )
@@ -138,18 +284,10 @@ class TestClient(Controller):
                 else:
                     break
 
-        req = {
-            **self.default_req,
-            "method": "POST",
-            "url": self.url + "api/test/streaming",
-            "data": file_chunks_generator(),
-            "headers": {
-                "Content-Type": multipart.content_type,
-                # "Content-Length": multipart.len,
-            }
-        }
-
-        return requests.request(**req)
+        resp, stats = self.post_payload("api/test/streaming", file_chunks_generator(),
+                                        chunked=True, content_type=multipart.content_type)
+        print(stats)
+        return resp
 
     def test_route_args(self, a: int = 1, b: int = 2, c: int = 3) -> requests.Response:
         req = {
@@ -0,0 +1,364 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Bounded in-memory time series store for telemetry, device events and HA
+# stats.
+#
+# Each series, keyed by (device, endpoint, field), is a ring buffer of two
+# preallocated array('d') (timestamps and values): memory is fixed by the
+# capacity whatever the run time, with an optional time based retention on
+# top. Range queries return NumPy views of the buffers when numpy is
+# available (arrays otherwise), stores can be saved to and restored from a
+# compact binary snapshot.
+
+from __future__ import annotations
+
+import json
+import math
+import struct
+import sys
+import time
+from array import array
+from typing import BinaryIO, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# (device, endpoint, field), e.g. (0x08, 1, "b0"), ("0x08", 2, "last_event"), ("controller", None, "rx")
+SeriesKey = Tuple[Hashable, Optional[int], str]
+
+SNAPSHOT_MAGIC = b"CTSS"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHI")
+SERIES_HEADER = struct.Struct("<HIIdI")
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+
+def _normalize_key(key: SeriesKey) -> SeriesKey:
+    device, endpoint, field = key
+    if not isinstance(device, str) and device is not None:
+        device = int(device)
+    return device, (int(endpoint) if endpoint is not None else None), str(field)
+
+
+class Series:
+    __slots__ = ("capacity", "retention", "timestamps", "values", "start", "count", "dropped")
+
+    def __init__(self, capacity: int = 4096, retention: Optional[float] = None):
+        assert capacity > 0
+        self.capacity = capacity
+        # maximum age of the samples relative to the last one (s)
+        self.retention = retention
+
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.values = array("d", bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+
+        # out of order samples
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return 16 * self.capacity
+
+    def _index(self, i: int) -> int:
+        return (self.start + i) % self.capacity
+
+    @property
+    def last(self) -> Optional[Tuple[float, float]]:
+        if not self.count:
+            return None
+        i = self._index(self.count - 1)
+        return self.timestamps[i], self.values[i]
+
+    def append(self, timestamp: float, value: float) -> bool:
+        if self.count and timestamp < self.timestamps[self._index(self.count - 1)]:
+            self.dropped += 1
+            return False
+
+        if self.count == self.capacity:
+            # overwrite the oldest sample
+            i = self.start
+            self.start = (self.start + 1) % self.capacity
+        else:
+            i = self._index(self.count)
+            self.count += 1
+        self.timestamps[i] = timestamp
+        self.values[i] = value
+
+        if self.retention is not None:
+            self.expire(timestamp - self.retention)
+        return True
+
+    def expire(self, oldest: float):
+        # drop the samples older than `oldest`
+        n = self._bisect(oldest)
+        self.start = self._index(n)
+        self.count -= n
+
+    def _bisect(self, timestamp: float, right: bool = False) -> int:
+        # logical index of the first sample >= timestamp (> if right)
+        ts = self.timestamps
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t = ts[(self.start + mid) % self.capacity]
+            if t < timestamp or (right and t == timestamp):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _segments(self, i: int, j: int) -> List[Tuple[int, int]]:
+        # physical slices of the logical range [i, j)
+        if i >= j:
+            return []
+        a = self._index(i)
+        n = j - i
+        if a + n <= self.capacity:
+            return [(a, a + n)]
+        return [(a, self.capacity), (0, a + n - self.capacity)]
+
+    def _slice(self, buffer: array, segments: List[Tuple[int, int]], use_numpy: bool):
+        if use_numpy:
+            if len(segments) == 1:
+                a, b = segments[0]
+                view = np.frombuffer(buffer, dtype=np.float64, count=b - a, offset=8 * a)
+                view.flags.writeable = False
+                return view
+            return np.concatenate([np.frombuffer(buffer, dtype=np.float64, count=b - a, offset=8 * a)
+                                   for a, b in segments]) if segments else np.empty(0)
+
+        if len(segments) == 1:
+            a, b = segments[0]
+            return memoryview(buffer)[a:b].toreadonly()
+        result = array("d")
+        for a, b in segments:
+            result.extend(buffer[a:b])
+        return result
+
+    def range(self, t0: Optional[float] = None, t1: Optional[float] = None,
+              use_numpy: bool = True):
+        # (timestamps, values) of the samples with t0 <= timestamp <= t1.
+        # With numpy, results are read-only views of the ring buffer whenever
+        # the range does not wrap around: copy them to keep them beyond the
+        # next appends.
+        i = self._bisect(t0) if t0 is not None else 0
+        j = self._bisect(t1, right=True) if t1 is not None else self.count
+        segments = self._segments(i, j)
+        use_numpy = use_numpy and np is not None
+        return self._slice(self.timestamps, segments, use_numpy), self._slice(self.values, segments, use_numpy)
+
+    def downsample(self, bucket: float, t0: Optional[float] = None, t1: Optional[float] = None) -> Dict[str, object]:
+        # min/max/mean/count per `bucket` seconds (aligned on multiples of bucket),
+        # empty buckets are omitted
+        timestamps, values = self.range(t0, t1)
+
+        if np is not None:
+            if not len(timestamps):
+                empty = np.empty(0)
+                return {"time": empty, "min": empty, "max": empty, "mean": empty,
+                        "count": np.empty(0, dtype=np.int64)}
+            buckets = np.floor(timestamps / bucket)
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+            counts = np.diff(np.append(starts, len(values)))
+            return {
+                "time": buckets[starts] * bucket,
+                "min": np.minimum.reduceat(values, starts),
+                "max": np.maximum.reduceat(values, starts),
+                "mean": np.add.reduceat(values, starts) / counts,
+                "count": counts,
+            }
+
+        result = {"time": array("d"), "min": array("d"), "max": array("d"),
+                  "mean": array("d"), "count": array("q")}
+        current = None
+        for t, v in zip(timestamps, values):
+            b = math.floor(t / bucket)
+            if b != current:
+                if current is not None:
+                    result["mean"].append(total / n)
+                    result["count"].append(n)
+                current, n, total = b, 0, 0.0
+                result["time"].append(b * bucket)
+                result["min"].append(v)
+                result["max"].append(v)
+            result["min"][-1] = min(result["min"][-1], v)
+            result["max"][-1] = max(result["max"][-1], v)
+            n += 1
+            total += v
+        if current is not None:
+            result["mean"].append(total / n)
+            result["count"].append(n)
+        return result
+
+    def __repr__(self) -> str:
+        return f"Series(count={self.count}/{self.capacity} retention={self.retention})"
+
+
+class TimeSeriesStore:
+    def __init__(self, capacity: int = 4096, retention: Optional[float] = None):
+        # defaults of the new series
+        self.capacity = capacity
+        self.retention = retention
+
+        self._series: Dict[SeriesKey, Series] = {}
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def __contains__(self, key: SeriesKey) -> bool:
+        return _normalize_key(key) in self._series
+
+    def keys(self) -> Iterator[SeriesKey]:
+        return iter(self._series)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(s.nbytes for s in self._series.values())
+
+    def series(self, key: SeriesKey, create: bool = False) -> Optional[Series]:
+        key = _normalize_key(key)
+        series = self._series.get(key)
+        if series is None and create:
+            series = self._series[key] = Series(self.capacity, self.retention)
+        return series
+
+    def configure(self, key: SeriesKey, capacity: int = None, retention: Optional[float] = None) -> Series:
+        # per series capacity/retention (existing samples are dropped)
+        series = Series(capacity or self.capacity, retention)
+        self._series[_normalize_key(key)] = series
+        return series
+
+    def append(self, key: SeriesKey, value: float, timestamp: float = None) -> bool:
+        if timestamp is None:
+            timestamp = time.time()
+        return self.series(key, create=True).append(timestamp, value)
+
+    def query(self, key: SeriesKey, t0: float = None, t1: float = None, use_numpy: bool = True):
+        series = self.series(key)
+        if series is None:
+            raise KeyError(key)
+        return series.range(t0, t1, use_numpy)
+
+    def downsample(self, key: SeriesKey, bucket: float, t0: float = None, t1: float = None) -> Dict[str, object]:
+        series = self.series(key)
+        if series is None:
+            raise KeyError(key)
+        return series.downsample(bucket, t0, t1)
+
+    def remove(self, key: SeriesKey) -> bool:
+        return self._series.pop(_normalize_key(key), None) is not None
+
+    # ingestion
+
+    def add_telemetry(self, result: dict, timestamp: float = None):
+        # {"did": .., "ep": .., "payload": [..]} as returned by request_telemetry(),
+        # one series per payload byte ("b0" .. "b7")
+        if not result:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        did, ep = result["did"], result["ep"]
+        for i, byte in enumerate(result.get("payload", [])):
+            self.append((did, ep, f"b{i}"), byte, timestamp)
+
+    def add_devices(self, devices: Iterable[dict], timestamp: float = None):
+        # last event timestamp of the endpoints of get_devices()
+        if timestamp is None:
+            timestamp = time.time()
+        for dev in devices:
+            for ep, endpoint in enumerate(dev.get("endpoints", [])):
+                last = (endpoint.get("last_event") or {}).get("timestamp", 0)
+                if last:
+                    key = (dev["addr_repr"], ep, "last_event")
+                    series = self.series(key, create=True)
+                    # only new events
+                    if series.last is None or series.last[1] != last:
+                        series.append(timestamp, last)
+
+    def add_stats(self, stats: dict, device: Hashable = "controller", timestamp: float = None):
+        # numeric fields of get_ha_stats() (nested fields as "a.b")
+        if timestamp is None:
+            timestamp = time.time()
+
+        def flatten(prefix: str, obj):
+            for name, value in obj.items():
+                name = f"{prefix}{name}"
+                if isinstance(value, dict):
+                    yield from flatten(f"{name}.", value)
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield name, value
+
+        for name, value in flatten("", stats or {}):
+            self.append((device, None, name), value, timestamp)
+
+    # snapshots
+    #
+    # header: magic, version, number of series
+    # series: key length, capacity, count, retention (NaN if None), dropped,
+    #         JSON key, count timestamps, count values (float64, little endian)
+
+    def save(self, f: BinaryIO):
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(self._series)))
+        for key, series in self._series.items():
+            encoded = json.dumps(key).encode()
+            retention = series.retention if series.retention is not None else math.nan
+            f.write(SERIES_HEADER.pack(len(encoded), series.capacity, series.count, retention, series.dropped))
+            f.write(encoded)
+            segments = series._segments(0, series.count)
+            for buffer in (series.timestamps, series.values):
+                for a, b in segments:
+                    if LITTLE_ENDIAN:
+                        with memoryview(buffer)[a:b] as view:
+                            f.write(view)
+                    else:
+                        data = buffer[a:b]
+                        data.byteswap()
+                        f.write(data.tobytes())
+
+    def load(self, f: BinaryIO):
+        magic, version, n = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"Invalid snapshot (magic={magic}, version={version})")
+
+        series_map = {}
+        for _ in range(n):
+            key_len, capacity, count, retention, dropped = SERIES_HEADER.unpack(f.read(SERIES_HEADER.size))
+            device, endpoint, field = json.loads(f.read(key_len))
+            series = Series(capacity, None if math.isnan(retention) else retention)
+            for buffer in (series.timestamps, series.values):
+                data = array("d")
+                data.frombytes(f.read(8 * count))
+                if not LITTLE_ENDIAN:
+                    data.byteswap()
+                buffer[:count] = data
+            series.count = count
+            series.dropped = dropped
+            series_map[_normalize_key((device, endpoint, field))] = series
+
+        self._series = series_map
+
+    def snapshot(self, path: str):
+        with open(path, "wb") as f:
+            self.save(f)
+
+    @classmethod
+    def restore(cls, path: str, capacity: int = 4096, retention: Optional[float] = None) -> TimeSeriesStore:
+        store = cls(capacity, retention)
+        with open(path, "rb") as f:
+            store.load(f)
+        return store
+
@@ -0,0 +1,200 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Transports carry CaniotAPI operations to the devices, either through the
+# controller REST API (controller.RestTransport) or directly on a CAN bus
+# (RawCanTransport).
+
+from __future__ import annotations
+
+import struct
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Iterable, List, Optional, Union
+
+from .can import CanBus, CanFrame
+from .caniot import DeviceId, Endpoint, FrameType, MsgId, QueryType, SysCommand, blc_command
+from .correlator import PendingQuery, QueryCorrelator, Response
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CaniotTransport(ABC):
+    @abstractmethod
+    def request_telemetry(self, did: Union[DeviceId, int], ep: int, timeout: float):
+        pass
+
+    @abstractmethod
+    def command(self, did: Union[DeviceId, int], ep: int, vals: List[int], timeout: float):
+        pass
+
+    @abstractmethod
+    def read_attribute(self, did: Union[DeviceId, int], key: int, timeout: float):
+        pass
+
+    @abstractmethod
+    def write_attribute(self, did: Union[DeviceId, int], key: int, value: int, timeout: float):
+        pass
+
+    @abstractmethod
+    def command_cls1(self, did: Union[DeviceId, int], vals: Iterable[str], timeout: float):
+        pass
+
+    @abstractmethod
+    def factory_reset(self, did: Union[DeviceId, int], timeout: float):
+        pass
+
+    @abstractmethod
+    def reboot(self, did: Union[DeviceId, int], timeout: float):
+        pass
+
+    def close(self):
+        pass
+
+
+class RawCanTransport(CaniotTransport):
+    # Encodes CANIOT frames directly on a CAN bus, responses are matched
+    # against outstanding queries by a QueryCorrelator.
+    #
+    # Results have the same shape as the controller REST API ones:
+    #   telemetry/command: {"did": .., "ep": .., "payload": [..]}
+    #   attributes: {"did": .., "key": .., "value": ..}
+    # Queries to the broadcast device return the list of responses received
+    # before the timeout.
+    def __init__(self, bus: CanBus, timeout: float = 1.0, expire_period: float = 0.05):
+        self.bus = bus
+        self.timeout = timeout
+        self.expire_period = expire_period
+
+        self.correlator = QueryCorrelator(timeout)
+
+        self._stop = threading.Event()
+        self._reaper: Optional[threading.Thread] = None
+        self._reaper_lock = threading.Lock()
+
+        self.bus.add_listener(self._on_frame)
+
+    def _on_frame(self, frame: CanFrame):
+        if frame.arbitration_id & (QueryType.Response << 2):
+            self.correlator.match(frame.arbitration_id, frame.data)
+
+    def _reap(self):
+        while not self._stop.wait(self.expire_period):
+            self.correlator.expire()
+
+    def _start_reaper(self):
+        with self._reaper_lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap, daemon=True,
+                                                name="caniot-correlator")
+                self._reaper.start()
+
+    def query(self, msgid: MsgId, data: bytes = b"", timeout: float = None) -> PendingQuery:
+        # Send a query and return its pending entry without waiting,
+        # use asyncio.wrap_future(entry.future) from asyncio code.
+        self._start_reaper()
+
+        entry = self.correlator.register(msgid, data, timeout)
+        try:
+            self.bus.send(CanFrame(int(msgid), data, msgid.is_extended()))
+        except Exception:
+            self.correlator.cancel(entry)
+            raise
+        return entry
+
+    def _query_wait(self, msgid: MsgId, data: bytes, timeout: float):
+        if timeout is None:
+            timeout = self.timeout
+
+        entry = self.query(msgid, data, timeout)
+        try:
+            # the reaper completes the entry at its deadline
+            return entry.future.result(timeout + 10 * self.expire_period)
+        except FutureTimeoutError:
+            self.correlator.cancel(entry)
+            raise TimeoutError(f"No response to {msgid}")
+
+    def _request(self, msgid: MsgId, data: bytes, timeout: float, decode):
+        try:
+            result = self._query_wait(msgid, data, timeout)
+        except Exception as e:
+            logger.error(f"Request failed: {msgid}: {e}")
+            return None
+
+        if isinstance(result, list):
+            return [decode(r) for r in result if isinstance(r, Response)]
+        else:
+            return decode(result)
+
+    @staticmethod
+    def _decode_telemetry(response: Response) -> dict:
+        msgid = response.msgid
+        return {
+            "did": int(msgid.device_id),
+            "ep": int(msgid.endpoint),
+            "payload": list(response.data),
+        }
+
+    @staticmethod
+    def _decode_attribute(response: Response) -> dict:
+        key, value = struct.unpack_from("<HI", response.data.ljust(6, b"\x00"))
+        return {
+            "did": int(response.msgid.device_id),
+            "key": key,
+            "value": value,
+        }
+
+    @staticmethod
+    def _msgid(frame_type: FrameType, did: Union[DeviceId, int], ep: int = Endpoint.ApplicationMain) -> MsgId:
+        return MsgId(
+            frame_type=frame_type,
+            query_type=QueryType.Query,
+            device_id=DeviceId.from_int(int(did)),
+            endpoint=Endpoint(ep),
+        )
+
+    def request_telemetry(self, did: Union[DeviceId, int], ep: int, timeout: float = None):
+        msgid = self._msgid(FrameType.Telemetry, did, ep)
+        return self._request(msgid, b"", timeout, self._decode_telemetry)
+
+    def command(self, did: Union[DeviceId, int], ep: int, vals: List[int], timeout: float = None):
+        msgid = self._msgid(FrameType.Command, did, ep)
+        return self._request(msgid, bytes(vals), timeout, self._decode_telemetry)
+
+    def read_attribute(self, did: Union[DeviceId, int], key: int, timeout: float = None):
+        msgid = self._msgid(FrameType.ReadAttribute, did)
+        return self._request(msgid, struct.pack("<H", key), timeout, self._decode_attribute)
+
+    def write_attribute(self, did: Union[DeviceId, int], key: int, value: int, timeout: float = None):
+        msgid = self._msgid(FrameType.WriteAttribute, did)
+        return self._request(msgid, struct.pack("<HI", key, value & 0xFFFFFFFF), timeout,
+                             self._decode_attribute)
+
+    def command_cls1(self, did: Union[DeviceId, int], vals: Iterable[str], timeout: float = None):
+        msgid = self._msgid(FrameType.Command, did, Endpoint.BoardLevelControl)
+        return self._request(msgid, blc_command(list(vals)), timeout, self._decode_telemetry)
+
+    def _system_command(self, did: Union[DeviceId, int], sys: SysCommand):
+        # the node resets without answering, "" as for the controller (204)
+        msgid = self._msgid(FrameType.Command, did, Endpoint.BoardLevelControl)
+        try:
+            self.bus.send(CanFrame(int(msgid), blc_command(sys=sys), msgid.is_extended()))
+        except Exception as e:
+            logger.error(f"Request failed: {msgid}: {e}")
+            return None
+        return ""
+
+    def factory_reset(self, did: Union[DeviceId, int], timeout: float = None):
+        return self._system_command(did, SysCommand.ConfigReset)
+
+    def reboot(self, did: Union[DeviceId, int], timeout: float = None):
+        return self._system_command(did, SysCommand.HardwareReset)
+
+    def close(self):
+        self._stop.set()
+        self.bus.remove_listener(self._on_frame)
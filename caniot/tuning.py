@@ -0,0 +1,126 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Chunk size tuning for uploads with chunked transfer encoding.
+#
+# The throughput of the controller HTTP server depends on the size of the
+# chunks relative to its receive buffers. probe_chunks_sizes() measures a
+# few sizes against the api/test/streaming route and the best one is cached
+# per controller (host:port) in a JSON file, which Controller.upload() uses
+# by default.
+
+from __future__ import annotations
+
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Optional
+
+from .utils import MakeChunks
+
+if TYPE_CHECKING:
+    from .controller import Controller
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNKS_SIZE = 1024
+PROBE_CHUNKS_SIZES = (256, 512, 1024, 1460, 2048, 4096, 8192)
+
+
+def default_cache_path() -> str:
+    base = os.environ.get("CANIOT_CACHE_DIR") or \
+        os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "caniot")
+    return os.path.join(base, "chunks_size.json")
+
+
+class ChunksSizeCache:
+    # {"host:port": {"chunks_size": .., "throughput": .., "timestamp": ..}}
+    def __init__(self, path: Optional[str] = None):
+        self.path = path if path is not None else default_cache_path()
+        self._entries: Optional[Dict[str, dict]] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, dict]:
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def get(self, host: str, port: int) -> Optional[int]:
+        with self._lock:
+            entry = self._load().get(f"{host}:{port}")
+        return entry["chunks_size"] if entry else None
+
+    def put(self, host: str, port: int, chunks_size: int, throughput: float):
+        with self._lock:
+            entries = self._load()
+            entries[f"{host}:{port}"] = {
+                "chunks_size": chunks_size,
+                "throughput": round(throughput, 1),
+                "timestamp": int(time.time()),
+            }
+
+            directory = os.path.dirname(os.path.abspath(self.path))
+            try:
+                os.makedirs(directory, exist_ok=True)
+                fd, tmp = tempfile.mkstemp(prefix=".chunks_size-", dir=directory)
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f, indent=1)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                logger.warning(f"Failed to save chunks size cache {self.path}: {e}")
+
+
+# shared by the controllers, loaded on first use
+cache = ChunksSizeCache()
+
+
+def probe_chunks_sizes(ctrl: Controller,
+                       sizes: Iterable[int] = PROBE_CHUNKS_SIZES,
+                       probe_size: int = 65536,
+                       rounds: int = 3,
+                       route: str = "api/test/streaming") -> Dict[int, float]:
+    # Median throughput (B/s) of a `probe_size` bytes chunked upload for each size
+    payload = bytes(probe_size)
+    results = {}
+
+    for size in sizes:
+        durations = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            resp = ctrl._req("POST", ctrl.url.sub(route), data=MakeChunks(payload, size),
+                             headers={"Content-Type": "application/octet-stream"})
+            dt = time.perf_counter() - t0
+            if resp.status_code != 200:
+                logger.warning(f"Chunks size probe {size} B failed: {resp.status_code} {resp.reason}")
+                break
+            durations.append(dt)
+        else:
+            results[size] = probe_size / statistics.median(durations)
+            logger.info(f"Chunks size {size} B: {results[size] / 1024:.1f} KiB/s")
+
+    return results
+
+
+def tune_chunks_size(ctrl: Controller, cache: ChunksSizeCache = cache, **kwargs) -> int:
+    # Probe the chunk sizes and cache the fastest one for the controller
+    results = probe_chunks_sizes(ctrl, **kwargs)
+    if not results:
+        logger.error(f"Chunks size tuning failed for {ctrl.host}:{ctrl.port}")
+        return DEFAULT_CHUNKS_SIZE
+
+    best = max(results, key=results.get)
+    cache.put(ctrl.host, ctrl.port, best, results[best])
+    logger.info(f"Best chunks size for {ctrl.host}:{ctrl.port}: {best} B "
+                f"({results[best] / 1024:.1f} KiB/s)")
+    return best
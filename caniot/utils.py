@@ -1,8 +1,85 @@
-from typing import Iterable
+import json
+import mmap
+import os
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Iterable, Iterator, Optional, Union
 
-def MakeChunks(data: bytes, size: int) -> Iterable:
+def MakeChunks(data: Union[bytes, memoryview], size: int) -> Iterable[Union[bytes, memoryview]]:
+    # Slices of `data` (zero-copy for a memoryview)
     for i in range(0, len(data), size):
         yield data[i:i+size]
 
+def MakeTransientChunks(data: Union[bytes, memoryview], size: int) -> Iterable[memoryview]:
+    # Zero-copy slices of `data`, each chunk is only valid until the next one
+    # is requested (views are released so that a mapped file can be closed).
+    # Only for consumers which don't keep the chunks (uploads).
+    with memoryview(data) as view:
+        for i in range(0, len(view), size):
+            with view[i:i+size] as chunk:
+                yield chunk
+
+@contextmanager
+def map_file(source: Union[str, BinaryIO]) -> Iterator[memoryview]:
+    # Read-only view of a file (path or binary file object) without loading
+    # it into memory, through mmap when the file supports it.
+    f = open(source, "rb") if isinstance(source, (str, os.PathLike)) else source
+    mm = None
+    try:
+        try:
+            size = os.fstat(f.fileno()).st_size - f.tell()
+            if size > 0:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError):
+            # not a regular file (pipe, BytesIO, ...)
+            pass
+
+        if mm is not None:
+            view = memoryview(mm)[f.tell():]
+        elif hasattr(f, "getbuffer"):
+            view = f.getbuffer()[f.tell():]
+        else:
+            view = memoryview(f.read())
+
+        try:
+            yield view
+        finally:
+            view.release()
+    finally:
+        if mm is not None:
+            try:
+                mm.close()
+            except BufferError:
+                # a view is still referenced, the mapping is closed once collected
+                pass
+        if f is not source:
+            f.close()
+
+# Validators of a partially downloaded file, sent back as If-Range on resume
+def response_validator(resp) -> Dict[str, Optional[str]]:
+    # weak ETags can't be used with If-Range
+    etag = resp.headers.get("ETag")
+    if etag is not None and etag.startswith("W/"):
+        etag = None
+    return {"etag": etag, "last_modified": resp.headers.get("Last-Modified")}
+
+def same_validator(validator: dict, current: dict) -> bool:
+    # only validators given by both sides are compared
+    for name in ("etag", "last_modified"):
+        if validator.get(name) and current.get(name):
+            return validator[name] == current[name]
+    return True
+
+def read_validator(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r") as f:
+            validator = json.load(f)
+        return validator if isinstance(validator, dict) else None
+    except (OSError, ValueError):
+        return None
+
+def write_validator(path: str, validator: dict):
+    with open(path, "w") as f:
+        json.dump(validator, f)
+
 def is_bit_set(n: int, bit: int = 0) -> bool:
-    return bool(n & (1 << bit))
\ No newline at end of file
+    return bool(n & (1 << bit))
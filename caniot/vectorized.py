@@ -0,0 +1,114 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+# Vectorized (NumPy) decoding/encoding of CANIOT arbitration ids,
+# same bit layout as MsgId.get() / MsgId.from_int().
+
+from __future__ import annotations
+
+from typing import Optional
+
+try:
+    import numpy as np
+except ImportError:  # numpy is an optional dependency
+    np = None
+
+from .caniot import FrameType, QueryType
+
+MSGID_FIELDS = [
+    ("arbitration_id", "u4"),
+    ("frame_type", "u1"),
+    ("query_type", "u1"),
+    ("device_cls", "u1"),
+    ("device_sid", "u1"),
+    ("device_id", "u1"),
+    ("endpoint", "u1"),
+    ("extended_id", "u4"),
+    ("is_extended", "?"),
+    ("is_valid", "?"),
+    ("is_error", "?"),
+    ("is_broadcast", "?"),
+]
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for caniot.vectorized (pip install numpy)")
+
+
+def msgid_dtype() -> np.dtype:
+    _require_numpy()
+    return np.dtype(MSGID_FIELDS)
+
+
+def decode_ids(ids, extended: Optional[bool] = None) -> np.ndarray:
+    # `extended` has the same meaning as for MsgId.from_int()
+    _require_numpy()
+
+    ids = np.asarray(ids, dtype=np.uint32)
+
+    out = np.empty(ids.shape, dtype=msgid_dtype())
+    out["arbitration_id"] = ids
+
+    frame_type = (ids & 0b11).astype(np.uint8)
+    query_type = ((ids >> 2) & 0b1).astype(np.uint8)
+    device_id = ((ids >> 3) & 0b111111).astype(np.uint8)
+
+    out["frame_type"] = frame_type
+    out["query_type"] = query_type
+    out["device_id"] = device_id
+    out["device_cls"] = device_id & 0b111
+    out["device_sid"] = device_id >> 3
+    out["endpoint"] = (ids >> 9) & 0b11
+
+    if extended is False:
+        out["extended_id"] = 0
+        out["is_extended"] = False
+    else:
+        out["extended_id"] = ids >> 11
+        out["is_extended"] = (ids >> 11) != 0
+
+    is_error = (frame_type == FrameType.Command) & (query_type == QueryType.Response)
+    is_broadcast = device_id == 0b111111
+
+    out["is_error"] = is_error
+    out["is_broadcast"] = is_broadcast
+    # cannot be a response from all nodes
+    out["is_valid"] = (device_id != 0) & ~is_error & \
+        ((query_type == QueryType.Query) | ~is_broadcast)
+
+    return out
+
+
+def encode_ids(frame_type, query_type=None, device_cls=None, device_sid=None,
+               endpoint=0, extended_id=0) -> np.ndarray:
+    # Inverse of decode_ids(), either from broadcastable columns or from
+    # a structured array returned by decode_ids().
+    _require_numpy()
+
+    frame_type = np.asarray(frame_type)
+    if frame_type.dtype.names is not None:
+        decoded = frame_type
+        return encode_ids(decoded["frame_type"], decoded["query_type"],
+                          decoded["device_cls"], decoded["device_sid"],
+                          decoded["endpoint"],
+                          np.where(decoded["is_extended"], decoded["extended_id"], 0))
+
+    missing = [name for name, column in (("query_type", query_type),
+                                         ("device_cls", device_cls),
+                                         ("device_sid", device_sid)) if column is None]
+    if missing:
+        raise ValueError(f"Missing column(s): {', '.join(missing)}")
+
+    def u32(column):
+        return np.asarray(column).astype(np.uint32)
+
+    return (u32(frame_type) & 0b11) | \
+        (u32(query_type) & 0b1) << 2 | \
+        (u32(device_cls) & 0b111) << 3 | \
+        (u32(device_sid) & 0b111) << 6 | \
+        (u32(endpoint) & 0b11) << 9 | \
+        u32(extended_id) << 11
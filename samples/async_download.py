@@ -0,0 +1,45 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import asyncio
+import os
+import tempfile
+
+from caniot.async_controller import AsyncController
+from caniot.mock_server import MockController
+from caniot.utils import response_validator, write_validator
+
+sizes = [10, 1000, 16384, 16385, 100 * 1024]
+
+async def main(mock: MockController, tmp: str):
+    async with AsyncController(mock.host, mock.port) as ctrl:
+        for size in sizes:
+            content = os.urandom(size)
+            mock.files[f"file_{size}.bin"] = content
+
+            dest = os.path.join(tmp, f"file_{size}.bin")
+            assert await ctrl.download(f"file_{size}.bin", dest)
+            with open(dest, "rb") as f:
+                assert f.read() == content, f"{size} B: content mismatch"
+            print(f"{size} B: OK")
+
+        # resumed from a partial download left by a previous call
+        content = mock.files[f"file_{sizes[-1]}.bin"]
+        dest = os.path.join(tmp, "resumed.bin")
+        assert await ctrl.download(f"file_{sizes[-1]}.bin", dest)
+        os.rename(dest, dest + ".part")
+        with open(dest + ".part", "r+b") as f:
+            f.truncate(len(content) // 3)
+        resp = await ctrl._req("GET", ctrl.url.sub(f"api/files/file_{sizes[-1]}.bin"))
+        write_validator(dest + ".part.meta", dict(response_validator(resp), size=len(content)))
+
+        assert await ctrl.download(f"file_{sizes[-1]}.bin", dest)
+        with open(dest, "rb") as f:
+            assert f.read() == content, "resumed: content mismatch"
+        print("resumed: OK")
+
+with MockController() as mock, tempfile.TemporaryDirectory() as tmp:
+    asyncio.run(main(mock, tmp))
@@ -0,0 +1,28 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import asyncio
+
+from caniot.caniot import DeviceId, Endpoint
+from caniot.async_controller import AsyncController
+
+from pprint import pprint
+
+ip = "192.0.2.1" if False else "192.168.10.240"
+
+async def main():
+    async with AsyncController(ip, pool_size=4) as ctrl:
+        dids = [DeviceId(cls, sid) for cls in range(2) for sid in range(8)]
+
+        results = await asyncio.gather(*[
+            ctrl.caniot.request_telemetry(did, Endpoint.BoardLevelControl) for did in dids
+        ])
+
+        for did, res in zip(dids, results):
+            print(did)
+            pprint(res)
+
+asyncio.run(main())
@@ -0,0 +1,29 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from caniot.controller import Controller
+from caniot.counters import CounterMonitor
+from caniot.caniot import DeviceId
+import time
+
+qemu = False
+
+ip = "192.0.2.1" if qemu else "192.168.10.240"
+
+dids = [DeviceId(1, sid) for sid in range(8)]
+
+with Controller(ip) as ctrl:
+    monitor = CounterMonitor(period=10.0, window=60.0)
+    monitor.add_controller(ctrl)
+    monitor.add_nodes(ctrl.caniot, dids)
+
+    with monitor:
+        while True:
+            time.sleep(monitor.period)
+
+            # nodes flooding the bus first
+            for name, rate in monitor.top("SysReceivedTotal", n=5):
+                print(f"{name}: {rate:.2f} frames/s")
@@ -0,0 +1,34 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from caniot.controller import Controller
+from caniot.device_sync import DeviceTableSync
+import time
+
+qemu = False
+
+ip = "192.0.2.1" if qemu else "192.168.10.240"
+
+with Controller(ip) as ctrl:
+    sync = DeviceTableSync(ctrl)
+
+    while True:
+        changes = sync.refresh()
+        if changes is None:
+            # failed, previous snapshot kept
+            time.sleep(5.0)
+            continue
+
+        for dev in changes.added:
+            print(f"+ {dev['addr_type']} {dev['addr_medium']} {dev['addr_repr']}")
+        for dev in changes.removed:
+            print(f"- {dev['addr_type']} {dev['addr_medium']} {dev['addr_repr']}")
+        for change in changes.changed:
+            for ep in change.endpoints:
+                if ep.new_event:
+                    print(f"  {' '.join(change.key)} ep={ep.index}: event at {ep.last_event}")
+
+        time.sleep(5.0)
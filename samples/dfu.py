@@ -13,4 +13,9 @@ ip = "192.0.2.1" if False else "192.168.10.240"
 with Controller(ip) as ctrl:    
     dfu_status = ctrl.get_dfu_status()
 
-    print(dfu_status)
\ No newline at end of file
+    print(dfu_status)
+
+    # firmware update, the image is streamed and the status polled until
+    # the controller reports the new image
+    # report = ctrl.dfu("./tmp/zephyr.signed.bin", reboot=True)
+    # print(report)
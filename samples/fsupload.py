@@ -20,16 +20,14 @@ fsdir = "./fs"
 tmpdir = "./tmp"
 
 with Controller(ip) as ctrl:
-    for root, subdirs, files in os.walk(fsdir, ):
-        if ".git" in subdirs:
-            subdirs.remove(".git")
+    # only files changed since the last run are uploaded
+    result = ctrl.sync_dir(fsdir, "/",
+                           manifest=os.path.join(tmpdir, "fsupload_manifest.json"),
+                           verify=False)
 
-        dest_dir_path = os.path.join("/", root[len(fsdir):])
-        for file in files:
-            src_path = os.path.join(root, file)
-            dest_path = os.path.join(dest_dir_path, file)
-            print(f"Uploading {src_path} to {dest_path}")
+    for path in result.uploaded:
+        print(f"Uploaded {path}")
+    for path, error in result.failed.items():
+        print(f"Failed {path}: {error}")
 
-            ctrl.upload(src_path, dest_path)
-
-            # resp = ctrl.download(dest_path, dest_path + ".downloaded")
\ No newline at end of file
+    print(result)
@@ -6,9 +6,22 @@
 
 from pprint import pprint
 from caniot.controller import Controller
-import json
+from caniot.metrics import MetricsScraper
+import time
 
 ip = "192.0.2.1" if False else "192.168.10.240"
 
 with Controller(ip) as ctrl:
-    print(ctrl.get_metrics())
\ No newline at end of file
+    print(ctrl.get_metrics())
+
+    for sample in ctrl.iter_metrics():
+        print(sample)
+
+    scraper = MetricsScraper(period=5.0)
+    target = scraper.add(ctrl)
+
+    with scraper:
+        while True:
+            time.sleep(scraper.period)
+            pprint(target.deltas())
+            print(scraper.exposition())
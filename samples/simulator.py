@@ -0,0 +1,42 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+from caniot.can import VirtualCanBus
+from caniot.caniot import DeviceId, Endpoint
+from caniot.controller import CaniotAPI
+from caniot.simulator import Simulator
+from caniot.transport import RawCanTransport
+
+from concurrent.futures import ThreadPoolExecutor
+
+import time
+import statistics
+
+bus = VirtualCanBus()
+
+sim = Simulator(bus, seed=0)
+sim.add_nodes(range(1, 63), latency=0.010, jitter=0.005, drop_rate=0.001)
+sim.start_background()
+
+api = CaniotAPI(None, transport=RawCanTransport(bus.connect()))
+
+def timed_telemetry(did: int):
+    t0 = time.perf_counter()
+    res = api.request_telemetry(did, Endpoint.ApplicationMain)
+    return time.perf_counter() - t0, res is not None
+
+t0 = time.perf_counter()
+with ThreadPoolExecutor(max_workers=32) as executor:
+    results = list(executor.map(timed_telemetry, list(range(1, 63)) * 10))
+elapsed = time.perf_counter() - t0
+
+latencies = sorted(lat for lat, ok in results if ok)
+print(f"{len(latencies)}/{len(results)} responses in {elapsed:.3f} s "
+      f"({len(results) / elapsed:.0f} req/s)")
+print(f"p50={statistics.median(latencies) * 1000:.1f} ms "
+      f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+
+sim.stop_background()
@@ -0,0 +1,29 @@
+#
+# Copyright (c) 2022 Lucas Dietrich <ld.adecy@gmail.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+
+import asyncio
+
+from caniot.caniot import DeviceId, Endpoint
+from caniot.async_controller import AsyncController
+from caniot.scheduler import TelemetryScheduler
+
+ip = "192.0.2.1" if False else "192.168.10.240"
+
+async def main():
+    async with AsyncController(ip, pool_size=4) as ctrl:
+        scheduler = TelemetryScheduler(ctrl.caniot, max_inflight=2)
+
+        for did in [DeviceId(cls, sid) for cls in range(2) for sid in range(8)]:
+            scheduler.add(did, Endpoint.BoardLevelControl, period=10.0)
+
+        async with scheduler:
+            async for result in scheduler:
+                if result.ok():
+                    print(f"{result.did} {result.ep}: {result.value} ({result.latency * 1000:.1f} ms)")
+                else:
+                    print(f"{result.did} {result.ep}: {result.error}")
+
+asyncio.run(main())
@@ -45,11 +45,13 @@ with Controller(ip) as ctrl:
             print(ret)
 
         if False:
-            for i in range(0, 19):
-                dur = device.read_attribute(0x20D0 + (i << 4)).get("value", 0)
-                print(f"{i} Pulse duration {dur} ms")
+            keys = [0x20D0 + (i << 4) for i in range(0, 19)]
 
-                device.write_attribute(0x20D0 + (i << 4), 500)
+            durations = device.read_attributes(keys)
+            for i, key in enumerate(keys):
+                print(f"{i} Pulse duration {durations.get(key, 0)} ms")
+
+            device.write_attributes({key: 500 for key in keys})
 
         # ret = device.read_attribute(0x20D0 + ((19) << 4))
         # print(ret)
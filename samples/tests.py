@@ -7,17 +7,13 @@
 import sys
 
 from pprint import pprint
-from caniot.testclient import TestClient, ChunksGeneratorType
+from caniot.testclient import TestClient, ChunksGeneratorType, PatternPayload
 
 ip = ("192.168.10.240", 80)
 ip = ("192.0.2.1", 80)
 
 def simple_chunk_generator(size: int, chunks_size: int = 1024) -> ChunksGeneratorType:
-    sent = 0
-    while sent < size:
-        tosend = min(chunks_size, size - sent)
-        yield bytes([65 for _ in range(tosend)])
-        sent += tosend
+    return iter(PatternPayload(size, b"A", chunks_size))
 
 if __name__ == "__main__":
 
@@ -52,6 +48,8 @@ if __name__ == "__main__":
         res = t.test_session()
     elif test_n == 6:
         res = t.test_simultaneous(5, 5)
+    elif test_n == 7:
+        res = t.test_throughput()
 
     print(res)
 